@@ -0,0 +1,210 @@
+#Computer-controlled players.
+#An AI picks each move by trying every sensible option many times over: it plays the option on a copy of the game, lets
+#everyone carry on with a quick rule-of-thumb policy until its next turn comes round, and scores how it's doing by then.
+#The option with the best average score wins. The rollouts run in a pool of workers for THINK_TIME seconds per move, so
+#the event loop never waits on them. Setup deployments and trading in cards don't need that much thought and are done by
+#the policy alone.
+#AI players get ids like "ai1", which can't clash with Discord ids, and never show up in the directory or the users table.
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from engine import RuleError
+from rules import neighbours, mask_of, new_troops_for, territory_names, territory_index
+import asyncio
+import codec
+import engine
+import events
+import metrics
+import random
+import time
+import os
+
+AI_PREFIX = "ai"
+THINK_TIME = float(os.environ.get("AI_THINK_TIME", 0.5))
+ROLLOUT_ROUNDS = int(os.environ.get("AI_ROLLOUT_ROUNDS", 1))
+MAX_FORTIFY_SOURCES = 5
+
+def is_ai(player_id):
+  return str(player_id).startswith(AI_PREFIX)
+
+#The first AI id that isn't taken yet in this game.
+def new_ai_id(players):
+  players = [str(player_id) for player_id in players]
+  n = 1
+  while f"{AI_PREFIX}{n}" in players: n += 1
+  return f"{AI_PREFIX}{n}"
+
+def name(game, player_id):
+  return game["players"][str(player_id)]["colour"].title() + " Bot"
+
+
+#Actions are events without the player id (see events.py):
+#("trade",), ("deploy", location, troops), ("blitz", target, attacker, 1), ("move", troops), ("fortify", troops, start, destination), ("endturn",)
+def event(player_id, action):
+  return [action[0], player_id, *action[1:]]
+
+def apply(game, player_id, action, rng=random):
+  return events.run(game, event(player_id, action), rng)
+
+#Each territory's neighbours, with their indices. The helpers below run over and over in every rollout, so they read the
+#game's owner and troop arrays (see boards.Territories) straight, by index, instead of going through a territory view.
+neighbour_indices = {name:tuple((neighbour, territory_index[neighbour]) for neighbour in neighbours[name]) for name in territory_names}
+
+#The player's territories that have an enemy next door.
+def border_territories(game, player_id):
+  owners = game["territories"].owners
+  return [name for name in game["players"][player_id]["territories"]
+          if any(owners[i] != player_id for _, i in neighbour_indices[name])]
+
+def attack_options(game, player_id):
+  owners, troops = game["territories"].owners, game["territories"].troops
+  return [(target, attacker) for attacker in game["players"][player_id]["territories"] if troops[territory_index[attacker]] > 1
+          for target, i in neighbour_indices[attacker] if owners[i] != player_id]
+
+#Whether the last attack took its target and left troops behind that could still follow.
+def can_follow_up(game, player_id):
+  if not game["last_attack"]: return False
+  target, attacker, _ = game["last_attack"]
+  return game["territories"][target]["owner"] == player_id and game["territories"][attacker]["troops"] > 1
+
+def wants_to_trade(game, player):
+  return game["turn_stage"] == 0 or (game["turn_stage"] == 1 and not game["in_pregame"] and len(player["cards"]) >= 3
+                                     and engine.select_cards(player) is not None)
+
+
+#The quick rule-of-thumb player used for everyone during rollouts, and for the AI's own setup moves.
+#Trade whenever possible, pile every troop onto one border territory, attack wherever the odds look good, then stop.
+def policy_action(game, player_id, rng=random):
+  player = game["players"][player_id]
+  territories = game["territories"]
+
+  if wants_to_trade(game, player):
+    return ("trade",)
+
+  if game["turn_stage"] == 1:
+    if game["in_pregame"]:
+      if game["unclaimed_territories"]:
+        unclaimed = [name for name, territory in territories.items() if territory["owner"] is None]
+        nearby = [name for name in unclaimed if any(territories[neighbour]["owner"] == player_id for neighbour in neighbours[name])]
+        return ("deploy", rng.choice(nearby or unclaimed), 1)
+      return ("deploy", rng.choice(border_territories(game, player_id) or player["territories"]), 1)
+    return ("deploy", rng.choice(border_territories(game, player_id) or player["territories"]), player["deployable_troops"])
+
+  if can_follow_up(game, player_id):
+    return ("move", None)
+
+  troops = territories.troops
+  options = [(target, attacker) for target, attacker in attack_options(game, player_id)
+             if troops[territory_index[attacker]] > troops[territory_index[target]] + 1]
+  if options:
+    return ("blitz",) + rng.choice(options) + (1,)
+  return ("endturn",)
+
+#How well a player is doing: their share of the board and of the troops on it, plus what they'll get next turn.
+def score(game, player_id):
+  player = game["players"][player_id]
+  if not player["territories"]: return 0.0
+  if len(player["territories"]) == len(territory_names): return 10.0
+  all_troops = game["territories"].troops
+  troops = sum(all_troops[territory_index[name]] for name in player["territories"])
+  total_troops = sum(all_troops)
+  return len(player["territories"]) / len(territory_names) + troops / total_troops + new_troops_for(mask_of(player["territories"])) / 10
+
+#Plays action on a copy of the game (given encoded, see codec.py), then lets the policy play everyone until it's the
+#player's turn again rounds times.
+def rollout(encoded_game, player_id, action, rng, rounds=ROLLOUT_ROUNDS):
+  game = codec.decode(encoded_game)
+  try:
+    result = apply(game, player_id, action, rng)
+    turns_left = rounds
+    current = engine.active_player_id(game)
+    while not getattr(result, "victory", False):
+      result = apply(game, current, policy_action(game, current, rng), rng)
+      next_player = engine.active_player_id(game)
+      if next_player != current:
+        if next_player == player_id:
+          turns_left -= 1
+          if turns_left == 0: break
+        current = next_player
+  except (RuleError, IndexError): #An option that turned out not to be legal, or the deck's run dry; score it as it stands.
+    pass
+  return score(game, player_id)
+
+#Runs rollouts of every action in turn until the time's up. Returns the total score and rollout count for each action.
+#This is what the pool's workers run.
+def simulate(encoded_game, player_id, actions, seconds, seed):
+  rng = random.Random(seed)
+  totals = [0.0] * len(actions)
+  counts = [0] * len(actions)
+  deadline = time.perf_counter() + seconds
+  while True:
+    for i, action in enumerate(actions):
+      totals[i] += rollout(encoded_game, player_id, action, rng)
+      counts[i] += 1
+    if time.perf_counter() >= deadline: break
+  return totals, counts
+
+
+#The AI pool. AI_POOL picks "process" or "thread" workers (or "none" to use asyncio's default threads), AI_WORKERS picks
+#how many. Every worker spends the whole think time on rollouts, so more workers means more rollouts per move.
+ai_pool = None
+ai_workers = 1
+
+def start_ai_pool(kind=None, workers=None):
+  global ai_pool, ai_workers
+  kind = kind or os.environ.get("AI_POOL", "process")
+  ai_workers = workers or int(os.environ.get("AI_WORKERS", 2))
+  if kind == "process":
+    ai_pool = ProcessPoolExecutor(max_workers=ai_workers)
+  elif kind == "thread":
+    ai_pool = ThreadPoolExecutor(max_workers=ai_workers, thread_name_prefix="ai")
+  else:
+    ai_workers = 1
+
+def stop_ai_pool():
+  global ai_pool
+  if ai_pool:
+    ai_pool.shutdown()
+    ai_pool = None
+
+#Picks the action with the best average rollout score. The game goes to the workers encoded, which is a few hundred
+#bytes to send to another process instead of a pickled dict.
+async def choose(game, player_id, actions):
+  if len(actions) == 1: return actions[0]
+  start = time.perf_counter()
+  loop = asyncio.get_running_loop()
+  encoded_game = codec.encode(game)
+  results = await asyncio.gather(*(loop.run_in_executor(ai_pool, simulate, encoded_game, player_id, actions, THINK_TIME, random.random())
+                                   for worker in range(ai_workers)))
+  totals = [sum(result[0][i] for result in results) for i in range(len(actions))]
+  counts = [sum(result[1][i] for result in results) for i in range(len(actions))]
+  metrics.tally("ai rollouts/s", sum(counts) / (time.perf_counter() - start))
+  return max(zip(actions, totals, counts), key=lambda option: option[1] / option[2])[0]
+
+#Decides what the AI whose turn it is does next.
+async def next_action(game, player_id):
+  player = game["players"][player_id]
+  territories = game["territories"]
+
+  if game["in_pregame"] or wants_to_trade(game, player):
+    return policy_action(game, player_id)
+
+  if game["turn_stage"] == 1:
+    return await choose(game, player_id, [("deploy", name, player["deployable_troops"])
+                                          for name in border_territories(game, player_id) or player["territories"]])
+
+  #After a conquest, the troops left behind follow unless there's still an enemy next to them.
+  if can_follow_up(game, player_id):
+    attacker = game["last_attack"][1]
+    if all(territories[neighbour]["owner"] == player_id for neighbour in neighbours[attacker]):
+      return ("move", None)
+
+  #Attacking, or ending the turn, with or without bringing some troops from the back up to the front.
+  actions = [("blitz", target, attacker, 1) for target, attacker in attack_options(game, player_id)]
+  borders = set(border_territories(game, player_id))
+  sources = sorted((name for name in player["territories"] if name not in borders and territories[name]["troops"] > 1),
+                   key=lambda name: territories[name]["troops"], reverse=True)[:MAX_FORTIFY_SOURCES]
+  for start in sources:
+    for destination in neighbours[start]:
+      if destination in borders:
+        actions.append(("fortify", territories[start]["troops"] - 1, start, destination))
+  actions.append(("endturn",))
+  return await choose(game, player_id, actions)
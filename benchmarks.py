@@ -0,0 +1,261 @@
+#Rough timings for the hot paths of the bot. Run with 'python benchmarks.py'; nothing here talks to Discord or the database.
+from PIL import ImageDraw
+from rules import neighbours
+import display
+import engine
+import events
+import codec
+import ai
+import parsing
+import rules
+import odds
+import random as r
+import timeit
+import json
+import pickle
+
+#A game with every territory claimed by one of six players, which is as busy as the map ever gets.
+def sample_game(seed=0):
+  rng = r.Random(seed)
+  colours = ("red", "blue", "yellow", "green", "brown", "black")
+  game = {"index":None,
+          "players":{str(i):{"colour":colour} for i, colour in enumerate(colours)},
+          "territories":{name:{"owner":str(rng.randrange(6)), "troops":rng.randint(1, 30)} for name in display.points.keys()}}
+  return game
+
+#How draw_map used to do it, for comparison: a fresh copy of the map with every marker drawn from scratch.
+def legacy_draw_map(game):
+  im = display.load_base_map().convert("RGB")
+  draw = ImageDraw.Draw(im)
+  for name, territory in game["territories"].items():
+    point = display.points[name]
+    point_box = (point[0]-7, point[1]-7, point[0]+7, point[1]+7)
+    owner = str(territory["owner"])
+    colour = display.COLOURS[game["players"][owner]["colour"] if owner != "None" else None]
+    draw.ellipse(point_box, fill=colour)
+    troop_count = territory["troops"]
+    draw.text((point_box[0] + 2 + (0 if troop_count > 9 else 3), point_box[1] + 2), str(troop_count), font=draw.getfont(), fill=((0, 0, 0) if colour == (255, 245, 0) else (255, 255, 255)))
+  return im
+
+#The same full redraw, but pasting markers from the sprite atlas.
+def atlas_draw_map(game):
+  im = display.load_base_map().convert("RGB")
+  for name, (colour, troop_count) in zip(game["territories"].keys(), display.map_fingerprint(game)):
+    sprite = display.get_sprite(colour, troop_count)
+    im.paste(sprite, display.marker_box(display.points[name], sprite)[:2], sprite)
+  return im
+
+def bench(label, function, number=200):
+  seconds = timeit.timeit(function, number=number) / number
+  print(f"{label:<40}{seconds*1000:>10.4f} ms")
+
+def bench_rendering():
+  display.load_base_map()
+  game = sample_game()
+
+  print("Rendering")
+  bench("markers, ellipse + text", lambda: legacy_draw_map(game))
+  bench("markers, sprite atlas", lambda: atlas_draw_map(game))
+
+  #A full render including the JPEG encode, then the common case of a single territory changing.
+  def full_render():
+    display.canvases.clear()
+    display.cached_maps.clear()
+    display.draw_map(dict(game, index=0))
+  bench("draw_map, blank canvas", full_render, number=50)
+
+  territory = game["territories"]["Siam"]
+  def one_change():
+    territory["troops"] = territory["troops"] % 30 + 1
+    display.draw_map(dict(game, index=0))
+  bench("draw_map, one territory changed", one_change, number=50)
+  bench("draw_map, nothing changed", lambda: display.draw_map(dict(game, index=0)))
+
+#Turning messages into commands, apart from doing anything with them. The typo lookups skip the cache, as a first
+#typo would.
+def bench_parsing():
+  print("Parsing")
+  usage = "usage"
+  bench("tokenize + clauses", lambda: parsing.parse_clauses(parsing.tokenize("!attack Middle East from North Africa with 2")[1], ("from", "with"), usage), number=10000)
+  bench("territory, exact", lambda: parsing.territory("Middle East"), number=10000)
+  bench("territory, alias", lambda: parsing.territory("E. Africa"), number=10000)
+  def typo():
+    parsing.find_territories.cache_clear()
+    parsing.territory("Kamchatca")
+  bench("territory, typo (uncached)", typo, number=1000)
+
+#Size and encode time of a full map in each output format, at full size and as a mid-turn thumbnail.
+def bench_encoding():
+  im = atlas_draw_map(sample_game())
+
+  print("Encoding")
+  for format, quality in (("jpeg", 75), ("jpeg", 50), ("png", None), ("webp", 75), ("webp", 50)):
+    for scale in (1, display.THUMBNAIL_SCALE):
+      label = f"{format}" + (f" q{quality}" if quality else "") + f" x{scale}"
+      seconds = timeit.timeit(lambda: display.encode_map(im, format=format, quality=quality, scale=scale), number=20) / 20
+      size = len(display.encode_map(im, format=format, quality=quality, scale=scale))
+      print(f"{label:<40}{seconds*1000:>10.3f} ms{size/1024:>10.1f} KB")
+
+#Plays a whole game between bots that pick random legal moves, straight through the engine. Returns the number of actions.
+def random_game(players=4, seed=0):
+  rng = r.Random(seed)
+  game = engine.create_game(list(range(players)), randomfill=True, rng=rng)
+  actions = 0
+  while True:
+    player_id = engine.active_player_id(game)
+    player = game["players"][player_id]
+    actions += 1
+
+    try:
+      if game["turn_stage"] == 0:
+        engine.trade(game, player_id)
+      elif game["turn_stage"] == 1:
+        engine.deploy(game, player_id, rng.choice(player["territories"]), player["deployable_troops"])
+      else:
+        attacks = ai.attack_options(game, player_id)
+        if attacks and rng.random() < 0.9:
+          result = engine.attack(game, player_id, *rng.choice(attacks), rng=rng)
+          if result.victory: return actions
+          if result.extra_troops: engine.conquer_move(game, player_id)
+        else:
+          engine.end_turn(game, player_id)
+    except IndexError: #The deck has run dry; call it a draw.
+      return actions
+
+def bench_engine():
+  print("Engine")
+  bench("create_game, six players", lambda: engine.create_game(list(range(6))), number=1000)
+  bench("create_game, randomfill", lambda: engine.create_game(list(range(6)), randomfill=True), number=1000)
+
+  game = engine.create_game(list(range(6)), randomfill=True)
+  player = game["players"][engine.active_player_id(game)]
+  bench("calculate_new_troops", lambda: engine.calculate_new_troops(player), number=10000)
+
+  player = {"territories":["Siam", "Alaska"],
+            "cards":[("Infantry", "Siam"), ("Cavalry", "Peru"), ("Artillery", "Egypt"), ("Infantry", "Alaska"), ("Wild", None)]}
+  bench("select_cards, five cards", lambda: engine.select_cards(player), number=10000)
+  player = dict(player, cards=player["cards"] + [("Cavalry", "Siam"), ("Artillery", "Alaska"), ("Infantry", "Peru"), ("Wild", None)])
+  bench("select_cards, nine cards", lambda: engine.select_cards(player), number=10000)
+  #A player's connected groups of territories, worked out from scratch and then from the cache.
+  mask = rules.mask_of(game["players"][engine.active_player_id(game)]["territories"])
+  def fresh_components():
+    rules.components.cache_clear()
+    rules.components(mask)
+  bench("components, uncached", fresh_components, number=10000)
+  bench("components, cached", lambda: rules.components(mask), number=10000)
+  bench("roll_dice + resolve_dice", lambda: engine.resolve_dice(*engine.roll_dice(3, 2)), number=10000)
+
+  #30 attackers worn down against a wall of defenders, one !attack at a time and as a single !blitz.
+  player_id = engine.active_player_id(game)
+  attacker = game["players"][player_id]["territories"][0]
+  target = next(name for name in neighbours[attacker] if game["territories"][name]["owner"] != player_id)
+  game["turn_stage"] = 2
+  def reset():
+    game["territories"][attacker]["troops"] = 30
+    game["territories"][target]["troops"] = 500
+  def attacks():
+    reset()
+    while game["territories"][attacker]["troops"] > 1:
+      engine.attack(game, player_id, target, attacker)
+  def blitz():
+    reset()
+    engine.blitz(game, player_id, target, attacker)
+  bench("30 troops, repeated attack", attacks, number=1000)
+  bench("30 troops, blitz", blitz, number=1000)
+  #A blitz with until stops at the threshold; it never ends up below it.
+  for seed in range(2000):
+    game["territories"][attacker]["troops"] = 6
+    game["territories"][target]["troops"] = 500
+    engine.blitz(game, player_id, target, attacker, until=5, rng=r.Random(seed))
+    assert game["territories"][attacker]["troops"] >= 5, seed
+
+  odds.load_table()
+  bench("odds lookup", lambda: odds.lookup(150, 120), number=100000)
+
+  number = 20
+  seconds = timeit.timeit(lambda: random_game(seed=r.random()), number=number)
+  print(f"{'random games':<40}{number/seconds:>10.1f} games/s")
+
+  #How many AI rollouts one worker gets through, which is what sizes the AI pool.
+  game = engine.create_game(list(range(4)), randomfill=True, rng=r.Random(0))
+  player_id = engine.active_player_id(game)
+  actions = [("deploy", name, game["players"][player_id]["deployable_troops"]) for name in ai.border_territories(game, player_id)]
+  totals, counts = ai.simulate(codec.encode(game), player_id, actions, 2, 0)
+  print(f"{'ai rollouts, one worker':<40}{sum(counts)/2:>10.1f} rollouts/s")
+
+#Stands in for a UnitOfWork, keeping the events it's given.
+class EventList(list):
+  def record(self, game_id, event):
+    self.append(event)
+
+#Plays a random game through events, returning the game and its log.
+def logged_game(seed=0):
+  rng = r.Random(seed)
+  game, event = events.create_game(list(range(4)), randomfill=True, log_id=seed + 1)
+  game["index"] = None
+  log = EventList([event])
+  try:
+    while True:
+      player_id = engine.active_player_id(game)
+      player = game["players"][player_id]
+      if game["turn_stage"] == 0:
+        events.apply(log, game, ["trade", player_id, []])
+      elif game["turn_stage"] == 1:
+        events.apply(log, game, ["deploy", player_id, rng.choice(player["territories"]), player["deployable_troops"]])
+      else:
+        attacks = ai.attack_options(game, player_id)
+        if attacks and rng.random() < 0.9:
+          result = events.apply(log, game, ["attack", player_id, *rng.choice(attacks), 3])
+          if result.victory: break
+          if result.extra_troops: events.apply(log, game, ["move", player_id, None])
+        else:
+          events.apply(log, game, ["endturn", player_id])
+  except IndexError:
+    pass
+  return game, log
+
+def bench_events():
+  print("Events")
+  game, log = logged_game()
+  print(f"{'game snapshot':<40}{len(codec.encode(game)):>10} bytes")
+  print(f"{'event, on average':<40}{sum(len(json.dumps(event)) for event in log) / len(log):>10.1f} bytes")
+  bench(f"replay, whole game ({len(log)} events)", lambda: events.replay(1, log), number=20)
+  snapshot = codec.encode(events.replay(1, log, len(log) - 21))
+  def trailing():
+    game = codec.decode(snapshot)
+    for event in log[-20:]:
+      events.apply(None, game, event)
+  bench("load, snapshot + 20 events", trailing, number=1000)
+  bench("load, snapshot alone", lambda: codec.decode(snapshot), number=1000)
+
+#Checks that codec.py gives back what JSON would at every few events of some random games, then times it against JSON
+#and pickle. JSON gets the territories as the dict per territory they'd be without boards.Territories (default=dict).
+def bench_codec():
+  print("Codec")
+  for seed in range(5):
+    game, log = logged_game(seed)
+    for upto in range(0, len(log), 5):
+      game = events.replay(seed + 1, log, upto)
+      assert codec.decode(codec.encode(game)) == json.loads(json.dumps(game, default=dict)), f"game {seed} differs after event {upto}"
+  print(f"{'round trips':<40}{'ok':>10}")
+
+  game, log = logged_game()
+  game = events.replay(1, log, len(log) // 2)
+  game["index"] = 0
+  encoded, text, pickled = codec.encode(game), json.dumps(game, default=dict), pickle.dumps(game)
+  print(f"{'codec':<40}{len(encoded):>10} bytes")
+  print(f"{'json':<40}{len(text):>10} bytes")
+  print(f"{'pickle':<40}{len(pickled):>10} bytes")
+  bench("codec encode", lambda: codec.encode(game), number=2000)
+  bench("codec decode", lambda: codec.decode(encoded), number=2000)
+  bench("json dumps", lambda: json.dumps(game, default=dict), number=2000)
+  bench("json loads", lambda: json.loads(text), number=2000)
+  bench("pickle dumps + loads", lambda: pickle.loads(pickle.dumps(game)), number=2000)
+
+if __name__ == "__main__":
+  bench_parsing()
+  bench_engine()
+  bench_events()
+  bench_codec()
+  bench_rendering()
+  bench_encoding()
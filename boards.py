@@ -0,0 +1,207 @@
+#The boards games are played on, each read in once and shared by everything that needs it.
+#A board is its territories (in order: a territory's position here is its index everywhere else, see rules.py), who
+#borders whom, the continents and their bonuses, the map picture and the spot on it where each territory's marker goes.
+#These come from three files per board that are easy to get out of step, so they're checked against each other when the
+#board is loaded: a territory missing its marker or a one-way border stops the bot from starting, rather than turning up
+#as a KeyError halfway through someone's game.
+#Everything on a board is a tuple or a read-only mapping, so the one copy can be handed to every game and every thread.
+#Games themselves only hold what changes: who owns each territory and how many troops are on it.
+from collections import namedtuple
+from collections.abc import Mapping
+from types import MappingProxyType
+from PIL import Image
+import array
+
+#Each board's files: territories and borders (grouped under ">Continent bonus" lines), markers and the map.
+BOARDS = {"classic":("territories.txt", "markers.txt", "map.jpg")}
+
+#Cards are stored as a byte each, with the territory in the low 6 bits (see codec.py).
+MAX_TERRITORIES = 64
+
+Continent = namedtuple("Continent", ["name", "bonus", "territories"])
+Board = namedtuple("Board", ["name", "territory_names", "territory_index", "neighbours", "continents", "points",
+                             "image", "image_size"])
+
+class BoardError(Exception):
+  pass
+
+def read_territories(path):
+  continents = []
+  neighbours = {}
+  problems = []
+  with open(path) as file:
+    for number, line in enumerate(file, 1):
+      line = line.strip()
+      if not line: continue
+      if line.startswith(">"):
+        name, _, bonus = line[1:].rpartition(" ")
+        if not bonus.isdigit(): problems.append(f"{path}:{number}: no bonus for {line[1:]!r}")
+        continents.append((name.lower(), int(bonus) if bonus.isdigit() else 0, []))
+        continue
+      name, separator, borders = line.partition(" - ")
+      if not continents or not separator:
+        problems.append(f"{path}:{number}: expected \"territory - neighbour, neighbour\" under a continent, got {line!r}")
+        continue
+      if name in neighbours: problems.append(f"{path}:{number}: {name} is listed twice")
+      continents[-1][2].append(name)
+      neighbours[name] = borders.split(", ")
+  return continents, neighbours, problems
+
+def read_markers(path):
+  points = {}
+  problems = []
+  with open(path) as file:
+    for number, line in enumerate(file, 1):
+      line = line.strip()
+      if not line: continue
+      name, _, point = line.partition(" - ")
+      try:
+        x, y = (int(value) for value in point.split(", "))
+      except ValueError:
+        problems.append(f"{path}:{number}: expected \"territory - x, y\", got {line!r}")
+        continue
+      if name in points: problems.append(f"{path}:{number}: {name} has two markers")
+      points[name] = (x, y)
+  return points, problems
+
+#Everything that would make the files disagree with each other, as a list of messages.
+def check(territory_names, neighbours, continents, points, image_size):
+  problems = []
+  names = set(territory_names)
+  if len(territory_names) > MAX_TERRITORIES:
+    problems.append(f"{len(territory_names)} territories is more than the {MAX_TERRITORIES} a board can have")
+
+  for name in territory_names:
+    for neighbour in neighbours[name]:
+      if neighbour not in names:
+        problems.append(f"{name} borders {neighbour}, which isn't a territory")
+      elif neighbour == name:
+        problems.append(f"{name} borders itself")
+      elif name not in neighbours[neighbour]:
+        problems.append(f"{name} borders {neighbour} but not the other way around")
+
+  for continent in continents:
+    if not continent.territories: problems.append(f"{continent.name} has no territories")
+
+  #Every territory has to be reachable from every other, or some games could never be won.
+  reached = set()
+  frontier = [territory_names[0]] if territory_names else []
+  while frontier:
+    name = frontier.pop()
+    if name in reached or name not in names: continue
+    reached.add(name)
+    frontier.extend(neighbours[name])
+  if names - reached:
+    problems.append(f"{', '.join(sorted(names - reached))} can't be reached from {territory_names[0]}")
+
+  for name in territory_names:
+    if name not in points: problems.append(f"{name} has no marker")
+  for name, (x, y) in points.items():
+    if name not in names:
+      problems.append(f"there's a marker for {name}, which isn't a territory")
+    elif not (0 <= x < image_size[0] and 0 <= y < image_size[1]):
+      problems.append(f"{name}'s marker at {x}, {y} is off the {image_size[0]}x{image_size[1]} map")
+  return problems
+
+def load(name):
+  territories_path, markers_path, image_path = BOARDS[name]
+  continent_lists, neighbours, problems = read_territories(territories_path)
+  points, marker_problems = read_markers(markers_path)
+  problems += marker_problems
+  #Only the size is read here (from the header); display.py decodes the pixels when it first draws something.
+  try:
+    with Image.open(image_path) as image:
+      image_size = image.size
+  except OSError as error:
+    problems.append(f"can't open {image_path}: {error}")
+    image_size = (0, 0)
+
+  territory_names = tuple(neighbours)
+  continents = tuple(Continent(continent_name, bonus, tuple(names)) for continent_name, bonus, names in continent_lists)
+  if not problems:
+    problems = check(territory_names, neighbours, continents, points, image_size)
+  if problems:
+    raise BoardError(f"The {name} board doesn't add up:\n" + "\n".join(problems))
+
+  return Board(name=name,
+               territory_names=territory_names,
+               territory_index=MappingProxyType({territory:i for i, territory in enumerate(territory_names)}),
+               neighbours=MappingProxyType({territory:tuple(borders) for territory, borders in neighbours.items()}),
+               continents=continents,
+               points=MappingProxyType({territory:points[territory] for territory in territory_names}),
+               image=image_path,
+               image_size=image_size)
+
+#Boards that have been loaded, by name. Each one is only ever read in once.
+boards = {}
+
+def get_board(name):
+  if name not in boards:
+    boards[name] = load(name)
+  return boards[name]
+
+
+#A game's territories: each one's owner and troops, in two arrays in the board's order, next to the board they're on.
+#It reads and writes like the dict of {"owner":..., "troops":...} dicts that games have always had (game["territories"]
+#["Siam"]["troops"] += 2), so nothing that uses territories has to know; each territory is only a small view onto its
+#place in the arrays, made when it's asked for.
+class Territories(Mapping):
+  __slots__ = ("board", "owners", "troops")
+
+  def __init__(self, board, owners=None, troops=None):
+    count = len(board.territory_names)
+    self.board = board
+    self.owners = owners if owners is not None else [None] * count
+    self.troops = troops if troops is not None else array.array("I", bytes(4 * count))
+
+  def __getitem__(self, name):
+    return Territory(self, self.board.territory_index[name])
+
+  def __iter__(self):
+    return iter(self.board.territory_names)
+
+  def __len__(self):
+    return len(self.owners)
+
+  def __repr__(self):
+    return repr({name:dict(territory) for name, territory in self.items()})
+
+  #Boards can't be pickled, so a pickled game just names its board.
+  def __reduce__(self):
+    return (territories_on, (self.board.name, self.owners, self.troops))
+
+def territories_on(board_name, owners=None, troops=None):
+  return Territories(get_board(board_name), owners, troops)
+
+#A game's territories as Territories, whether they already are or are still a dict per territory (games saved as JSON).
+def as_territories(territories, board):
+  if isinstance(territories, Territories): return territories
+  return Territories(board, [territories[name]["owner"] for name in board.territory_names],
+                     array.array("I", (territories[name]["troops"] for name in board.territory_names)))
+
+class Territory(Mapping):
+  __slots__ = ("territories", "i")
+  KEYS = ("owner", "troops")
+
+  def __init__(self, territories, i):
+    self.territories = territories
+    self.i = i
+
+  def __getitem__(self, key):
+    if key == "owner": return self.territories.owners[self.i]
+    if key == "troops": return self.territories.troops[self.i]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    if key == "owner": self.territories.owners[self.i] = value
+    elif key == "troops": self.territories.troops[self.i] = value
+    else: raise KeyError(key)
+
+  def __iter__(self):
+    return iter(self.KEYS)
+
+  def __len__(self):
+    return 2
+
+  def __repr__(self):
+    return repr(dict(self))
@@ -0,0 +1,185 @@
+#A compact binary encoding of a game, for storing it and for handing it to other processes.
+#A game as a dict spells out every key and every territory name (in the territories, in each player's list and on
+#every card), which comes to about 4 KB of JSON. Here territories are their index on the board, cards are a byte each,
+#ownership is one byte per territory (the owner's seat) and troops are a packed array, which comes to a few hundred
+#bytes. decode gives back a game equal to what JSON would have: same keys, same order of every list, tuples as lists
+#(except that games from before path fortifying come back with path_fortify False). Its territories are a
+#boards.Territories straight from the two arrays, rather than a dict per territory. Anything in the game this doesn't
+#know about rides along at the end as JSON, so adding a key to games never breaks the encoding.
+#The layout, after the header and the fixed fields below:
+#  each player: id (a tag byte, then a u64 for Discord ids or a length-prefixed string for AIs), turn number, colour,
+#               deployable troops, territory indices, cards (a count of 255 meaning the cards are None)
+#  turn order (seats), eliminated players, each territory's owner's seat (255 for nobody), troops, deck, discard pile,
+#  auto trades if there are any, and the JSON of any other keys
+from engine import COLOURS
+from boards import Territories
+from rules import board, territory_names, territory_index
+import array
+import json
+import struct
+import sys
+
+MAGIC = b"RK"
+VERSION = 1
+HEADER = struct.Struct("<2sB")
+#flags, seats, active player, turn stage, unclaimed territories, trade count, event count, log id, game id,
+#last attack (target, attacker, army size)
+FIXED = struct.Struct("<BBBBBHIqiBBB")
+
+IN_PREGAME = 1
+CARD_CLAIMED = 2
+PATH_FORTIFY = 4
+HAS_LOG = 8
+HAS_INDEX = 16
+HAS_LAST_ATTACK = 32
+HAS_AUTO_TRADES = 64
+
+KNOWN_KEYS = ("players", "territories", "deck", "discard_pile", "turn_order", "active_player", "eliminated_players",
+              "turn_stage", "in_pregame", "unclaimed_territories", "last_attack", "card_claimed", "trade_count",
+              "path_fortify", "log", "event_count", "index", "auto_trades")
+
+#Cards are kind << 6 | territory index, with wilds as WILD.
+CARD_KINDS = ("Infantry", "Cavalry", "Artillery")
+WILD = 3 << 6
+NOBODY = 255
+colour_index = {colour:i for i, colour in enumerate(COLOURS)}
+
+card_codes = {(kind, name):k << 6 | i for k, kind in enumerate(CARD_KINDS) for i, name in enumerate(territory_names)}
+card_codes[("Wild", None)] = WILD
+cards_by_code = {code:card for card, code in card_codes.items()}
+
+def encode_cards(cards):
+  return bytes(card_codes[tuple(card)] for card in cards)
+
+def decode_cards(data):
+  return [list(cards_by_code[code]) for code in data]
+
+#Packs a game into bytes.
+def encode(game):
+  players = game["players"]
+  seats = {player_id:seat for seat, player_id in enumerate(players)}
+  flags = ((IN_PREGAME if game["in_pregame"] else 0) | (CARD_CLAIMED if game["card_claimed"] else 0)
+           | (PATH_FORTIFY if game.get("path_fortify") else 0) | (HAS_LOG if "log" in game else 0)
+           | (HAS_INDEX if game.get("index") is not None else 0) | (HAS_LAST_ATTACK if game["last_attack"] else 0)
+           | (HAS_AUTO_TRADES if game.get("auto_trades") else 0))
+  target, attacker, army_size = game["last_attack"] or (None, None, 0)
+
+  parts = [HEADER.pack(MAGIC, VERSION),
+           FIXED.pack(flags, len(players), game["active_player"], game["turn_stage"], game["unclaimed_territories"],
+                      game["trade_count"], game.get("event_count", 0), game.get("log", 0), game.get("index") or 0,
+                      territory_index.get(target, NOBODY), territory_index.get(attacker, NOBODY), army_size)]
+
+  #The player's id as it appears in the turn order (an int for people, a string for AIs) gives the tag.
+  ids = {str(player_id):player_id for player_id in game["turn_order"]}
+  for player_id, player in players.items():
+    typed_id = ids.get(player_id, player_id)
+    if isinstance(typed_id, int):
+      parts.append(struct.pack("<BQ", 0, typed_id))
+    else:
+      encoded_id = typed_id.encode()
+      parts.append(struct.pack("<BB", 1, len(encoded_id)) + encoded_id)
+    cards = player["cards"]
+    parts.append(struct.pack("<BBIB", player["turn_number"], colour_index[player["colour"]], player["deployable_troops"],
+                             len(player["territories"])))
+    parts.append(bytes(territory_index[name] for name in player["territories"]))
+    parts.append(bytes((NOBODY,)) if cards is None else bytes((len(cards),)) + encode_cards(cards))
+
+  parts.append(bytes(seats[str(player_id)] for player_id in game["turn_order"]))
+  parts.append(bytes((len(game["eliminated_players"]),)) + bytes(game["eliminated_players"]))
+  territories = game["territories"]
+  if isinstance(territories, Territories):
+    owners, troops = territories.owners, array.array("I", territories.troops)
+  else: #Games that came from JSON still have a dict per territory.
+    owners = [territory["owner"] for territory in territories.values()]
+    troops = array.array("I", (territory["troops"] for territory in territories.values()))
+  parts.append(bytes(NOBODY if owner is None else seats[owner] for owner in owners))
+  if sys.byteorder == "big": troops.byteswap()
+  parts.append(troops.tobytes())
+  for cards in (game["deck"], game["discard_pile"]):
+    parts.append(struct.pack("<H", len(cards)) + encode_cards(cards))
+
+  if flags & HAS_AUTO_TRADES:
+    parts.append(bytes((len(game["auto_trades"]),)))
+    for new_troops, bonus_territory in game["auto_trades"]:
+      parts.append(struct.pack("<HB", new_troops, territory_index.get(bonus_territory, NOBODY)))
+
+  extras = {key:value for key, value in game.items() if key not in KNOWN_KEYS}
+  if "auto_trades" in game and not game["auto_trades"]: extras["auto_trades"] = []
+  if "index" in game and game["index"] is None: extras["index"] = None
+  encoded_extras = json.dumps(extras).encode() if extras else b""
+  parts.append(struct.pack("<I", len(encoded_extras)) + encoded_extras)
+  return b"".join(parts)
+
+#Unpacks bytes from encode back into a game.
+def decode(data):
+  magic, version = HEADER.unpack_from(data, 0)
+  if magic != MAGIC or version != VERSION:
+    raise ValueError(f"Not a version {VERSION} game.")
+  (flags, seat_count, active_player, turn_stage, unclaimed_territories, trade_count, event_count, log_id, game_id,
+   target, attacker, army_size) = FIXED.unpack_from(data, HEADER.size)
+  offset = HEADER.size + FIXED.size
+
+  typed_ids = []
+  players = {}
+  for seat in range(seat_count):
+    if data[offset] == 0:
+      typed_id = struct.unpack_from("<Q", data, offset + 1)[0]
+      offset += 9
+    else:
+      length = data[offset + 1]
+      typed_id = data[offset+2:offset+2+length].decode()
+      offset += 2 + length
+    turn_number, colour, deployable_troops, territory_count = struct.unpack_from("<BBIB", data, offset)
+    offset += 7
+    owned = [territory_names[i] for i in data[offset:offset+territory_count]]
+    offset += territory_count
+    card_count = data[offset]
+    offset += 1
+    if card_count == NOBODY:
+      cards = None
+    else:
+      cards = decode_cards(data[offset:offset+card_count])
+      offset += card_count
+    typed_ids.append(typed_id)
+    players[str(typed_id)] = {"turn_number":turn_number, "colour":COLOURS[colour], "territories":owned, "cards":cards,
+                              "deployable_troops":deployable_troops}
+
+  seat_ids = list(players)
+  turn_order = [typed_ids[seat] for seat in data[offset:offset+seat_count]]
+  offset += seat_count
+  eliminated_players = list(data[offset+1:offset+1+data[offset]])
+  offset += 1 + data[offset]
+  owners = data[offset:offset+len(territory_names)]
+  offset += len(territory_names)
+  troops = array.array("I")
+  troops.frombytes(data[offset:offset+4*len(territory_names)])
+  if sys.byteorder == "big": troops.byteswap()
+  offset += 4 * len(territory_names)
+  territories = Territories(board, [None if owner == NOBODY else seat_ids[owner] for owner in owners], troops)
+  piles = []
+  for pile in range(2):
+    length = struct.unpack_from("<H", data, offset)[0]
+    piles.append(decode_cards(data[offset+2:offset+2+length]))
+    offset += 2 + length
+
+  game = {"players":players, "territories":territories, "deck":piles[0], "discard_pile":piles[1], "turn_order":turn_order,
+          "active_player":active_player, "eliminated_players":eliminated_players, "turn_stage":turn_stage,
+          "in_pregame":bool(flags & IN_PREGAME), "unclaimed_territories":unclaimed_territories,
+          "last_attack":[territory_names[target], territory_names[attacker], army_size] if flags & HAS_LAST_ATTACK else None,
+          "card_claimed":bool(flags & CARD_CLAIMED), "trade_count":trade_count, "path_fortify":bool(flags & PATH_FORTIFY)}
+  if flags & HAS_LOG:
+    game["log"] = log_id
+    game["event_count"] = event_count
+  if flags & HAS_INDEX:
+    game["index"] = game_id
+  if flags & HAS_AUTO_TRADES:
+    game["auto_trades"] = []
+    for trade in range(data[offset]):
+      new_troops, bonus_territory = struct.unpack_from("<HB", data, offset + 1 + 3*trade)
+      game["auto_trades"].append([new_troops, None if bonus_territory == NOBODY else territory_names[bonus_territory]])
+    offset += 1 + 3 * data[offset]
+
+  length = struct.unpack_from("<I", data, offset)[0]
+  if length:
+    game.update(json.loads(data[offset+4:offset+4+length]))
+  return game
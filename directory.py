@@ -0,0 +1,63 @@
+import asyncio
+import heapq
+
+#Keeps track of which game every user is in and which game ids are free, so that routing a command to its game and
+#starting a new game never have to go through the store. It's loaded from the store once, at startup, and from then on
+#every change to a user's current game goes through assign() as well as the user's record in the store.
+class Directory:
+
+  def __init__(self):
+    self.lock = asyncio.Lock()
+    self.clear()
+
+  def clear(self):
+    self.loaded = False
+    self.user_games = {}
+    self.members = {} #game id -> how many users are in it; a game is live as long as it has anyone in it
+    self.free_ids = [] #A heap, so the smallest free id gets reused first, same as before.
+    self.next_id = 0
+
+  async def load(self, store):
+    async with self.lock:
+      if self.loaded: return
+      game_ids = set(await store.game_ids())
+      self.user_games = {user_id:user["current_game_id"] for user_id, user in (await store.all_users()).items()
+                         if user and user["current_game_id"] is not None}
+      self.members = {}
+      for game_id in self.user_games.values():
+        self.members[game_id] = self.members.get(game_id, 0) + 1
+      self.next_id = max(game_ids) + 1 if game_ids else 0
+      self.free_ids = [game_id for game_id in range(0, self.next_id) if game_id not in game_ids]
+      heapq.heapify(self.free_ids)
+      self.loaded = True
+
+  def game_of(self, user_id):
+    return self.user_games.get(user_id)
+
+  #Moves a user into a game, or out of whatever game they were in if game_id is None.
+  def assign(self, user_id, game_id):
+    old_game_id = self.user_games.pop(user_id, None)
+    if old_game_id is not None:
+      self.members[old_game_id] -= 1
+      if not self.members[old_game_id]: del self.members[old_game_id]
+    if game_id is not None:
+      self.user_games[user_id] = game_id
+      self.members[game_id] = self.members.get(game_id, 0) + 1
+
+  def is_live(self, game_id):
+    return game_id in self.members
+
+  #How many games have people in them.
+  def live_games(self):
+    return len(self.members)
+
+  #Hands out an id for a new game.
+  def allocate(self):
+    if self.free_ids:
+      return heapq.heappop(self.free_ids)
+    self.next_id += 1
+    return self.next_id - 1
+
+  #Makes a finished game's id available again. Only call this once the game has actually been deleted from the store.
+  def release(self, game_id):
+    heapq.heappush(self.free_ids, game_id)
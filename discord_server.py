@@ -0,0 +1,86 @@
+#A local stand-in for the bit of Discord's HTTP API that sends messages, for seeing how the bot's outbox copes with rate
+#limits without a real bot account (see loadtest.py --discord).
+#Start it with 'python discord_server.py [port]', then point discord.py at it with
+#discord.http.Route.BASE = "http://localhost:8082/api/v7". It takes any token, stores nothing but counts, and answers
+#GET /stats with how many messages, files and file bytes each channel got and how many requests it turned away.
+#Each channel gets RATE_LIMIT messages every RATE_PERIOD seconds, with the same rate limit headers Discord sends and a
+#429 for anything over. LATENCY_MS adds a delay to every request, like the trip to Discord would.
+from aiohttp import web
+from collections import defaultdict, deque
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+
+RATE_LIMIT = int(os.environ.get("RATE_LIMIT", 5))
+RATE_PERIOD = float(os.environ.get("RATE_PERIOD", 5))
+latency = float(os.environ.get("LATENCY_MS", 0)) / 1000
+
+BOT = {"id":"1", "username":"Risk Bot", "discriminator":"0001", "avatar":None, "bot":True}
+
+message_ids = itertools.count(1)
+sent = defaultdict(deque) #channel id -> when its recent messages were sent
+stats = {"channels":defaultdict(lambda: {"messages":0, "files":0, "file_bytes":0}), "rate_limited":0}
+
+#discord.py only takes a reply as JSON if its content type is exactly application/json, with no charset.
+def reply(data, status=200, headers={}):
+  return web.Response(body=json.dumps(data).encode(), status=status, headers={**headers, "Content-Type":"application/json"})
+
+async def slow_down():
+  if latency: await asyncio.sleep(latency)
+
+async def get_me(request):
+  await slow_down()
+  return reply(BOT)
+
+async def create_message(request):
+  await slow_down()
+  channel_id = request.match_info["channel_id"]
+  now = time.monotonic()
+  recent = sent[channel_id]
+  while recent and recent[0] <= now - RATE_PERIOD:
+    recent.popleft()
+  reset_after = recent[0] + RATE_PERIOD - now if recent else RATE_PERIOD
+  headers = {"X-RateLimit-Limit":str(RATE_LIMIT), "X-RateLimit-Bucket":f"channel-{channel_id}",
+             "X-RateLimit-Reset":f"{time.time() + reset_after:.3f}", "X-RateLimit-Reset-After":f"{reset_after:.3f}",
+             "Via":"1.1 google"} #discord.py only retries 429s that came through Discord's proxy
+  if len(recent) >= RATE_LIMIT:
+    stats["rate_limited"] += 1
+    headers["X-RateLimit-Remaining"] = "0"
+    return reply({"message":"You are being rate limited.", "retry_after":reset_after * 1000, "global":False},
+                 status=429, headers=headers)
+  recent.append(now)
+  headers["X-RateLimit-Remaining"] = str(RATE_LIMIT - len(recent))
+
+  counts = stats["channels"][channel_id]
+  if request.content_type.startswith("multipart/"):
+    form = await request.post()
+    payload = json.loads(form.get("payload_json", "{}"))
+    for field in form.values():
+      if isinstance(field, web.FileField):
+        counts["files"] += 1
+        counts["file_bytes"] += len(field.file.read())
+  else:
+    payload = await request.json()
+  counts["messages"] += 1
+
+  return reply({"id":str(next(message_ids)), "channel_id":channel_id, "type":0, "author":BOT,
+                "content":payload.get("content") or "", "timestamp":datetime.datetime.now().isoformat(),
+                "edited_timestamp":None, "tts":False, "mention_everyone":False, "mentions":[], "mention_roles":[],
+                "attachments":[], "embeds":[], "pinned":False}, headers=headers)
+
+async def get_stats(request):
+  return reply(stats)
+
+def make_app():
+  app = web.Application()
+  app.add_routes([web.get("/api/v7/users/@me", get_me),
+                  web.post("/api/v7/channels/{channel_id}/messages", create_message),
+                  web.get("/stats", get_stats)])
+  return app
+
+if __name__ == "__main__":
+  web.run_app(make_app(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8082)
@@ -1,85 +1,252 @@
 from PIL import Image, ImageDraw
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from threading import Lock
+from rules import board
+from tracing import traced
+import metrics
+import asyncio
+import atexit
+import time
 import io
+import os
 
-points = {
-"Alaska":(44, 94),
-"North West Territory":(125, 86),
-"Greenland":(268, 59),
-"Alberta":(112, 136),
-"Ontario":(155, 122),
-"Quebec":(206, 151),
-"Western United States":(109, 199),
-"Eastern United States":(195, 188),
-"Central America":(135, 253),
-"Venezuela":(170, 288),
-"Peru":(172, 371),
-"Brazil":(243, 375),
-"Argentina":(190, 457),
-"Iceland":(329, 114),
-"Scandinavia":(393, 122),
-"Ukraine":(457, 164),
-"Great Britain":(326, 179),
-"Northern Europe":(371, 194),
-"Western Europe":(340, 260),
-"Southern Europe":(380, 234),
-"North Africa":(359, 316),
-"Egypt":(425, 326),
-"East Africa":(452, 351),
-"Congo":(431, 421),
-"South Africa":(429, 498),
-"Madagascar":(493, 475),
-"Ural":(553, 145),
-"Siberia":(597, 101),
-"Yakutsk":(644, 77),
-"Kamchatka":(702, 82),
-"Irkutsk":(635, 145),
-"Mongolia":(648, 197),
-"Japan":(723, 207),
-"Afghanistan":(536, 214),
-"China":(644, 252),
-"Middle East":(489, 305),
-"India":(583, 302),
-"Siam":(661, 317),
-"Indonesia":(656, 414),
-"New Guinea":(733, 392),
-"Western Australia":(689, 452),
-"Eastern Australia":(762, 485)}
-
-def draw_map(game):
-  with Image.open("map.jpg") as im:
-  
-    draw = ImageDraw.Draw(im)
-
-    territories = game["territories"]
-
-    for name in territories.keys():
-      point = points[name]
-      point_box = (point[0]-7, point[1]-7, point[0]+7, point[1]+7)
-      
-      owner = str(territories[name]["owner"])
-      if owner != "None":
-        colour = game["players"][owner]["colour"]
-        if colour == "red":
-          colour = (200, 0, 0)
-        elif colour == "blue":
-          colour = (0, 0, 128)
-        elif colour == "yellow":
-          colour = (255, 245, 0)
-        elif colour == "green":
-          colour = (0, 128, 0)
-        elif colour == "brown":
-          colour = (110, 38, 10)
-        elif colour == "black":
-          colour = (0, 0, 0)
-      else:
-        colour = (128, 128, 128)
-      
-      draw.ellipse(point_box, fill=colour)
-      troop_count = territories[name]["troops"]
-      draw.text((point_box[0] + 2 + (0 if troop_count > 9 else 3), point_box[1] + 2), str(troop_count), font=draw.getfont(), fill=((0, 0, 0) if colour == (255, 245, 0) else (255, 255, 255)))
-
-    byte_arr = io.BytesIO()
-    im.save(byte_arr, format="JPEG")
-    byte_arr.seek(0)
-
-    return byte_arr
\ No newline at end of file
+#Where each territory's marker goes on the map.
+points = board.points
+
+#The base map is decoded once and kept around as a pristine template; every render works on a copy of it.
+#Render workers in other processes don't decode it themselves, they map the pixels the main process put in shared memory.
+base_map = None
+shared_base_map = None
+
+def load_base_map():
+  global base_map
+  build_atlas()
+  if base_map is None:
+    with Image.open(board.image) as file:
+      base_map = file.convert("RGBX")
+  return base_map
+
+def attach_base_map(name, size):
+  global base_map, shared_base_map
+  shared_base_map = shared_memory.SharedMemory(name=name)
+  base_map = Image.frombuffer("RGBX", size, shared_base_map.buf, "raw", "RGBX", 0, 1)
+  build_atlas()
+
+#Encoded maps are remembered per game (and per size, see below), along with the fingerprint of the game state they were
+#drawn from. The oldest ones get dropped once there are more than MAX_CACHED_MAPS of them.
+MAX_CACHED_MAPS = 256
+cached_maps = OrderedDict()
+
+#Each game also keeps its own canvas with the markers from its last render still on it, so the next render only has to
+#repaint the territories that changed. Canvases are a lot bigger than encoded maps, hence the separate (smaller) limit.
+MAX_CANVASES = 48
+canvases = OrderedDict()
+
+#Renders can happen on several threads at once, so the two caches above are only touched while holding this.
+cache_lock = Lock()
+
+#Everything that shows up on the map: the colour and troop count of each territory.
+def map_fingerprint(game):
+  fingerprint = []
+  for territory in game["territories"].values():
+    owner = str(territory["owner"])
+    colour = game["players"][owner]["colour"] if owner != "None" else None
+    fingerprint.append((colour, territory["troops"]))
+  return tuple(fingerprint)
+
+#The colours players (and unclaimed territories) show up as on the map.
+COLOURS = {"red":(200, 0, 0),
+           "blue":(0, 0, 128),
+           "yellow":(255, 245, 0),
+           "green":(0, 128, 0),
+           "brown":(110, 38, 10),
+           "black":(0, 0, 0),
+           None:(128, 128, 128)}
+
+#Draws a single marker (a circle in the territory's colour with the troop count on top) onto its own transparent tile.
+#The tile's top left corner goes 7 pixels up and left of the territory's point; big troop counts make it wider than the circle.
+def make_sprite(colour, troop_count):
+  colour = COLOURS[colour]
+  text_position = (2 + (0 if troop_count > 9 else 3), 2)
+  font = ImageDraw.Draw(Image.new("RGBA", (1, 1))).getfont()
+  text_box = font.getbbox(str(troop_count))
+  size = (max(15, text_position[0] + text_box[2] + 1), max(15, text_position[1] + text_box[3] + 1))
+
+  sprite = Image.new("RGBA", size, (0, 0, 0, 0))
+  draw = ImageDraw.Draw(sprite)
+  draw.ellipse((0, 0, 14, 14), fill=colour)
+  draw.text(text_position, str(troop_count), font=font, fill=((0, 0, 0) if colour == (255, 245, 0) else (255, 255, 255)))
+  return sprite
+
+#Every marker with up to ATLAS_MAX_TROOPS troops is drawn once at startup. Anything bigger is drawn the first time it's needed
+#and kept around in an LRU cache, since those only turn up late in long games.
+ATLAS_MAX_TROOPS = 99
+atlas = {}
+
+def build_atlas():
+  if not atlas:
+    for colour in COLOURS.keys():
+      for troop_count in range(0, ATLAS_MAX_TROOPS+1):
+        atlas[(colour, troop_count)] = make_sprite(colour, troop_count)
+
+@lru_cache(maxsize=512)
+def make_large_sprite(colour, troop_count):
+  return make_sprite(colour, troop_count)
+
+def get_sprite(colour, troop_count):
+  try: return atlas[(colour, troop_count)]
+  except KeyError: return make_large_sprite(colour, troop_count)
+
+#The area of the map covered by a territory's marker.
+def marker_box(point, sprite):
+  return (point[0]-7, point[1]-7, point[0]-7+sprite.width, point[1]-7+sprite.height)
+
+#How maps get encoded before being uploaded. MAP_FORMAT is "jpeg", "png" (a quantised palette PNG) or "webp".
+#MAP_SCALE shrinks every map, THUMBNAIL_SCALE shrinks the ones sent mid-turn (after attacks and deployments),
+#MAP_QUALITY is used by JPEG and WebP, and PALETTE_COLOURS is the size of the PNG palette.
+MAP_FORMAT = os.environ.get("MAP_FORMAT", "jpeg").lower()
+MAP_QUALITY = int(os.environ.get("MAP_QUALITY", 75))
+MAP_SCALE = float(os.environ.get("MAP_SCALE", 1))
+THUMBNAIL_SCALE = float(os.environ.get("THUMBNAIL_SCALE", 0.6))
+PALETTE_COLOURS = int(os.environ.get("PALETTE_COLOURS", 64))
+
+EXTENSIONS = {"jpeg":"jpg", "png":"png", "webp":"webp"}
+
+def map_filename():
+  return "map." + EXTENSIONS[MAP_FORMAT]
+
+def encode_map(im, thumbnail=False, format=None, quality=None, scale=None):
+  format = format or MAP_FORMAT
+  quality = quality or MAP_QUALITY
+  scale = scale or (THUMBNAIL_SCALE if thumbnail else MAP_SCALE)
+
+  if scale != 1:
+    im = im.resize((round(im.width*scale), round(im.height*scale)), Image.BOX)
+
+  byte_arr = io.BytesIO()
+  if format == "png":
+    im.quantize(colors=PALETTE_COLOURS, method=Image.Quantize.FASTOCTREE).save(byte_arr, format="PNG")
+  elif format == "webp":
+    im.save(byte_arr, format="WEBP", quality=quality)
+  else:
+    im.save(byte_arr, format="JPEG", quality=quality)
+  return byte_arr.getvalue()
+
+#Draws the markers described by the fingerprint and returns the encoded map. This is the part that runs on the render pool,
+#so it only gets plain tuples to work with rather than the game itself.
+def render(game_id, names, fingerprint, thumbnail=False):
+  base = load_base_map()
+
+  #Picking up where the last render of this game left off, or starting over from a blank map. The canvas is taken out
+  #of the cache while we draw on it, so a second render of the same game running alongside this one just starts over.
+  with cache_lock:
+    im, drawn_fingerprint = canvases.pop(game_id, (None, None))
+  if im is None:
+    im, drawn_fingerprint = base.convert("RGB"), (None,)*len(names)
+
+  #Only the markers that changed get wiped (by pasting that patch of the clean map back over them) and redrawn.
+  for name, (colour, troop_count), drawn in zip(names, fingerprint, drawn_fingerprint):
+    if drawn == (colour, troop_count):
+      continue
+    point = points[name]
+    if drawn is not None:
+      box = marker_box(point, get_sprite(*drawn))
+      im.paste(base.crop(box), box[:2])
+    sprite = get_sprite(colour, troop_count)
+    im.paste(sprite, marker_box(point, sprite)[:2], sprite)
+
+  encoded = encode_map(im, thumbnail)
+
+  if game_id is not None:
+    with cache_lock:
+      canvases[game_id] = (im, fingerprint)
+      while len(canvases) > MAX_CANVASES:
+        canvases.popitem(last=False)
+
+  return encoded
+
+def get_cached_map(key, fingerprint):
+  with cache_lock:
+    if key in cached_maps:
+      cached_fingerprint, encoded = cached_maps[key]
+      if cached_fingerprint == fingerprint:
+        cached_maps.move_to_end(key)
+        return encoded
+  return None
+
+def cache_map(key, fingerprint, encoded):
+  if key[0] is None:
+    return
+  with cache_lock:
+    cached_maps[key] = (fingerprint, encoded)
+    cached_maps.move_to_end(key)
+    while len(cached_maps) > MAX_CACHED_MAPS:
+      cached_maps.popitem(last=False)
+
+def draw_map(game, thumbnail=False):
+  game_id = game.get("index")
+  fingerprint = map_fingerprint(game)
+
+  encoded = get_cached_map((game_id, thumbnail), fingerprint)
+  if encoded is None:
+    encoded = render(game_id, list(game["territories"].keys()), fingerprint, thumbnail)
+    cache_map((game_id, thumbnail), fingerprint, encoded)
+
+  return io.BytesIO(encoded)
+
+
+#The render pool. RENDER_POOL picks "thread" or "process" workers (or "none" to render right on the event loop),
+#RENDER_WORKERS picks how many.
+render_pool = None
+
+def start_render_pool(kind=None, workers=None):
+  global render_pool, shared_base_map
+  kind = kind or os.environ.get("RENDER_POOL", "thread")
+  workers = workers or int(os.environ.get("RENDER_WORKERS", 2))
+  base = load_base_map()
+
+  if kind == "thread":
+    render_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+  elif kind == "process":
+    pixels = base.tobytes()
+    shared_base_map = shared_memory.SharedMemory(create=True, size=len(pixels))
+    shared_base_map.buf[:len(pixels)] = pixels
+    atexit.register(stop_render_pool)
+    render_pool = ProcessPoolExecutor(max_workers=workers, initializer=attach_base_map, initargs=(shared_base_map.name, base.size))
+
+def stop_render_pool():
+  global render_pool, shared_base_map
+  if render_pool:
+    render_pool.shutdown()
+    render_pool = None
+  if shared_base_map:
+    shared_base_map.close()
+    shared_base_map.unlink()
+    shared_base_map = None
+
+#The event-loop-friendly version of draw_map. The fingerprint is taken here, before anything is awaited, so the game can
+#carry on changing while its map is being drawn.
+@traced("render")
+async def render_map(game, thumbnail=False):
+  start = time.perf_counter()
+  game_id = game.get("index")
+  fingerprint = map_fingerprint(game)
+
+  encoded = get_cached_map((game_id, thumbnail), fingerprint)
+  cached = encoded is not None
+  if not cached:
+    names = list(game["territories"].keys())
+    if render_pool:
+      encoded = await asyncio.get_running_loop().run_in_executor(render_pool, render, game_id, names, fingerprint, thumbnail)
+    else:
+      encoded = render(game_id, names, fingerprint, thumbnail)
+    cache_map((game_id, thumbnail), fingerprint, encoded)
+    metrics.observe("risk_render_bytes", len(encoded), metrics.BYTE_BUCKETS)
+
+  seconds = time.perf_counter() - start
+  metrics.record("render", seconds)
+  metrics.observe("risk_render_seconds", seconds, cached="yes" if cached else "no")
+  return io.BytesIO(encoded)
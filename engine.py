@@ -0,0 +1,562 @@
+#The rules of the game, with no Discord and no database in sight. Every action takes a game dict and the id of the player
+#doing it, checks that it's allowed, changes the game and returns a result describing what happened. Anything that isn't
+#allowed raises a RuleError carrying the message to show the player, and leaves the game untouched.
+#Player ids are strings here, like the keys of game["players"]; turn_order keeps them as they were given to create_game.
+from collections import namedtuple
+from boards import Territories
+from rules import board, territory_names, is_adjacent, mask_of, names_of, new_troops_for, component_of, territory_index, neighbours
+import itertools
+import random
+
+COLOURS = ("red", "blue", "yellow", "green", "brown", "black")
+DIE_FACES = range(1, 7)
+BLITZ_BATCH = 16
+
+#A message can be addressed to the player it's for, by naming them as {player}: main.py fills in a mention of them,
+#while str() (for logs, and AIs) just gives their id.
+class RuleError(Exception):
+
+  def __init__(self, message, player_id=None):
+    super().__init__(message)
+    self.message = message
+    self.player_id = player_id
+
+  def addressed_to(self, name):
+    return self.message.replace("{player}", str(name))
+
+  def __str__(self):
+    return self.addressed_to(self.player_id)
+
+DeployResult = namedtuple("DeployResult", "troops territory next_player_id all_deployed")
+AttackResult = namedtuple("AttackResult", ["target", "attacker", "army_size", "adjusted", "off_dice", "def_dice", "off_dead", "def_dead",
+                                           "off_troops", "def_troops", "conquered", "eliminated_player_id", "victory",
+                                           "moved_troops", "extra_troops", "card_gained", "army_too_small"])
+Conquest = namedtuple("Conquest", "eliminated_player_id victory moved_troops extra_troops card_gained")
+NO_CONQUEST = Conquest(None, False, 0, 0, False)
+BlitzResult = namedtuple("BlitzResult", ["target", "attacker", "until", "rounds", "off_troops", "def_troops", "off_dead", "def_dead",
+                                         "conquered", "eliminated_player_id", "victory", "moved_troops", "extra_troops",
+                                         "card_gained"])
+MoveResult = namedtuple("MoveResult", "territory troops territory_troops next_player_id")
+TradeResult = namedtuple("TradeResult", "cards new_troops deployable_troops bonus_territory")
+ResignResult = namedtuple("ResignResult", "winner_id next_player_id")
+
+
+#Creates and returns a dictionary with game data. The players list is shuffled in place into the turn order.
+#With path_fortify, the end-of-turn move can go anywhere connected to its start through the player's own territories,
+#not just next door.
+def create_game(players, randomfill=False, path_fortify=False, rng=random):
+
+  game = {}
+
+  #Initializing players
+  deployable_troops = 0 if randomfill else (40, 35, 30, 25, 20)[len(players)-2]
+  rng.shuffle(players)
+  game["players"] = {str(player_id):{"turn_number":i+1,
+                                "colour":COLOURS[i],
+                                "territories":[],
+                                "cards":[],
+                                "deployable_troops":deployable_troops}
+                     for i, player_id in enumerate(players)}
+
+  #Initializing territories. The board itself is shared (see boards.py); the game only gets each territory's owner and troops.
+  game["territories"] = Territories(board)
+  if randomfill:
+    for key in game["territories"].keys():
+      lucky_player = str(rng.choice(players))
+      territory = game["territories"][key]
+      territory["owner"] = lucky_player
+      territory["troops"] = rng.randint(1, 10)
+      game["players"][lucky_player]["territories"].append(key)
+    player = game["players"][str(players[0])]
+    player["deployable_troops"] = calculate_new_troops(player)
+
+  #Initializing deck and discard pile
+  territory_symbols = list(territory_names)
+  rng.shuffle(territory_symbols)
+  game["deck"] = [(("Infantry", "Cavalry", "Artillery")[i%3], territory_symbols[i]) for i in range(len(territory_symbols))] + [("Wild", None)]*2
+  rng.shuffle(game["deck"])
+  game["discard_pile"] = []
+
+  #Other variables
+  game["turn_order"] = players.copy()
+  game["active_player"] = 1
+  game["eliminated_players"] = []
+  game["turn_stage"] = 1
+  game["in_pregame"] = False if randomfill else True
+  game["unclaimed_territories"] = 0 if randomfill else len(territory_names)
+  game["last_attack"] = None
+  game["card_claimed"] = False
+  game["trade_count"] = 0
+  game["path_fortify"] = path_fortify
+
+  return game
+
+
+#Takes a player and calculates the number of new troops he receives.
+def calculate_new_troops(player):
+  return new_troops_for(mask_of(player["territories"]))
+
+
+def active_player_id(game):
+  return str(game["turn_order"][game["active_player"]-1])
+
+
+#Ends current turn, starts next turn. Returns the id of the player whose turn it is.
+def begin_next_player_turn(game):
+
+  #Start by cycling active_player status to the next player
+  while True:
+    game["active_player"] += 1
+    if game["active_player"] > len(game["players"]):
+      game["active_player"] = 1
+    if game["active_player"] in game["eliminated_players"]:
+      continue
+    break
+
+  #Excuse this nightmare of an index
+  player_id = game["turn_order"][game["active_player"]-1]
+  player = game["players"][str(player_id)]
+
+  if game["in_pregame"]:
+    if player["deployable_troops"] == 0:
+      game["in_pregame"] = False
+    else: return player_id
+
+  player["deployable_troops"] = calculate_new_troops(player)
+  game["turn_stage"] = 1
+  game["last_attack"] = None
+  game["card_claimed"] = False
+
+  #Five cards or more have to be traded in before anything else, so that's done straight away, with the best sets going.
+  #What was traded is kept in the game for the turn's opening message.
+  game["auto_trades"] = []
+  while len(player["cards"]) >= 5:
+    result = trade_cards(game, player, select_cards(player))
+    game["auto_trades"].append((result.new_troops, result.bonus_territory))
+
+  return player_id
+
+
+def get_territory(game, name):
+  try: return game["territories"][name]
+  except KeyError: raise RuleError(f"Couldn't find the territory '{name}'.")
+
+def check_turn(game, player_id):
+  if game["active_player"] != game["players"][player_id]["turn_number"]:
+    raise RuleError("It's not your turn, {player}.", player_id)
+
+#Attacking, moving and ending your turn all have to wait until you're done deploying.
+def check_deployed(game, player_id):
+  check_turn(game, player_id)
+  if game["turn_stage"] != 2:
+    troops = game["players"][player_id]["deployable_troops"]
+    raise RuleError(f"You must first deploy all of your troops, {{player}}. You still have {troops} left.", player_id)
+
+
+#Places troops on one of the player's territories (or an unclaimed one, during setup).
+def deploy(game, player_id, location, troops=1):
+
+  player = game["players"][player_id]
+  check_turn(game, player_id)
+  #"NotYetDeploymentStageError"
+  if game["turn_stage"] == 0:
+    raise RuleError("You must trade in a set of cards, {player}. Type !trade to do so.", player_id)
+  #"DeploymentStageOverError"
+  if game["turn_stage"] == 2:
+    raise RuleError("You have no troops left to deploy, {player}.", player_id)
+  #"TooManyTroopsError"
+  if troops < 1:
+    raise RuleError("You can't deploy fewer than one troop.")
+  if game["in_pregame"] and troops > 1:
+    raise RuleError("You can't deploy more than one troop at a time until the game setup is over.")
+  if player["deployable_troops"] < troops:
+    raise RuleError("You don't have that many troops.")
+
+  territory = get_territory(game, location)
+  if str(territory["owner"]) not in ("None", player_id): #"GetOffMyPropertyError"
+    raise RuleError("Someone else owns that territory.")
+  if game["unclaimed_territories"] and territory["owner"]: #"MustClaimTerritoryError"
+    raise RuleError("You must deploy on unclaimed territories while there are territories to be claimed.")
+
+  #Error checking finally finished. Deploying troops.
+  if territory["owner"] == None:
+    territory["owner"] = player_id
+    game["unclaimed_territories"] -= 1
+    player["territories"].append(location)
+
+  territory["troops"] += troops
+  player["deployable_troops"] -= troops
+
+  #After deploying in the pregame, your turn immediately ends.
+  #Otherwise, done deploying all your troops? Right then, now you can attack.
+  next_player_id = None
+  if game["in_pregame"]:
+    next_player_id = begin_next_player_turn(game)
+  elif player["deployable_troops"] == 0:
+    game["turn_stage"] = 2
+
+  return DeployResult(troops, location, next_player_id, game["turn_stage"] == 2)
+
+
+#Rolls the dice for one round of an attack, best dice first.
+def roll_dice(army_size, def_size, rng=random):
+  off_dice = sorted((rng.randint(1, 6) for die in range(0, army_size)), reverse=True)
+  def_dice = sorted((rng.randint(1, 6) for die in range(0, def_size)), reverse=True)
+  return off_dice, def_dice
+
+#Compares the best dice of each side; ties go to the defender. Returns how many troops each side loses.
+def resolve_dice(off_dice, def_dice):
+  off_dead = 0
+  def_dead = 0
+  for off_die, def_die in zip(off_dice, def_dice):
+    if off_die > def_die: def_dead += 1
+    else: off_dead += 1
+  return off_dead, def_dead
+
+
+#Checks that the player can attack target from attacker, and returns the two territories.
+def check_attack(game, player_id, target, attacker):
+  check_deployed(game, player_id)
+  def_territory = get_territory(game, target)
+  off_territory = get_territory(game, attacker)
+  if off_territory["owner"] != player_id:
+    raise RuleError("You can't attack from a territory you don't own.")
+  if not is_adjacent(attacker, target):
+    raise RuleError("Those territories are not adjacent.")
+  if def_territory["owner"] == player_id:
+    raise RuleError("You can't attack yourself.")
+  if off_territory["troops"] == 1:
+    raise RuleError("You can't attack with one troop; doing so would leave your territory undefended.")
+  return off_territory, def_territory
+
+#Hands a territory whose defenders have all died over to the attacker, along with moved_troops of the attacking troops.
+#Takes care of eliminating its old owner and of this turn's card.
+def take_territory(game, player_id, target, attacker, moved_troops):
+
+  player = game["players"][player_id]
+  off_territory = game["territories"][attacker]
+  def_territory = game["territories"][target]
+  eliminated_player_id = None
+  card_gained = False
+
+  conquered_player_id = def_territory["owner"]
+  conquered_player = game["players"][conquered_player_id]
+  conquered_player["territories"].remove(target)
+
+  if len(conquered_player["territories"]) == 0: #Player eliminated.
+    game["discard_pile"] += conquered_player["cards"]
+    conquered_player["cards"] = None
+    game["eliminated_players"].append(conquered_player["turn_number"])
+    eliminated_player_id = conquered_player_id
+
+  extra_troops = off_territory["troops"] - 1 - moved_troops
+  def_territory["owner"] = player_id
+  def_territory["troops"] = moved_troops
+  off_territory["troops"] -= moved_troops
+
+  player["territories"].append(target)
+  victory = len(player["territories"]) == len(territory_names)
+
+  if not victory:
+    if extra_troops == 0:
+      game["last_attack"] = None
+    if not game["card_claimed"]:
+      player["cards"].append(game["deck"].pop())
+      game["card_claimed"] = True
+      card_gained = True
+
+  return Conquest(eliminated_player_id, victory, moved_troops, extra_troops, card_gained)
+
+
+#One round of dice between two territories. If the defenders are wiped out, the attacker takes the territory, moving in as
+#many troops as survived the roll; the rest can be brought along afterwards with conquer_move.
+def attack(game, player_id, target, attacker, army_size=3, rng=random):
+
+  off_territory, def_territory = check_attack(game, player_id, target, attacker)
+
+  off_troops = off_territory["troops"]
+  def_troops = def_territory["troops"]
+
+  #Automatically adjusting army size if necessary
+  adjusted = False
+  if army_size > 3:
+    army_size = 3
+    adjusted = True
+  if off_troops <= army_size:
+    army_size = off_troops - 1
+    adjusted = True
+
+  #Calling defenders to arms
+  def_size = 2 if def_troops > 1 else 1
+  off_dice, def_dice = roll_dice(army_size, def_size, rng)
+  off_dead, def_dead = resolve_dice(off_dice, def_dice)
+
+  off_territory["troops"] -= off_dead
+  def_territory["troops"] -= def_dead
+  game["last_attack"] = (target, attacker, army_size)
+
+  conquered = def_territory["troops"] == 0
+  conquest = take_territory(game, player_id, target, attacker, army_size - off_dead) if conquered else NO_CONQUEST
+
+  return AttackResult(target, attacker, army_size, adjusted, off_dice, def_dice, off_dead, def_dead, off_troops, def_troops,
+                      conquered, *conquest, not conquered and off_territory["troops"] == 1)
+
+
+#Keeps attacking target from attacker until it falls or the attackers are down to until troops, all in one go.
+#Every round throws at most five dice, so the dice are drawn up front in batches of BLITZ_BATCH rounds and the rounds just
+#walk through them. Every round also kills at least one troop, which caps how many rounds a batch ever needs to cover.
+def blitz(game, player_id, target, attacker, until=1, rng=random):
+
+  off_territory, def_territory = check_attack(game, player_id, target, attacker)
+  off_troops = off_territory["troops"]
+  def_troops = def_territory["troops"]
+  if until < 1:
+    raise RuleError("You can't fight down to fewer than one troop; someone has to stay behind.")
+  if off_troops <= until:
+    raise RuleError(f"{attacker} only has {off_troops} troops, so there's nothing to blitz with.")
+
+  off_left, def_left = off_troops, def_troops
+  rounds = 0
+  dice = []
+  i = 0
+  while def_left and off_left > until:
+    if i == len(dice):
+      dice = rng.choices(DIE_FACES, k=min(BLITZ_BATCH, off_left - until + def_left - 1)*5)
+      i = 0
+    #Never more dice than troops above the threshold, so the last round can't take the attackers below it.
+    army_size = min(3, off_left - until)
+    def_size = 2 if def_left > 1 else 1
+    off_dice = sorted(dice[i:i+army_size], reverse=True)
+    def_dice = sorted(dice[i+3:i+3+def_size], reverse=True)
+    i += 5
+    off_dead, def_dead = resolve_dice(off_dice, def_dice)
+    off_left -= off_dead
+    def_left -= def_dead
+    rounds += 1
+
+  off_territory["troops"] = off_left
+  def_territory["troops"] = def_left
+  game["last_attack"] = (target, attacker, 3)
+
+  conquered = def_left == 0
+  conquest = take_territory(game, player_id, target, attacker, army_size - off_dead) if conquered else NO_CONQUEST
+
+  return BlitzResult(target, attacker, until, rounds, off_troops, def_troops, off_troops - off_left, def_troops - def_left,
+                     conquered, *conquest)
+
+
+#Moves more troops into the territory that was just conquered: all of them but one, unless told otherwise.
+def conquer_move(game, player_id, troops=None):
+
+  check_deployed(game, player_id)
+  if not game["last_attack"]:
+    raise RuleError("There's no freshly conquered territory to move troops into.")
+
+  target, attacker, _ = game["last_attack"]
+  target_territory = game["territories"][target]
+  attacker_territory = game["territories"][attacker]
+
+  if target_territory["owner"] != attacker_territory["owner"]:
+    raise RuleError("You haven't conquered the territory yet.")
+  if troops is None:
+    troops = attacker_territory["troops"] - 1
+  elif troops < 1:
+    raise RuleError("You have to move at least one troop.")
+  elif attacker_territory["troops"] <= troops:
+    raise RuleError("You're trying to move too many troops; one troop must always stay behind.")
+
+  attacker_territory["troops"] -= troops
+  target_territory["troops"] += troops
+  game["last_attack"] = None
+
+  return MoveResult(target, troops, target_territory["troops"], None)
+
+
+#The end-of-turn troop movement between two adjacent territories. Ends the turn.
+def fortify(game, player_id, troops, start, destination):
+
+  check_deployed(game, player_id)
+
+  #Checking that the move is legal
+  territory_a = get_territory(game, start)
+  territory_b = get_territory(game, destination)
+  if territory_a["owner"] != player_id:
+    raise RuleError(f"You don't own {start}.")
+  elif territory_b["owner"] != player_id:
+    raise RuleError(f"You don't own {destination}.")
+  if game.get("path_fortify"):
+    if not component_of(mask_of(game["players"][player_id]["territories"]), start) >> territory_index[destination] & 1:
+      raise RuleError(f"You can't get from {start} to {destination} through territories you own.")
+  elif not is_adjacent(start, destination):
+    raise RuleError("Those territories are not adjacent.")
+  if troops < 1:
+    raise RuleError("You have to move at least one troop.")
+  if troops >= territory_a["troops"]:
+    raise RuleError("You're trying to move too many troops: at least one troop must always stay behind.")
+
+  territory_a["troops"] -= troops
+  territory_b["troops"] += troops
+
+  return MoveResult(destination, troops, territory_b["troops"], begin_next_player_turn(game))
+
+
+#Where the player could move troops to from start at the end of their turn.
+def fortify_destinations(game, player_id, start):
+  if get_territory(game, start)["owner"] != player_id:
+    raise RuleError(f"You don't own {start}.")
+  if game.get("path_fortify"):
+    return [name for name in names_of(component_of(mask_of(game["players"][player_id]["territories"]), start)) if name != start]
+  return [name for name in neighbours[start] if game["territories"][name]["owner"] == player_id]
+
+
+def check_set_legality(cards_to_be_checked):
+  legal = False
+  if len(cards_to_be_checked) == 3:
+    L = [card[0] for card in cards_to_be_checked]
+    L, wild = (L.count("Infantry"), L.count("Cavalry"), L.count("Artillery")), L.count("Wild")
+    if wild or L.count(2) == 0: legal = True
+  return legal
+
+#For picking sets, a card only matters for its type and, if it's a territory card, whether it's a bonus card (one marked
+#with a territory its owner holds). That makes seven kinds of card, and every legal set is one of a few dozen mixes of
+#kinds, whose scores don't depend on the hand at all. So the mixes are scored once, up front, and picking a set is just
+#finding the best-scoring mix the hand can make, however many cards are in it.
+def card_kind(card, owned):
+  return ("Wild", False) if card[0] == "Wild" else (card[0], card[1] in owned)
+
+def set_score(kinds):
+
+  #The criteria for the best set? 1. Set has a bonus card. 2. Set has a low number of wild cards. 3. Set has a low number of bonus cards.
+  score = 0
+  wilds = sum(1 for kind in kinds if kind[0] == "Wild")
+  bonuses = sum(1 for kind in kinds if kind[0] != "Wild" and kind[1])
+  if bonuses: score += 3
+  if wilds:
+    if wilds == 1: score += 1
+  else: score += 2
+  if score == 5: score += 3 - bonuses
+  return score
+
+def kinds_are_legal(kinds):
+  types = set(kind[0] for kind in kinds)
+  return "Wild" in types or len(types) != 2
+
+CARD_KINDS = [("Wild", False)] + [(card_type, bonus) for card_type in ("Infantry", "Cavalry", "Artillery") for bonus in (True, False)]
+
+#Every legal mix of kinds, best first, as {kind: how many of it}.
+SET_MIXES = [{kind:kinds.count(kind) for kind in kinds}
+             for kinds in sorted((kinds for kinds in itertools.combinations_with_replacement(CARD_KINDS, 3) if kinds_are_legal(kinds)),
+                                 key=set_score, reverse=True)]
+
+#Completes a set from the player's cards, given the positions (counting from 0) of the ones they picked themselves.
+#Returns the positions of the whole set, or None if there's no legal set.
+def select_cards(player, selected=()):
+
+  owned = set(player["territories"])
+  selected = list(selected)
+  selected_kinds = {}
+  for i in selected:
+    kind = card_kind(player["cards"][i], owned)
+    selected_kinds[kind] = selected_kinds.get(kind, 0) + 1
+  by_kind = {}
+  for i, card in enumerate(player["cards"]):
+    if i not in selected:
+      by_kind.setdefault(card_kind(card, owned), []).append(i)
+
+  for mix in SET_MIXES:
+    if any(mix.get(kind, 0) < n for kind, n in selected_kinds.items()): continue
+    if any(n - selected_kinds.get(kind, 0) > len(by_kind.get(kind, ())) for kind, n in mix.items()): continue
+    return selected + [i for kind, n in mix.items() for i in by_kind.get(kind, [])[:n - selected_kinds.get(kind, 0)]]
+  return None
+
+
+#Trades in a set of cards for troops. card_numbers are the cards the player picked (counting from 1); any not picked are
+#chosen automatically.
+def trade(game, player_id, card_numbers=()):
+
+  check_turn(game, player_id)
+  if game["turn_stage"] == 2:
+    raise RuleError("You've deployed all your troops and therefore can no longer trade, {player}.", player_id)
+
+  player = game["players"][player_id]
+  cards = player["cards"]
+
+  if len(cards) < 3:
+    raise RuleError("You don't have enough cards to trade, {player}.", player_id)
+  if len(card_numbers) > 3: #TooManyArgumentsError
+    raise RuleError("There are only three cards to a set. Why are you trying to trade in four?")
+  if len(set(card_numbers)) != len(card_numbers):
+    raise RuleError("You can't trade in the same card twice.")
+
+  selected = []
+  for number in card_numbers:
+    if number < 1 or number > len(cards):
+      if 0 < number < 21:
+        raise RuleError(f"You don't have a {number}th card, mate.")
+      raise RuleError(f"Don't be absurd. No one has {number} cards.")
+    selected.append(number-1) #Legit card? Alright then.
+
+  #Legality checking and autoselecting
+  if len(selected) == 3:
+    if not check_set_legality([cards[i] for i in selected]):
+      raise RuleError("That's not a legal set of cards.")
+  else:
+    selected = select_cards(player, selected)
+    if not selected:
+      raise RuleError("You don't have a complete set to trade in, {player}.", player_id)
+
+  return trade_cards(game, player, selected)
+
+#Swaps the cards at the given positions in the player's hand for troops. The set has to be legal already.
+def trade_cards(game, player, selected):
+
+  traded_cards = [player["cards"][i] for i in selected]
+  owned = set(player["territories"])
+  bonus_territory = next((card[1] for card in traded_cards if card[1] in owned), None)
+
+  #Removing by position, from the back so the positions don't shift under us.
+  for i in sorted(selected, reverse=True):
+    del player["cards"][i]
+  game["discard_pile"] += traded_cards
+
+  #Success! Have some troops
+  try: new_troops = (4, 6, 8, 10, 12, 15)[game["trade_count"]]
+  except IndexError: new_troops = ((game["trade_count"]-2)*5) #20, 25, 30...
+  game["trade_count"] += 1
+  player["deployable_troops"] += new_troops
+
+  #If a bonus card was traded in, drop two bonus troops on that territory
+  if bonus_territory: game["territories"][bonus_territory]["troops"] += 2
+
+  if game["turn_stage"] == 0: game["turn_stage"] = 1
+  return TradeResult(traded_cards, new_troops, player["deployable_troops"], bonus_territory)
+
+
+#Ends the turn without moving any troops. Returns the id of the player whose turn it is now.
+def end_turn(game, player_id):
+  check_deployed(game, player_id)
+  return begin_next_player_turn(game)
+
+
+#Takes the player out of the game. If that leaves one player standing, they've won.
+def resign(game, player_id):
+
+  player = game["players"][player_id]
+  game["discard_pile"] += player["cards"]
+  player["cards"] = None
+  game["eliminated_players"].append(player["turn_number"])
+
+  if len(game["players"]) == len(game["eliminated_players"]) + 1:
+    return ResignResult(begin_next_player_turn(game), None)
+  if game["active_player"] == player["turn_number"]:
+    return ResignResult(None, begin_next_player_turn(game))
+  return ResignResult(None, None)
+
+
+#Gives a player's seat, along with everything on it, to someone else (an AI taking over from someone who's resigned).
+def hand_over(game, player_id, new_player_id):
+  game["players"] = {(new_player_id if key == player_id else key):player for key, player in game["players"].items()}
+  game["turn_order"] = [new_player_id if str(key) == player_id else key for key in game["turn_order"]]
+  for territory in game["territories"].values():
+    if territory["owner"] == player_id:
+      territory["owner"] = new_player_id
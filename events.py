@@ -0,0 +1,91 @@
+#Every change to a game is an event: a short list naming an engine action, the player doing it and its arguments, like
+#["deploy", "1234", "Siam", 3]. Events are appended to the game's log as they happen, and a game can be rebuilt by
+#replaying its log, either from the start or from a snapshot of the game taken partway through (see UnitOfWork).
+#For that to work the dice have to come out the same every time, so each event gets its own random number generator,
+#seeded with the game's log id, the event's number and (for games since it was added) DICE_SECRET. Attacks and blitzes also record how many troops each side lost,
+#which replaying checks, so a replay that's gone off the rails says so instead of quietly making up a different game.
+#Log ids are random numbers rather than game ids, since game ids get reused; a finished game's log sticks around.
+#Anyone who knew a game's log id and the secret could work out every roll to come, so neither is ever shown to players.
+from tracing import traced
+import engine
+import os
+import random
+import secrets
+
+#event kind -> the engine function it runs
+ACTIONS = {"deploy":engine.deploy,
+           "attack":engine.attack,
+           "blitz":engine.blitz,
+           "move":engine.conquer_move,
+           "fortify":engine.fortify,
+           "trade":engine.trade,
+           "endturn":engine.end_turn,
+           "resign":engine.resign,
+           "handover":engine.hand_over}
+
+#Events that roll dice, and how long they are before their outcome is added.
+OUTCOME_AT = {"attack":5, "blitz":5}
+
+class ReplayError(Exception):
+  pass
+
+#Stays the same for as long as there are games it rolled for, or they won't replay.
+DICE_SECRET = os.environ.get("DICE_SECRET", "")
+
+#Games from before DICE_SECRET aren't salted, so that their logs still replay.
+def rng_for(log_id, event_number, salted=False):
+  if salted:
+    return random.Random(f"{DICE_SECRET}:{log_id}:{event_number}")
+  return random.Random(f"{log_id}:{event_number}")
+
+#Runs an event against a game, without any bookkeeping. This is also how AIs try moves out in their rollouts.
+def run(game, event, rng=random):
+  kind = event[0]
+  arguments = event[1:OUTCOME_AT[kind]] if kind in OUTCOME_AT else event[1:]
+  if kind in OUTCOME_AT:
+    return ACTIONS[kind](game, *arguments, rng=rng)
+  return ACTIONS[kind](game, *arguments)
+
+#Makes a new game and the event that created it, which is always event 0 of its log.
+def create_game(players, randomfill=False, path_fortify=False, log_id=None, salted=True):
+  log_id = log_id or secrets.randbits(62)
+  event = ["create", list(players), randomfill, path_fortify] + ([True] if salted else [])
+  game = engine.create_game(players, randomfill, path_fortify, rng=rng_for(log_id, 0, salted))
+  game["log"] = log_id
+  game["event_count"] = 1
+  if salted: game["salted"] = True
+  return game, event
+
+#Games from before there were logs get one, starting from however they are now.
+def start_log(game):
+  if "log" not in game:
+    game["log"] = secrets.randbits(62)
+    game["event_count"] = 0
+    game["salted"] = True
+
+#Runs an event against a game as its next one. Pass the command's unit of work to have the event saved with the game;
+#replays pass None. Raises RuleError, without changing anything, if the event isn't allowed.
+@traced("state")
+def apply(work, game, event):
+  kind = event[0]
+  result = run(game, event, rng_for(game["log"], game["event_count"], game.get("salted", False)))
+
+  if kind in OUTCOME_AT:
+    outcome = [result.off_dead, result.def_dead]
+    if len(event) == OUTCOME_AT[kind]:
+      event.extend(outcome)
+    elif event[OUTCOME_AT[kind]:] != outcome:
+      raise ReplayError(f"Event {game['event_count']} of log {game['log']} came out as {outcome} instead of {event[OUTCOME_AT[kind]:]}.")
+
+  game["event_count"] += 1
+  if work: work.record(game["index"], event)
+  return result
+
+#Rebuilds a game from its whole log, stopping after event number upto if given.
+def replay(log_id, log, upto=None):
+  kind, players, randomfill, path_fortify, *salted = log[0]
+  game, event = create_game(list(players), randomfill, path_fortify, log_id, salted=bool(salted))
+  game["index"] = None
+  for event in log[1:] if upto is None else log[1:upto+1]:
+    apply(None, game, event)
+  return game
@@ -1,7 +1,8 @@
 #https://uptimerobot.com/dashboard
 
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
+import metrics
 
 app = Flask('')
 
@@ -9,9 +10,14 @@ app = Flask('')
 def home():
     return "I'm alive"
 
+#For Prometheus to scrape.
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
 def run():
   app.run(host='0.0.0.0',port=8080)
 
 def keep_alive():
     t = Thread(target=run)
-    t.start()
\ No newline at end of file
+    t.start()
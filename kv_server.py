@@ -0,0 +1,51 @@
+#A local stand-in for Replit's key-value database, for running and testing the bot without Replit.
+#Start it with 'python kv_server.py [port]' and point the bot at it with REPLIT_DB_URL=http://localhost:8081 STORAGE=replit.
+#Everything is kept in memory and lost when it stops. LATENCY_MS adds a delay to every request, to see how the bot copes
+#with a slow database.
+from aiohttp import web
+from urllib.parse import quote
+import asyncio
+import os
+import sys
+
+values = {}
+latency = float(os.environ.get("LATENCY_MS", 0)) / 1000
+
+async def slow_down():
+  if latency: await asyncio.sleep(latency)
+
+async def get_value(request):
+  await slow_down()
+  key = request.match_info["key"]
+  if key not in values:
+    raise web.HTTPNotFound()
+  return web.Response(text=values[key])
+
+async def delete_value(request):
+  await slow_down()
+  values.pop(request.match_info["key"], None)
+  return web.Response(status=204)
+
+async def set_values(request):
+  await slow_down()
+  values.update(await request.post())
+  return web.Response(status=200)
+
+async def list_keys(request):
+  await slow_down()
+  prefix = request.query.get("prefix", "")
+  keys = [key for key in values.keys() if key.startswith(prefix)]
+  if request.query.get("encode") == "true":
+    keys = [quote(key, safe="") for key in keys]
+  return web.Response(text="\n".join(keys))
+
+def make_app():
+  app = web.Application()
+  app.add_routes([web.get("/", list_keys),
+                  web.post("/", set_values),
+                  web.get("/{key}", get_value),
+                  web.delete("/{key}", delete_value)])
+  return app
+
+if __name__ == "__main__":
+  web.run_app(make_app(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
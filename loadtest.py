@@ -0,0 +1,234 @@
+#A load generator: plays lots of games at once against the bot's on_message, with stand-in users, channels and messages
+#instead of Discord, to see how many commands a second the bot keeps up with and how long players wait as games pile up.
+#Every game is three (or --players) people taking turns with random legal commands: !play randomfill, then !trade,
+#!deploy, !attack, !move and !endturn, as fast as the bot answers (or with --think-ms between commands). Players look at
+#their game through the store to pick their moves; that peeking isn't counted in the latency.
+#  python loadtest.py --games 20 --commands 200
+#  python loadtest.py --sweep 1,5,10,25,50,100    (one row per number of games, to find where it falls over)
+#Storage defaults to memory; set STORAGE (and STORAGE_PATH or REPLIT_DB_URL) to load test a real backend.
+#These players answer the moment the bot does, which would keep every channel at Discord's rate limit the whole time, so
+#the outbox's limits are off unless CHANNEL_RATE_LIMIT and GLOBAL_RATE_LIMIT are set. With --discord URL, messages go
+#through discord.py to a stand-in Discord at that address (start discord_server.py first) instead of fake channels.
+import aiohttp
+import argparse
+import asyncio
+import discord
+import engine
+import itertools
+import io
+import os
+import random
+import resource
+import time
+
+os.environ.setdefault("STORAGE", "memory")
+os.environ.setdefault("CHANNEL_RATE_LIMIT", "0")
+os.environ.setdefault("GLOBAL_RATE_LIMIT", "0")
+
+import main
+import metrics
+from display import start_render_pool, stop_render_pool
+from rules import neighbours
+from storage import UnitOfWork
+
+#Stand-ins for the bits of discord.py that on_message uses.
+class FakeUser:
+
+  def __init__(self, user_id):
+    self.id = user_id
+    self.mention = f"<@{user_id}>"
+
+  def __eq__(self, other):
+    return isinstance(other, FakeUser) and other.id == self.id
+
+  def __hash__(self):
+    return hash(self.id)
+
+#Keeps what's sent to it rather than sending it. send_latency makes every send take that long, like Discord would.
+class FakeChannel:
+
+  def __init__(self, send_latency=0):
+    self.send_latency = send_latency
+    self.id = next(channel_ids)
+    self.messages = 0
+    self.files = 0
+    self.file_bytes = 0
+
+  async def send(self, content=None, file=None, **kwargs):
+    if self.send_latency: await asyncio.sleep(self.send_latency)
+    self.messages += 1
+    if file is not None:
+      self.files += 1
+      self.file_bytes += len(file.fp.getvalue()) if isinstance(file.fp, io.BytesIO) else 0
+
+#Channels on the stand-in Discord, which counts what they get itself (see sent_counts).
+def discord_channel():
+  return discord.DMChannel(me=main.client._connection.user, state=main.client._connection,
+                           data={"id":str(next(channel_ids)), "recipients":[{"id":"2", "username":"player",
+                                                                              "discriminator":"0002", "avatar":None}]})
+
+async def connect_discord(url):
+  discord.http.Route.BASE = url.rstrip("/") + "/api/v7"
+  main.client.http.loop = asyncio.get_running_loop() #client.run would have set this; it schedules the end of rate limits
+  await main.client.http.static_login("loadtest", bot=True)
+
+#How many messages, maps and map bytes these channels got.
+async def sent_counts(channels, discord_url):
+  if not discord_url:
+    return (sum(channel.messages for channel in channels), sum(channel.files for channel in channels),
+            sum(channel.file_bytes for channel in channels))
+  async with aiohttp.ClientSession() as session:
+    async with session.get(discord_url.rstrip("/") + "/stats") as response:
+      stats = (await response.json())["channels"]
+  counts = [stats.get(str(channel.id), {"messages":0, "files":0, "file_bytes":0}) for channel in channels]
+  return tuple(sum(count[key] for count in counts) for key in ("messages", "files", "file_bytes"))
+
+class FakeMessage:
+
+  def __init__(self, author, content, channel, mentions=()):
+    self.author = author
+    self.content = content
+    self.channel = channel
+    self.mentions = list(mentions)
+
+channel_ids = itertools.count(int(time.time() * 1000)) #different every run, since the stand-in Discord keeps counting
+BOT = FakeUser(1)
+main.client._connection.user = BOT #on_message compares authors with the bot's own user, which is normally set on login.
+
+
+class Results:
+
+  def __init__(self):
+    self.latencies = {} #command -> seconds for each time it was sent
+    self.errors = 0
+    self.finished_games = 0
+
+  def add(self, command, seconds):
+    self.latencies.setdefault(command, []).append(seconds)
+
+  def all_latencies(self):
+    return [seconds for latencies in self.latencies.values() for seconds in latencies]
+
+async def say(results, author, content, channel, mentions=()):
+  start = time.perf_counter()
+  try:
+    await main.on_message(FakeMessage(author, content, channel, mentions))
+  except Exception: #The deck running out, say. That game can't carry on.
+    results.errors += 1
+    raise
+  finally:
+    results.add(content.split()[0], time.perf_counter() - start)
+
+#The next command for whoever's turn it is, picked at random from the legal ones.
+def next_command(game, rng):
+  player_id = game["turn_order"][game["active_player"]-1]
+  player = game["players"][str(player_id)]
+  territories = game["territories"]
+
+  if game["turn_stage"] == 0:
+    return player_id, "!trade"
+  #Sets too many to hold get traded in automatically, so the only !trade anyone sends is one they choose to.
+  if game["turn_stage"] == 1 and player["cards"] and engine.select_cards(player) is not None and rng.random() < 0.5:
+    return player_id, "!trade"
+  if game["turn_stage"] == 1:
+    return player_id, f"!deploy {player['deployable_troops']} {rng.choice(player['territories'])}"
+
+  if game["last_attack"]:
+    target, attacker, _ = game["last_attack"]
+    if territories[target]["owner"] == str(player_id) and territories[attacker]["troops"] > 1 and rng.random() < 0.5:
+      return player_id, "!move"
+  attacks = [(target, attacker) for attacker in player["territories"] if territories[attacker]["troops"] > 1
+             for target in neighbours[attacker] if territories[target]["owner"] != str(player_id)]
+  if attacks and rng.random() < 0.85:
+    target, attacker = rng.choice(attacks)
+    return player_id, f"!attack {target} from {attacker}"
+  return player_id, "!endturn"
+
+async def play_game(results, number, players, commands, think, make_channel, seed):
+  rng = random.Random(seed)
+  channel = make_channel()
+  users = [FakeUser(1000 * (number + 1) + seat) for seat in range(players)]
+  await say(results, users[0], "!play randomfill " + " ".join(user.mention for user in users[1:]), channel, users[1:])
+  game_id = main.directory.game_of(str(users[0].id))
+
+  for sent in range(commands):
+    if think: await asyncio.sleep(think)
+    game = await UnitOfWork(main.store).game(game_id)
+    if game is None or main.directory.game_of(str(users[0].id)) != game_id:
+      results.finished_games += 1
+      return channel
+    player_id, content = next_command(game, rng)
+    try:
+      await say(results, FakeUser(player_id), content, channel)
+    except Exception:
+      break
+  #Whoever's left resigns, so the next run starts from an empty directory.
+  for user in users:
+    if main.directory.game_of(str(user.id)) == game_id:
+      await main.on_message(FakeMessage(user, "!resign", channel))
+  return channel
+
+def peak_memory_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+async def run(games, players, commands, think, send_latency, seed, discord_url=None):
+  results = Results()
+  memory_before = peak_memory_kb()
+  start = time.perf_counter()
+  make_channel = discord_channel if discord_url else lambda: FakeChannel(send_latency)
+  channels = await asyncio.gather(*(play_game(results, number, players, commands, think, make_channel, seed + number)
+                                    for number in range(games)))
+  elapsed = time.perf_counter() - start
+  results.elapsed = elapsed
+  results.memory_per_game = (peak_memory_kb() - memory_before) / games
+  results.messages, results.files, results.file_bytes = await sent_counts(channels, discord_url)
+  await main.store.clear()
+  main.directory.clear()
+  return results
+
+def milliseconds(values, p):
+  return metrics.percentile(values, p) * 1000
+
+def report(results, games):
+  latencies = results.all_latencies()
+  print(f"{games} games: {len(latencies)} commands in {results.elapsed:.1f}s = {len(latencies)/results.elapsed:.1f} commands/s, "
+        f"{results.errors} errors, {results.finished_games} games finished")
+  print(f"  peak memory grew by {results.memory_per_game:.0f} KB per game; {results.messages} messages sent, "
+        f"{results.files} with maps ({results.file_bytes/max(results.files, 1)/1024:.0f} KB each)")
+  print(f"  {'command':<12}{'n':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+  for command, values in sorted(results.latencies.items()) + [("all", latencies)]:
+    print(f"  {command:<12}{len(values):>7}{milliseconds(values, 50):>10.1f}{milliseconds(values, 90):>10.1f}"
+          f"{milliseconds(values, 99):>10.1f}{max(values)*1000:>10.1f}")
+
+def sweep_row(results, games):
+  latencies = results.all_latencies()
+  return (f"{games:>7}{len(latencies)/results.elapsed:>12.1f}{milliseconds(latencies, 50):>10.1f}"
+          f"{milliseconds(latencies, 99):>10.1f}{max(latencies)*1000:>10.1f}{results.memory_per_game:>12.0f}{results.errors:>8}")
+
+async def main_loadtest(arguments):
+  start_render_pool()
+  if arguments.discord: await connect_discord(arguments.discord)
+  if arguments.sweep:
+    print(f"{'games':>7}{'commands/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'KB/game':>12}{'errors':>8}")
+    for games in (int(games) for games in arguments.sweep.split(",")):
+      results = await run(games, arguments.players, arguments.commands, arguments.think_ms / 1000,
+                          arguments.send_latency_ms / 1000, arguments.seed, arguments.discord)
+      print(sweep_row(results, games))
+  else:
+    results = await run(arguments.games, arguments.players, arguments.commands, arguments.think_ms / 1000,
+                        arguments.send_latency_ms / 1000, arguments.seed, arguments.discord)
+    report(results, arguments.games)
+  if arguments.discord: await main.client.http.close()
+  stop_render_pool()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Plays lots of games at once against the bot, without Discord.")
+  parser.add_argument("--games", type=int, default=10, help="games played at the same time")
+  parser.add_argument("--players", type=int, default=3, help="players in each game")
+  parser.add_argument("--commands", type=int, default=200, help="commands each game gets through, at most")
+  parser.add_argument("--think-ms", type=float, default=0, help="how long players wait before each command")
+  parser.add_argument("--send-latency-ms", type=float, default=0, help="how long each message takes to send")
+  parser.add_argument("--sweep", help="comma-separated numbers of games to run one after another, e.g. 1,10,100")
+  parser.add_argument("--discord", metavar="URL", help="send through discord.py to a stand-in Discord, e.g. http://localhost:8082")
+  parser.add_argument("--seed", type=int, default=0)
+  asyncio.run(main_loadtest(parser.parse_args()))
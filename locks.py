@@ -0,0 +1,35 @@
+from contextlib import asynccontextmanager
+import asyncio
+import metrics
+import time
+
+#One asyncio lock per game, so that commands for the same game run one at a time while different games carry on side by
+#side. Locks are made the first time a game needs one and thrown away as soon as nobody is holding or waiting for them,
+#so there are never more locks around than games with a command in flight.
+class LockRegistry:
+
+  def __init__(self, name="game lock"):
+    self.name = name
+    self.locks = {}   #key -> lock
+    self.users = {}   #key -> how many commands are holding or waiting for that lock
+
+  @asynccontextmanager
+  async def hold(self, key):
+    if key not in self.locks:
+      self.locks[key] = asyncio.Lock()
+      self.users[key] = 0
+    lock = self.locks[key]
+    self.users[key] += 1
+
+    start = time.perf_counter()
+    try:
+      async with lock:
+        waited = time.perf_counter() - start
+        metrics.record(f"{self.name} wait", waited)
+        metrics.observe("risk_lock_wait_seconds", waited, lock=self.name)
+        yield
+    finally:
+      self.users[key] -= 1
+      if self.users[key] == 0:
+        del self.locks[key]
+        del self.users[key]
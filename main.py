@@ -1,144 +1,84 @@
-from replit import db
-from display import draw_map
+from storage import open_storage, UnitOfWork
+from directory import Directory
+from locks import LockRegistry
+from engine import RuleError
+from parsing import ParseError, tokenize, parse_clauses, parse_int, territory
+from display import render_map, map_filename, start_render_pool
 from keep_alive import keep_alive
+import asyncio
 import os
 import discord
-import random as r
-import itertools
-from copy import deepcopy
+import engine
+import events
+import ai
+import metrics
+import odds
+import outbox
+import profiler
+import time
+import tracing
+import traceback
 
 client = discord.Client()
+store = open_storage()
+directory = Directory()
+game_locks = LockRegistry()
+ai_tasks = {} #game id -> the task playing that game's AI turns, if there is one
+monitor_task = None
 
-#The list of continents can be a list since we never need to access them individually. 
-#For territories, however, it is better to access them by name than by index.
-continents = []
-territories = {}
-neighbours = {}
-
-#Now let's fill up those empty containers above
-with open("territories.txt") as file:
-    continent = None
-    for line in file:
-      if line.startswith(">"):
-        if continent: continents.append(continent)
-        continent = {"name":line[1:-3].lower(),
-                     "bonus":line[-2],
-                     "territories":[]}
-      else:
-        text = line[:-1].split(" - ")
-        name = text[0]
-        continent["territories"].append(name)
-        territories[name] = {"owner":None,
-                             "troops":0}
-        neighbours[name] = text[1].split(", ")
-    continents.append(continent)
-
-#Now for the functions. And we've got lots of 'em.
-
-#Creates and returns a dictionary with game data.
-def create_game(players, randomfill=False):
-
-  game = {}
-
-  #Initializing players
-  deployable_troops = 0 if randomfill else (40, 35, 30, 25, 20)[len(players)-2]
-  r.shuffle(players)
-  game["players"] = {str(player_id):{"turn_number":i+1,
-                                "colour":("red", "blue", "yellow", "green", "brown", "black")[i],
-                                "territories":[],
-                                "cards":[],
-                                "deployable_troops":deployable_troops}
-                     for i, player_id in enumerate(players)}
-
-  #Initializing territories
-  game["territories"] = deepcopy(territories)
-  if randomfill:
-    for key in game["territories"].keys():
-      lucky_player = str(r.choice(players))
-      territory = game["territories"][key]
-      territory["owner"] = lucky_player
-      territory["troops"] = r.randint(1, 10)
-      game["players"][lucky_player]["territories"].append(key)
-    player = game["players"][str(players[0])]
-    player["deployable_troops"] = calculate_new_troops(player)
-
-  #Initializing deck and discard pile
-  territory_symbols = [_ for _ in territories.keys()]
-  r.shuffle(territory_symbols)
-  game["deck"] = [(("Infantry", "Cavalry", "Artillery")[i%3], territory_symbols[i]) for i in range(0, 42)] + [("Wild", None)]*2
-  r.shuffle(game["deck"])
-  game["discard_pile"] = []
-      
-  #Other variables
-  game["turn_order"] = players.copy()
-  game["active_player"] = 1
-  game["eliminated_players"] = []
-  game["turn_stage"] = 1
-  game["in_pregame"] = False if randomfill else True
-  game["unclaimed_territories"] = 0 if randomfill else 42
-  game["last_attack"] = None
-  game["card_claimed"] = False
-  game["trade_count"] = 0
-
-  return game
-
+#Now for the functions.
 
 #Returns the id of the game which any given user is in.
 def get_user_current_game_id(user):
-  try:
-    return db["users"][str(user.id)]["current_game_id"]
-  except KeyError:
-    db["users"][str(user.id)] = {"current_game_id":None}
-    return db["users"][str(user.id)]["current_game_id"]
+  return directory.game_of(str(user.id))
 
 
-#Takes a player and calculates the number of new troops he receives.
-def calculate_new_troops(player):
+#Puts a user into a game (or takes them out of one, if game_id is None), in both the directory and the store. The
+#directory changes straight away, so that nobody else can put them in a game meanwhile, and goes back if the work is
+#never committed. AI players aren't users, so they're left alone.
+async def set_user_current_game_id(work, user_id, game_id):
+  if ai.is_ai(user_id): return
+  old_game_id = directory.game_of(str(user_id))
+  directory.assign(str(user_id), game_id)
+  work.on_rollback(lambda: directory.assign(str(user_id), old_game_id))
+  (await work.user(str(user_id)))["current_game_id"] = game_id
 
-  #The number of territories you occupy.
-  new_troops = len(player["territories"]) // 3
-  if new_troops < 3: new_troops = 3
 
-  #The value of the continents you control.
-  for continent in continents:
-    owns_continent = True
-    for territory in continent["territories"]:
-      if territory not in player["territories"]:
-        owns_continent = False
-        break
-    if owns_continent:
-      new_troops += int(continent["bonus"])
-    
-  return new_troops
+#How to refer to a player in a message: a mention for people, a name for AIs.
+def mention(game, player_id):
+  return ai.name(game, player_id) if ai.is_ai(player_id) else f"<@{player_id}>"
 
 
-#Ends current turn, starts next turn. Returns the id of the player whose turn it is.
-def begin_next_player_turn(game):
+#The people still playing in a game.
+def humans_left(game):
+  return [player_id for player_id, player in game["players"].items()
+          if not ai.is_ai(player_id) and player["turn_number"] not in game["eliminated_players"]]
 
-  #Start by cycling active_player status to the next player
-  while True:
-    game["active_player"] += 1
-    if game["active_player"] > len(game["players"]):
-      game["active_player"] = 1
-    if game["active_player"] in game["eliminated_players"]:
-      continue
-    break
 
-  #Excuse this nightmare of an index
-  player_id = game["turn_order"][game["active_player"]-1]
-  player = game["players"][str(player_id)]
+#Takes everyone still in a game out of it, deletes it and commits. The game's id only becomes free once that's saved.
+async def close_game(work, game):
+  for player_id in humans_left(game):
+    await set_user_current_game_id(work, player_id, None)
+  work.delete_game(game["index"])
+  await work.commit()
+  directory.release(game["index"])
+  update_games_gauge(game)
 
-  if game["in_pregame"]:
-    if player["deployable_troops"] == 0:
-      game["in_pregame"] = False
-    else: return player_id
-  
-  player["deployable_troops"] = calculate_new_troops(player)
-  game["turn_stage"] = 1 if len(player["cards"]) < 5 else 0
-  game["last_attack"] = None
-  game["card_claimed"] = False
 
-  return player_id
+#The live games (see the directory) that are still being set up, as far as we know: games from before a restart count
+#as being played until someone sends a command in them.
+pregame_games = set()
+
+#Keeps the risk_games gauges up to date. Call it with a game whenever one's been created, closed or might have finished
+#its pregame.
+def update_games_gauge(game=None):
+  if game is not None:
+    if game["in_pregame"] and directory.is_live(game["index"]):
+      pregame_games.add(game["index"])
+    else:
+      pregame_games.discard(game["index"])
+  metrics.set_gauge("risk_games", len(pregame_games), stage="pregame")
+  metrics.set_gauge("risk_games", directory.live_games() - len(pregame_games), stage="playing")
 
 
 #Generates a message for the player whose turn it just became.
@@ -148,703 +88,741 @@ def generate_turn_start_message(game, player_id):
 
   if game["in_pregame"]:
     plural = "troops" if troops > 1 else "troop"
-    message = f"It's your turn to deploy, <@{player_id}>. You have {troops} {plural} remaining."
+    message = f"It's your turn to deploy, {mention(game, player_id)}. You have {troops} {plural} remaining."
   else:
-    message = f"It's your turn, <@{player_id}>; you have {troops} new troops ready to be deployed." + (" But you have too many cards and must trade in a set before proceeding with your turn." if game["turn_stage"] == 0 else "")
+    message = f"It's your turn, {mention(game, player_id)}; you have {troops} new troops ready to be deployed." + (" But you have too many cards and must trade in a set before proceeding with your turn." if game["turn_stage"] == 0 else "")
+
+    #Sets that had to be traded in at the start of the turn.
+    for new_troops, bonus_territory in game.get("auto_trades", ()):
+      message += f" (You had too many cards, so a set was traded in for you for {new_troops} of those troops."
+      message += (f" Two extra troops were also deployed to {bonus_territory}.)" if bonus_territory else ")")
   
   return message
 
 
+#What to tell a player who's just taken a territory with !attack or !blitz.
+def generate_conquest_message(result):
+
+  message = f"\n\nYou've conquered {result.target}! {result.moved_troops} of your troops were automatically moved forward into that territory for you."
+  if result.extra_troops == 1:
+    message += f" But you can also type '!move' to move an additional 1 troop forward. (Doing some other move or attack will negate this opportunity.)"
+  elif result.extra_troops:
+    message += f" But you can also type '!move' to move {result.extra_troops} additional troops forward (the maximum), or '!move (number)' to move a specific, lesser number of additional troops forward. (Doing some other move or attack will negate this opportunity.)"
+  if result.card_gained:
+    message += "\n\nFor conquering a territory this turn, you also gained a card."
+
+  return message
+
+
+#How an attack of attackers troops (as on the map) against defenders troops is likely to go, fought to the last troop.
+def generate_odds_message(attackers, defenders):
+  chance, off_left, def_left = odds.lookup(attackers, defenders)
+  return f"Odds of {attackers} against {defenders}: the attackers win {chance:.1%} of the time, and on average end up with {off_left:.1f} troops to the defenders' {def_left:.1f}."
+
+
+#What to tell everyone after a !blitz (by a player or an AI), apart from its consequences.
+def generate_blitz_message(result):
+  off_left = result.off_troops - result.off_dead
+  def_left = result.def_troops - result.def_dead
+  plural = "s" if result.rounds > 1 else ""
+  return f"Blitzing {result.target} from {result.attacker}...\n`{result.rounds} round{plural} of dice: attackers lost {result.off_dead}, defenders lost {result.def_dead}. ({result.off_troops} -> {off_left}, {result.def_troops} -> {def_left})`"
+
+
+#How the history refers to a player: by colour, so that looking back doesn't ping anyone.
+def player_colour(game, player_id):
+  player = game["players"].get(str(player_id))
+  return player["colour"].title() if player else "Someone who's since left"
+
+
+#One line of a game's history.
+def describe_event(game, event):
+  kind = event[0]
+  if kind == "create":
+    return f"The game began with {len(event[1])} players."
+  name = player_colour(game, event[1])
+  if kind == "deploy":
+    return f"{name} deployed {event[3]} troop{'s' if event[3] != 1 else ''} to {event[2]}."
+  if kind == "attack":
+    return f"{name} attacked {event[2]} from {event[3]} with {event[4]}, losing {event[5]} and killing {event[6]}."
+  if kind == "blitz":
+    return f"{name} blitzed {event[2]} from {event[3]}, losing {event[5]} and killing {event[6]}."
+  if kind == "move":
+    return f"{name} moved " + ("every troop they could" if event[2] is None else f"{event[2]} more troop{'s' if event[2] != 1 else ''}") + " into their conquest."
+  if kind == "fortify":
+    return f"{name} moved {event[2]} troop{'s' if event[2] != 1 else ''} from {event[3]} to {event[4]} and ended their turn."
+  if kind == "trade":
+    return f"{name} traded in a set of cards."
+  if kind == "endturn":
+    return f"{name} ended their turn."
+  if kind == "resign":
+    return f"{name} resigned."
+  if kind == "handover":
+    return f"{player_colour(game, event[2])}'s seat was handed over to an AI."
+  return f"{name} did something called {kind}."
+
+
+#Sends a message to a channel through its outbox, which merges it with whatever else the command says (see outbox.py).
+#A message with a key is dropped if a newer one with the same key comes along before it's gone out, and one that's alone
+#goes out exactly as it is.
+async def send(channel, content=None, key=None, alone=False, **kwargs):
+  return await outbox.send(channel, content, key, alone, **kwargs)
+
+#Sends the game's map. Only the newest map of a game that's waiting to go out gets sent.
+async def send_map(channel, game, thumbnail=False):
+  key = ("map", game["index"]) if game.get("index") is not None else None
+  await send(channel, file=discord.File(await render_map(game, thumbnail=thumbnail), map_filename()), key=key)
+
+
+#Sends a batch of messages as a few long ones, without going over Discord's limit.
+async def send_lines(channel, lines, limit=2000, separator="\n\n"):
+  message = ""
+  for line in lines:
+    if message and len(message) + len(separator) + len(line) > limit:
+      await send(channel, message)
+      message = ""
+    message += (separator if message else "") + line
+  if message: await send(channel, message)
+
+
+#Starts playing the AIs' turns in the background, if it's one of their turns and they aren't at it already.
+#Call it once the command that got them there has committed.
+def check_ai_turn(game, channel):
+  game_id = game["index"]
+  if ai.is_ai(engine.active_player_id(game)) and game_id not in ai_tasks:
+    ai_tasks[game_id] = asyncio.get_running_loop().create_task(play_ai_turns(game_id, channel))
+
+
+#Plays AI moves for as long as it's an AI's turn. Every move is made, saved and announced under the game's lock, just like
+#a player's command, so players' commands can slip in between moves but never in the middle of one. The AI's messages
+#are saved up and sent together at the end of its turn, or when it hands the turn to a person.
+async def play_ai_turns(game_id, channel):
+  lines = []
+  work = None
+  try:
+    while True:
+      #AI moves take their time on purpose, so they aren't traced. This also keeps them out of the trace of the command
+      #that started them.
+      with tracing.trace(None):
+        async with outbox.batch():
+          async with game_locks.hold(game_id):
+            work = UnitOfWork(store)
+            game = await work.game(game_id)
+            if game is None: return
+            player_id = engine.active_player_id(game)
+            if not ai.is_ai(player_id): return
+
+            start = time.perf_counter()
+            try:
+              action = await ai.next_action(game, player_id)
+              result = events.apply(work, game, ai.event(player_id, action))
+            except Exception:
+              #A move that blows up (the deck running dry, or the process pool breaking, say) mustn't leave the AI's seat
+              #stuck for good, so the AI makes the simplest legal move instead: ending its turn if it's attacking, and
+              #otherwise trading or deploying like the rule-of-thumb player, since those can't be skipped. The game is
+              #loaded again first, since the move might have got partway.
+              print(f"An AI's move in game {game_id} failed, so it's making the simplest move instead.")
+              traceback.print_exc()
+              work = UnitOfWork(store)
+              game = await work.game(game_id)
+              action = ("endturn",) if game["turn_stage"] == 2 else ai.policy_action(game, player_id)
+              result = events.apply(work, game, ai.event(player_id, action))
+            metrics.record("ai move", time.perf_counter() - start)
+            metrics.observe("risk_ai_move_seconds", time.perf_counter() - start)
+            name = mention(game, player_id)
+            kind = action[0]
+            next_player_id = None
+
+            if kind == "trade":
+              lines.append(f"{name} traded in a set of cards for {result.new_troops} troops.")
+            elif kind == "deploy":
+              plural = "troops" if result.troops > 1 else "troop"
+              lines.append(f"{name} deployed {result.troops} {plural} to {result.territory}.")
+              next_player_id = result.next_player_id
+            elif kind == "move":
+              lines.append(f"{name} moved {result.troops} more troops into {result.territory}.")
+            elif kind == "fortify":
+              lines.append(f"{name} moved {result.troops} troops from {action[2]} to {result.territory}.")
+              next_player_id = result.next_player_id
+            elif kind == "endturn":
+              lines.append(f"{name} ended their turn.")
+              next_player_id = result
+            elif kind == "blitz":
+              lines.append(f"{name} attacks!\n" + generate_blitz_message(result))
+              if result.eliminated_player_id:
+                lines.append(f"{mention(game, result.eliminated_player_id)} has been eliminated.")
+                await set_user_current_game_id(work, result.eliminated_player_id, None)
+              if result.victory:
+                lines.append(f"VICTORY! {name} has conquered the world!")
+              elif not humans_left(game):
+                lines.append(f"There's nobody left but the AIs in game {game_id}, so they've called it a day.")
+              if result.victory or not humans_left(game):
+                await close_game(work, game)
+                await send_lines(channel, lines)
+                await send_map(channel, game)
+                return
+
+            await work.commit()
+            update_games_gauge(game)
+
+            #Pregame deployments pass the turn straight on, so a run of AIs doing them only shows the map once a person's up.
+            if next_player_id is not None and (not game["in_pregame"] or not ai.is_ai(next_player_id)):
+              lines.append(generate_turn_start_message(game, next_player_id))
+              await send_lines(channel, lines)
+              await send_map(channel, game)
+              lines = []
+  except Exception:
+    #Nothing waits on this task, so an error that gets this far would otherwise go unreported. The next command in the
+    #game starts the AIs up again.
+    print(f"The AIs stopped playing game {game_id} because of an error.")
+    traceback.print_exc()
+    if work is not None: work.rollback()
+  finally:
+    del ai_tasks[game_id]
+
+
 #Now for the bot commands.
 
 @client.event
 async def on_ready():
   print(client.user, "has arrived.")
+  global monitor_task
+  if monitor_task is None:
+    monitor_task = asyncio.get_running_loop().create_task(monitor())
 
+#Keeps the metric that nothing else updates up to date: how late the event loop is running (how much longer than asked
+#a short sleep takes).
+LAG_INTERVAL = 0.5
+
+async def monitor():
+  while True:
+    start = time.perf_counter()
+    await asyncio.sleep(LAG_INTERVAL)
+    lag = max(time.perf_counter() - start - LAG_INTERVAL, 0)
+    metrics.observe("risk_event_loop_lag_seconds", lag)
+    metrics.set_gauge("risk_event_loop_lag_seconds_last", lag)
+
+#Every command gets timed, so we can keep an eye on how long players are left waiting (see !admin stats).
+#Each command also gets its own unit of work: whatever it loads from the store is only saved if it calls work.commit(),
+#which it does once, after it's made all of its changes. Returning early without committing throws the changes away.
+#Commands from players in a game hold that game's lock from start to finish, so two commands for the same game can't
+#interleave around their awaits, while commands for other games go ahead.
+#What a command says is held back until it's done and then sent in as few messages as possible (see outbox.py); the
+#command isn't finished until they've gone out, but the game's lock is let go of before then.
 @client.event
 async def on_message(message):
+  start = time.perf_counter()
+  name = tokenize(message.content)[0]
+  if not directory.loaded:
+    await directory.load(store)
+    update_games_gauge()
+  work = UnitOfWork(store)
+  try:
+    with tracing.trace(name if name in commands else None):
+      async with outbox.batch():
+        while True:
+          game_id = get_user_current_game_id(message.author)
+          if game_id is None or not message.content.startswith("!"):
+            await handle_message(message, work)
+            break
+          async with game_locks.hold(game_id):
+            #The game might have ended (and the player moved on) while we were waiting for the lock.
+            if get_user_current_game_id(message.author) != game_id: continue
+            await handle_message(message, work)
+            break
+  finally:
+    work.rollback()
+  if name in commands:
+    seconds = time.perf_counter() - start
+    metrics.record(name, seconds)
+    metrics.tally(f"{name} writes", work.writes)
+    metrics.observe("risk_command_seconds", seconds, command=name)
+
+#Every command has a handler, registered in this table by the @command decorator. Handlers for commands that are played
+#in a game are passed the player's game and their id (as a string), and never see players who aren't in one.
+#A handler can raise a ParseError or a RuleError to tell the player what went wrong; that's all it takes, as long as it
+#hasn't committed anything yet.
+commands = {}
+
+def command(name, in_game=False):
+  def register(handler):
+    commands[name] = (handler, in_game)
+    return handler
+  return register
+
+async def handle_message(message, work):
 
   if message.author == client.user:
     if message.content[:6] != "!hack ":
       return
 
-  args = message.content.split()
-  command = args[0]
+  name, args = tokenize(message.content)
 
   #Admin command that lets me use the bot like a test dummy player.
-  if command == "!hack":
+  if name == "!hack":
     if message.author == client.user:
-      del args[0]
-      command = args[0]
+      name, args = tokenize(" ".join(args))
     elif message.author.id == int(os.environ['ADMIN_ID']):
-      await message.channel.send(message.content)
-      return
-
-  if command == "!admin" and message.author.id == int(os.environ['ADMIN_ID']):
-    if args[1] == "cleardb":
-      db["games"] = []
-      db["users"] = {}
-      await message.channel.send("Database cleared.")
-      return
-
-
-  #The !play command. Starts a new game including the message sender and all mentioned players.
-  if command == "!play":
-    
-    #Finding the users mentioned in the message in order to add them to the game
-    players = message.mentions.copy()
-    for mention in players:
-      if message.author == mention:
-        players.remove(mention)
-    if len(players) == 0:
-      await message.channel.send("Unfortunately you cannot play by yourself.")
-      return
-    if len(players) > 5:
-      await message.channel.send("Too many players; the maximum is 6.")
-      return
-    players.append(message.author)
-
-    #Checking to make sure none of the players are already in a game
-    busy_players = []
-    for player in players:
-      if get_user_current_game_id(player) != None: busy_players.append(player.mention)
-    if busy_players:
-      await message.channel.send(f"{busy_players} is/are already in a game.")
+      #The bot only picks up its own message if it starts with "!hack ", so it mustn't be merged with anything.
+      await send(message.channel, message.content, alone=True)
       return
 
-    #Turning the player list into a player id list
-    players = [player.id for player in players]
-
-    #Making the game, assigning the players to that game, updating the database
-    game = None
-    for i, g in enumerate(db["games"]):
-      if g == None:
-        x = i
-        game = create_game(players, randomfill=bool(args[1] == "randomfill"))
-        db["games"][i] = game
-        break
-    if not game:
-      x = len(db["games"])
-      game = create_game(players, randomfill=bool(args[1] == "randomfill"))
-      db["games"].append(game)
-    for player in players:
-      db["users"][str(player)]["current_game_id"] = x
-    db["games"][x]["index"] = x
-
-    #Announcing the creation of a brand new game, yaaaaaaay
-    announcement = f"New game created with id {x}.\n"
-    for i, player in enumerate(players, 1):
-      colour = ("red", "blue", "yellow", "green", "brown", "black")[i-1]
-      announcement += f"Player {i} ({colour}): <@{player}>\n"
-    await message.channel.send(announcement)
-    await message.channel.send(generate_turn_start_message(game, players[0]))
-    await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
+  if name not in commands:
     return
+  handler, in_game = commands[name]
 
+  game = None
+  try:
+    if not in_game:
+      await handler(message, work, args)
+      return
 
-  #The !deploy command. Used by in-game players to place troops upon their territories.
-  if command == "!deploy":
-    
     user_current_game_id = get_user_current_game_id(message.author)
-
     #"NotInGameError"
     if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
+      await send(message.channel, f"You're not in a game, {message.author.mention}.")
       return
+    game = await work.game(user_current_game_id)
+    #If it's an AI's turn and nobody's playing it (the bot restarted partway through, say), this gets it going again.
+    if game is not None: check_ai_turn(game, message.channel)
+    await handler(message, work, args, game, str(message.author.id))
+    if game is not None: update_games_gauge(game)
+
+  except ParseError as error:
+    await send(message.channel, str(error))
+  except RuleError as error:
+    #The engine leaves it to us how to address whoever the message is for (see engine.RuleError).
+    await send(message.channel, error.addressed_to(mention(game, error.player_id)))
 
-    user_id = str(message.author.id)
-    game = db["games"][user_current_game_id]
-    #"NotYourTurnError"
-    if game["active_player"] != game["players"][user_id]["turn_number"]:
-      await message.channel.send(f"It's not your turn, {message.author.mention}.")
+
+@command("!admin")
+async def admin_command(message, work, args):
+  if message.author.id != int(os.environ['ADMIN_ID']) or not args:
+    return
+  if args[0] == "cleardb":
+    await store.clear()
+    directory.clear()
+    pregame_games.clear()
+    update_games_gauge()
+    await send(message.channel, "Database cleared.")
+    return
+  if args[0] == "stats":
+    await send(message.channel, f"```{metrics.report()}```")
+    return
+  #Samples what the bot's doing for a while (a minute unless told otherwise) and sends back the stacks it saw, folded
+  #for a flame graph.
+  if args[0] == "profile":
+    usage = "Use !admin profile start [seconds] or !admin profile stop."
+    if len(args) > 1 and args[1] == "start":
+      seconds = parse_int(args[2], usage) if len(args) > 2 else 60
+      if not profiler.start(seconds):
+        await send(message.channel, "There's already a profile being taken.")
+        return
+      await send(message.channel, f"Profiling for up to {seconds} seconds. Use !admin profile stop to finish early.")
+      return
+    if len(args) > 1 and args[1] == "stop":
+      finished = profiler.stop()
+      if finished is None:
+        await send(message.channel, "There's no profile to stop.")
+        return
+      await send(message.channel, f"{finished.samples} samples, written to {finished.path}.", file=discord.File(finished.path))
       return
-    #"NotYetDeploymentStageError"
-    if game["turn_stage"] == 0:
-      await message.channel.send(f"You must trade in a set of cards, {message.author.mention}. Type !trade to do so.")
+    raise ParseError(usage)
+  #Which log a game is on, for replaying. Players never see log ids (see events.py).
+  if args[0] == "log":
+    game_id = parse_int(args[1] if len(args) > 1 else None, "Use !admin log <game id>.")
+    game = await store.get_game(game_id)
+    if game is None:
+      await send(message.channel, f"There's no game {game_id}.")
       return
-    #"DeploymentStageOverError"
-    if game["turn_stage"] == 2:
-      await message.channel.send(f"You have no troops left to deploy, {message.author.mention}.")
+    await send(message.channel, f"Game {game_id} is on log {game.get('log')}.")
+    return
+  #Replays a game's log (see !admin log for its id) up to some event, for looking into bug reports.
+  if args[0] == "replay":
+    usage = "Use !admin replay <log id> [event number]."
+    log_id = parse_int(args[1] if len(args) > 1 else None, usage)
+    log = await store.get_events(log_id)
+    if not log or log[0][0] != "create":
+      await send(message.channel, f"There's no complete log with the id {log_id}.")
+      return
+    upto = parse_int(args[2], usage) if len(args) > 2 else None
+    try:
+      game = events.replay(log_id, log, upto)
+    except events.ReplayError as error:
+      await send(message.channel, str(error))
       return
+    await send(message.channel, f"Log {log_id} after event {game['event_count'] - 1} of {len(log) - 1}:")
+    await send_map(message.channel, game)
+    return
 
-    try: #This try block catches IndexErrors which could occur both in the try and except block of the following try-except statement.
 
-      try: #This try block just catches ValueErrors, in case the user is using the shorter !deploy syntax which implies he only wants to deploy one troop.
+#The !play command. Starts a new game including the message sender and all mentioned players.
+@command("!play")
+async def play_command(message, work, args):
 
-        deployed_troops = int(args[1])
-        if deployed_troops == 0: #"ZeroTroopError"
-          await message.channel.send("You tried your hardest, and by a great force of will, you successfully deployed zero troops! So great was your power that you successfully deployed zero troops to not just one location, but every location! Wow! You're so going to win this war. And it's still your turn, by the way. As though you needed any more power.")
-          return
-        deploy_location = " ".join(args[2:]).title()
+  #Finding the users mentioned in the message in order to add them to the game. Every mention of the bot itself is an AI seat.
+  players = [mention for mention in message.mentions if mention != message.author and mention != client.user]
+  ai_seats = sum(1 for arg in args if arg in (f"<@{client.user.id}>", f"<@!{client.user.id}>"))
+  if len(players) + ai_seats == 0:
+    await send(message.channel, "Unfortunately you cannot play by yourself. (Mention me to add an AI player, e.g. '!play @me'.)")
+    return
+  if len(players) + ai_seats > 5:
+    await send(message.channel, "Too many players; the maximum is 6.")
+    return
+  players.append(message.author)
+
+  #Checking to make sure none of the players are already in a game. Their records are loaded up front so that nothing
+  #gets awaited between checking that they're free and putting them in the new game.
+  await work.load_users([str(player.id) for player in players])
+  busy_players = [player.mention for player in players if get_user_current_game_id(player) != None]
+  if busy_players:
+    await send(message.channel, f"{busy_players} is/are already in a game.")
+    return
 
-      except ValueError:
-        deployed_troops = 1
-        deploy_location = " ".join(args[1:]).title()
+  #Turning the player list into a player id list
+  players = [player.id for player in players]
+  for seat in range(ai_seats):
+    players.append(ai.new_ai_id(players))
+
+  #Making the game, assigning the players to that game, updating the database
+  x = directory.allocate()
+  work.on_rollback(lambda: directory.release(x))
+  options = set(arg.lower() for arg in args)
+  game, event = events.create_game(players, randomfill="randomfill" in options, path_fortify="pathfortify" in options)
+  game["index"] = x
+  work.new_game(x, game)
+  work.record(x, event)
+  for player in players:
+    await set_user_current_game_id(work, player, x)
+  await work.commit()
+
+  #Announcing the creation of a brand new game, yaaaaaaay
+  announcement = f"New game created with id {x}.\n"
+  for i, player in enumerate(players, 1):
+    colour = ("red", "blue", "yellow", "green", "brown", "black")[i-1]
+    announcement += f"Player {i} ({colour}): {mention(game, player)}\n"
+  if game["path_fortify"]:
+    announcement += "Troops can be moved at the end of a turn to any territory connected through your own, not just next door. (Use !reach to see where.)\n"
+  await send(message.channel, announcement)
+  await send(message.channel, generate_turn_start_message(game, players[0]))
+  await send_map(message.channel, game)
+  update_games_gauge(game)
+  check_ai_turn(game, message.channel)
+
+
+#The !deploy command. Used by in-game players to place troops upon their territories.
+@command("!deploy", in_game=True)
+async def deploy_command(message, work, args, game, user_id):
+
+  #The number of troops is optional; leaving it out means deploying just the one.
+  if args and args[0].lstrip("-").isdigit():
+    deployed_troops = int(args[0])
+    if deployed_troops == 0: #"ZeroTroopError"
+      await send(message.channel, "You tried your hardest, and by a great force of will, you successfully deployed zero troops! So great was your power that you successfully deployed zero troops to not just one location, but every location! Wow! You're so going to win this war. And it's still your turn, by the way. As though you needed any more power.")
+      return
+    args = args[1:]
+  else:
+    deployed_troops = 1
+  if not args:
+    raise ParseError("You didn't tell me where to deploy.")
+  deploy_location = territory(" ".join(args))
 
-      #"TooManyTroopsError"
-      if game["in_pregame"] and deployed_troops > 1:
-        await message.channel.send("You can't deploy more than one troop at a time until the game setup is over.")
-        return
-      if game["players"][user_id]["deployable_troops"] < deployed_troops:
-        await message.channel.send("You don't have that many troops.")
-        return
+  result = events.apply(work, game, ["deploy", user_id, deploy_location, deployed_troops])
+  await work.commit()
 
-    except IndexError:
-      await message.channel.send("You didn't tell me where to deploy.")
-      return
-    
-    #Alright, and NOW we can check to see if the user actually referenced a real territory lol
-    try: territory = game["territories"][deploy_location]
-    except KeyError as key:
-      await message.channel.send(f"Couldn't find the territory '{key}'.")
-      return
-    if str(territory["owner"]) not in ("None", user_id): #"GetOffMyPropertyError"
-      await message.channel.send("Someone else owns that territory.")
-      return
-    if game["unclaimed_territories"] and territory["owner"]: #"MustClaimTerritoryError"
-      await message.channel.send("You must deploy on unclaimed territories while there are territories to be claimed.")
-      return
+  await send(message.channel, f"Deployed {deployed_troops} " + ("troops" if deployed_troops > 1 else "troop") + f" to {deploy_location}.")
 
-    #Error checking finally finished. Deploying troops.
-    if territory["owner"] == None:
-      territory["owner"] = user_id
-      game["unclaimed_territories"] -= 1
-      game["players"][user_id]["territories"].append(deploy_location)
+  #After deploying in the pregame, your turn immediately ends.
+  if result.next_player_id is not None:
+    await send(message.channel, generate_turn_start_message(game, result.next_player_id))
+    await send_map(message.channel, game)
+    check_ai_turn(game, message.channel)
+    return
 
-    territory["troops"] += deployed_troops
-    game["players"][user_id]["deployable_troops"] -= deployed_troops
+  #Done deploying all your troops? Right then, now you can use the attack command.
+  if result.all_deployed:
+    await send(message.channel, "All troops deployed. Attack as you please, general.")
+    await send_map(message.channel, game, thumbnail=True)
 
-    await message.channel.send(f"Deployed {deployed_troops} " + ("troops" if deployed_troops > 1 else "troop") + f" to {deploy_location}.")
 
-    #After deploying in the pregame, your turn immediately ends.
-    if game["in_pregame"]:
-      next_player_id = begin_next_player_turn(game)
-      await message.channel.send(generate_turn_start_message(game, next_player_id))
-      await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-      return
+#The attack command. Self-explanatory.
+ATTACK_USAGE = "Invalid syntax. Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)"
 
-    #Done deploying all your troops? Right then, now you can use the attack command.
-    if game["players"][user_id]["deployable_troops"] == 0:
-      game["turn_stage"] = 2
-      await message.channel.send("All troops deployed. Attack as you please, general.")
-      await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-      return
+@command("!attack", in_game=True)
+async def attack_command(message, work, args, game, user_id):
 
+  #Might be using the shortcut
+  if not args:
+    if not game["last_attack"]:
+      raise ParseError("Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)\nAlternatively, !attack can be used on its own to repeat your previous attack. If you were attempting this, know that no previous attack was found.")
+    target, attacker, army_size = game["last_attack"]
+  else:
+    clauses = parse_clauses(args, ("from", "with"), ATTACK_USAGE)
+    if None not in clauses or "from" not in clauses: raise ParseError(ATTACK_USAGE)
+    target = territory(clauses[None])
+    attacker = territory(clauses["from"])
+    army_size = parse_int(clauses["with"], ATTACK_USAGE) if "with" in clauses else 3
+
+  result = events.apply(work, game, ["attack", user_id, target, attacker, army_size])
+
+  if result.adjusted:
+    await send(message.channel, f"Automatically reducing attacking army size to {result.army_size}...")
+
+  off_dead, def_dead = result.off_dead, result.def_dead
+  those_who_lost = "both armies" if off_dead and def_dead else "attackers" if off_dead else "defenders"
+  amount_text = "two troops" if 2 in (off_dead, def_dead) else "one troop"
+
+  changes = "("
+  if those_who_lost != "defenders":
+    changes += f"{result.off_troops} -> {result.off_troops - off_dead}"
+    if those_who_lost == "both armies":
+      changes += ", "
+  if those_who_lost != "attackers":
+    changes += f"{result.def_troops} -> {result.def_troops - def_dead}"
+  changes += ")"
+
+  results = f"Rolling...\n`Attackers ({result.off_troops}): {result.off_dice}`\n`Defenders ({result.def_troops}): {result.def_dice}`\n`Result: {those_who_lost} lose {amount_text}. {changes}`"
+
+  if result.eliminated_player_id:
+    results += f"\n\n{mention(game, result.eliminated_player_id)} has been eliminated."
+    await set_user_current_game_id(work, result.eliminated_player_id, None)
+
+  #Check for victory
+  if result.victory:
+    results += f"\n\nVICTORY! <@{user_id}> has conquered the world!"
+    await close_game(work, game)
+    await send(message.channel, results)
+    await send_map(message.channel, game)
+    return
 
-  #The attack command. Self-explanatory.
-  if command == "!attack":
+  if result.conquered:
+    results += generate_conquest_message(result)
 
-    user_current_game_id = get_user_current_game_id(message.author)
+  elif result.army_too_small:
+    results += f"\n\nYour army has grown too small to continue the attack."
 
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
+  await work.commit()
+  await send(message.channel, results)
+  if result.conquered or result.army_too_small:
+    await send_map(message.channel, game, thumbnail=True)
 
-    user_id = str(message.author.id)
-    game = db["games"][user_current_game_id]
-    player = game["players"][user_id]
 
-    if game["active_player"] != player["turn_number"]:
-      await message.channel.send(f"It's not your turn, {message.author.mention}.")
-      return
-    if game["turn_stage"] != 2:
-      troops = player["deployable_troops"]
-      await message.channel.send(f"You must first deploy all of your troops, {message.author.mention}. You still have {troops} left.")
-      return
-    
-    try:
-      args[1]
-      string = []
-      for arg in args[1:]:
-        if arg == "from":
-          target = " ".join(string).title()
-          if not target: raise NameError
-          string = []
-        elif arg == "with":
-          if target:
-            attacker = " ".join(string).title()
-            if not attacker: raise NameError
-            string = []
-        else:
-          string.append(arg)
-      try:
-        attacker
-        army_size = int(string[0])
-      except NameError:
-        attacker = " ".join(string).title()
-      target #checking if it exists
-    
-    #Might be using the shortcut
-    except IndexError:
-      if game["last_attack"]:
-        target, attacker, army_size = game["last_attack"]
-      else:
-        await message.channel.send("Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)\nAlternatively, !attack can be used on its own to repeat your previous attack. If you were attempting this, know that no previous attack was found.")
-        return
+#The !odds command. Anyone can ask, in a game or not.
+@command("!odds")
+async def odds_command(message, work, args):
+  usage = "Usage: !odds (attacking troops) (defending troops)\n(e.g. !odds 10 7)\nThe attacking troops are all the troops in the attacking territory, including the one that has to stay behind."
+  if len(args) != 2: raise ParseError(usage)
+  attackers, defenders = parse_int(args[0], usage), parse_int(args[1], usage)
+  if attackers < 1 or defenders < 1: raise ParseError(usage)
+  if odds.lookup(attackers, defenders) is None:
+    await send(message.channel, f"I only know the odds for up to {odds.table_max} troops a side.")
+    return
+  await send(message.channel, generate_odds_message(attackers, defenders))
 
-    #Might just be doing it wrong
-    except (NameError, ValueError):
-      await message.channel.send("Invalid syntax. Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)")
-      return
 
-    #We should have values for target and attacker, and possibly for army_size
-    try: army_size
-    except NameError: army_size = 3
-    
-    #Checking that the attack is legal
-    try:
-      def_territory = game["territories"][target]
-      def_territory_troops = def_territory["troops"]
-      off_territory = game["territories"][attacker]
-      off_territory_troops = off_territory["troops"]
-    except KeyError as key:
-      await message.channel.send(f"Couldn't find the territory '{key}'.")
-      return
-    if off_territory["owner"] != user_id:
-      await message.channel.send("You can't attack from a territory you don't own.")
-      return
-    if target not in neighbours[attacker]:
-      await message.channel.send("Those territories are not adjacent.")
-      return
-    if def_territory["owner"] == user_id:
-      await message.channel.send("You can't attack yourself.")
-      return
-    if off_territory_troops == 1:
-      await message.channel.send("You can't attack with one troop; doing so would leave your territory undefended.")
-      return
-    
-    #Automatically adjusting army size if necessary
-    adjusted = False
-    if army_size > 3:
-      army_size = 3
-      adjusted = True
-    if off_territory_troops <= army_size:
-      army_size = off_territory_troops - 1
-      adjusted = True
-    if adjusted:
-      await message.channel.send(f"Automatically reducing attacking army size to {army_size}...")
-    
-    #Calling defenders to arms
-    def_size = 2 if def_territory["troops"] > 1 else 1
-    
-    off_dice = [r.randint(1, 6) for die in range(0, army_size)]
-    def_dice = [r.randint(1, 6) for die in range(0, def_size)]
-    off_dice.sort(reverse=True)
-    def_dice.sort(reverse=True)
-    off_dead = 0
-    def_dead = 0
-    try:
-      for i in range(0, 2):
-        if off_dice[i] > def_dice[i]: def_dead += 1
-        else: off_dead += 1
-    except IndexError: pass
-
-    those_who_lost = "both armies" if off_dead and def_dead else "attackers" if off_dead else "defenders"
-    amount_text = "two troops" if 2 in (off_dead, def_dead) else "one troop"
-    
-    changes = "("
-    if those_who_lost != "defenders":
-      changes += f"{off_territory_troops} -> {off_territory_troops - off_dead}"
-      if those_who_lost == "both armies":
-        changes += ", "
-    if those_who_lost != "attackers":
-      changes += f"{def_territory_troops} -> {def_territory_troops - def_dead}"
-    changes += ")"
-
-    results = f"Rolling...\n`Attackers ({off_territory_troops}): {off_dice}`\n`Defenders ({def_territory_troops}): {def_dice}`\n`Result: {those_who_lost} lose {amount_text}. {changes}`"
-
-    off_territory["troops"] -= off_dead
-    def_territory["troops"] -= def_dead
-    game["last_attack"] = (target, attacker, army_size)
-
-    if def_territory["troops"] == 0:
-
-      conquered_player_id = def_territory["owner"]
-      conquered_player = game["players"][conquered_player_id]
-      conquered_player["territories"].remove(target)
-
-      if len(conquered_player["territories"]) == 0: #Player eliminated.
-        game["discard_pile"] += conquered_player["cards"]
-        conquered_player["cards"] = None
-        game["eliminated_players"].append(conquered_player["turn_number"])
-        results += f"\n\n<@{conquered_player_id}> has been eliminated."
-        db["users"][conquered_player_id]["current_game_id"] = None
-      
-      max_troops = off_territory["troops"] - 1
-      min_troops = army_size - off_dead
-      def_territory["owner"] = user_id
-      def_territory["troops"] = min_troops
-      off_territory["troops"] -= min_troops
-
-      game["players"][user_id]["territories"].append(target)
-      #Check for victory
-      if len(game["players"][user_id]["territories"]) == 42:
-        results += f"\n\nVICTORY! <@{user_id}> has conquered the world!"
-        await message.channel.send(results)
-        await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-        db["users"][user_id]["current_game_id"] = None
-        db["games"][game["index"]] = None
-        return
+#The !blitz command. Keeps attacking until the territory falls or the attackers are worn down, all in one message.
+BLITZ_USAGE = "Invalid syntax. Usage: !blitz (target country) from (attacking country) [until (troops)]\n(e.g. !blitz Siam from Indonesia until 3)\nThe attack carries on until the target falls or the attacking country is down to the given number of troops (1 if you don't give one)."
 
-      results += f"\n\nYou've conquered {target}! {min_troops} of your troops were automatically moved forward into that territory for you."
-      if max_troops != min_troops:
-        if max_troops - min_troops == 1:
-          results += f" But you can also type '!move' to move an additional 1 troop forward. (Doing some other move or attack will negate this opportunity.)"
-        else:
-          results += f" But you can also type '!move' to move {max_troops - min_troops} additional troops forward (the maximum), or '!move (number)' to move a specific, lesser number of additional troops forward. (Doing some other move or attack will negate this opportunity.)"
-      else:
-        game["last_attack"] = None
-
-      if not game["card_claimed"]:
-        player["cards"].append(game["deck"].pop())
-        game["card_claimed"] = True
-        results += "\n\nFor conquering a territory this turn, you also gained a card."
-
-    elif off_territory["troops"] == 1:
-      results += f"\n\nYour army has grown too small to continue the attack."
-
-    await message.channel.send(results)
-    if def_territory["owner"] == user_id or off_territory["troops"] == 1:
-      await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-    return
+@command("!blitz", in_game=True)
+async def blitz_command(message, work, args, game, user_id):
 
+  clauses = parse_clauses(args, ("from", "until"), BLITZ_USAGE)
+  if None not in clauses or "from" not in clauses: raise ParseError(BLITZ_USAGE)
+  target = territory(clauses[None])
+  attacker = territory(clauses["from"])
+  until = parse_int(clauses["until"], BLITZ_USAGE) if "until" in clauses else 1
 
-  if command == "!move":
-    
-    user_current_game_id = get_user_current_game_id(message.author)
+  #The odds have to be looked up before the battle changes the troop counts. They're only for fighting to the last troop,
+  #and only go so high.
+  attackers, defenders = game["territories"][attacker]["troops"], game["territories"][target]["troops"]
+  odds_line = ""
+  if until == 1 and odds.lookup(attackers, defenders) is not None:
+    odds_line = generate_odds_message(attackers, defenders) + "\n"
 
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
+  result = events.apply(work, game, ["blitz", user_id, target, attacker, until])
+  results = odds_line + generate_blitz_message(result)
 
-    user_id = str(message.author.id)
-    game = db["games"][user_current_game_id]
-    player = game["players"][user_id]
+  if result.eliminated_player_id:
+    results += f"\n\n{mention(game, result.eliminated_player_id)} has been eliminated."
+    await set_user_current_game_id(work, result.eliminated_player_id, None)
 
-    if game["active_player"] != player["turn_number"]:
-      await message.channel.send(f"It's not your turn, {message.author.mention}.")
-      return
-    if game["turn_stage"] != 2:
-      troops = player["deployable_troops"]
-      await message.channel.send(f"You must first deploy all of your troops, {message.author.mention}. You still have {troops} left.")
-      return
+  if result.victory:
+    results += f"\n\nVICTORY! <@{user_id}> has conquered the world!"
+    await close_game(work, game)
+    await send(message.channel, results)
+    await send_map(message.channel, game)
+    return
 
-    #Putting this message here is better than wrapping the following block of code in one fat try statement and catching arbitrary SyntaxErrors
-    move_command_syntax_error_message = "Invalid syntax. Usage: '!move (number of troops) from (starting territory) to (destination territory)'\n(e.g. '!move 5 from Egypt to Middle East')\nAfter conquering a territory, !move is also used to move more troops into the conquered territory, like so: '!move 5'."
-
-    #Checking to see if this is a move into a just-conquered territory.
-    try: args[2]
-    except IndexError:
-      if not game["last_attack"]:
-        try: args[1]
-        except IndexError:
-          await message.channel.send("Usage: '!move (number of troops) from (starting territory) to (destination territory)'\n(e.g. '!move 5 from Egypt to Middle East')\nAfter conquering a territory, !move is also used to move more troops into the conquered territory, like so: '!move 5'.")
-          return
-      
-      target, attacker, _ = game["last_attack"]
-      target_territory = game["territories"][target]
-      attacker_territory = game["territories"][attacker]
-
-      if target_territory["owner"] != attacker_territory["owner"]:
-        await message.channel.send("You haven't conquered the territory yet.")
-        return
-          
-      try:
-        troop_count = int(args[1])
-        if attacker_territory["troops"] <= troop_count:
-          await message.channel.send("You're trying to move too many troops; one troop must always stay behind.")
-          return
-      except IndexError: #No first argument
-        troop_count = attacker_territory["troops"] - 1
-      except ValueError: #First argument was not an integer. Unacceptable.
-        await message.channel.send(move_command_syntax_error_message)
-        return
-          
-      attacker_territory["troops"] -= troop_count
-      target_territory["troops"] += troop_count
-      game["last_attack"] = None
-
-      target_troops = target_territory["troops"]
-      plural = "s" if troop_count > 1 else ""
-      await message.channel.send(f"Moved {troop_count} extra troop{plural} to {target}, increasing its troop count to {target_troops}.")
-      return
-    
-    #Now for parsing the end-of-turn-movement syntax
-    try:
-      troop_count = int(args[1])
-      if args[2] != "from": raise ValueError #sure, call me cheap
-    except ValueError:
-      await message.channel.send(move_command_syntax_error_message)
-      return
-    
-    #Extracting the rest of the arguments
-    try:
-      string = []
-      for arg in args[3:]:
-        if arg == "to":
-          start = " ".join(string).title()
-          if not start: raise NameError
-          string = []
-        else: string.append(arg)
-      start
-      destination = " ".join(string).title()
-      if not destination: raise NameError
-    except (NameError, IndexError):
-      await message.channel.send(move_command_syntax_error_message)
-      return
+  if result.conquered:
+    results += generate_conquest_message(result)
+  else:
+    off_left = result.off_troops - result.off_dead
+    results += f"\n\n{target} holds. Your attack has stopped with {off_left} " + ("troops" if off_left > 1 else "troop") + f" left in {attacker}."
 
-    #Checking that the move is legal
-    try:
-      territory_a = game["territories"][start]
-      territory_b = game["territories"][destination]
-    except KeyError as key:
-      await message.channel.send(f"Couldn't find the territory '{key}'.")
-      return
-    if territory_a["owner"] != user_id:
-      await message.channel.send(f"You don't own {start}.")
-      return
-    elif territory_b["owner"] != user_id:
-      await message.channel.send(f"You don't own {destination}.")
-      return
-    if start not in neighbours[destination]:
-      await message.channel.send("Those territories are not adjacent.")
-      return
-    if troop_count >= territory_a["troops"]:
-      await message.channel.send("You're trying to move too many troops: at least one troop must always stay behind.")
-      return
-    
-    territory_a["troops"] -= troop_count
-    territory_b["troops"] += troop_count
+  await work.commit()
+  await send(message.channel, results)
+  await send_map(message.channel, game, thumbnail=True)
 
-    destination_troops = territory_b["troops"]
-    await message.channel.send(f"Moved {troop_count} extra troops to {destination}, increasing its troop count to {destination_troops}.")
 
-    #Starting the next player's turn.
-    start_message = generate_turn_start_message(game, begin_next_player_turn(game))
-    await message.channel.send(start_message)
-    await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-    return
+#The !move command: bringing more troops into a territory you've just conquered, or the end-of-turn troop movement.
+MOVE_USAGE = "Invalid syntax. Usage: '!move (number of troops) from (starting territory) to (destination territory)'\n(e.g. '!move 5 from Egypt to Middle East')\nAfter conquering a territory, !move is also used to move more troops into the conquered territory, like so: '!move 5'."
 
+@command("!move", in_game=True)
+async def move_command(message, work, args, game, user_id):
 
-  #The !cards command lets players see their cards.
-  if command == "!cards":
+  #Checking to see if this is a move into a just-conquered territory.
+  if len(args) < 2:
+    if not args and not game["last_attack"]:
+      raise ParseError("Usage: '!move (number of troops) from (starting territory) to (destination territory)'\n(e.g. '!move 5 from Egypt to Middle East')\nAfter conquering a territory, !move is also used to move more troops into the conquered territory, like so: '!move 5'.")
+    troop_count = parse_int(args[0], MOVE_USAGE) if args else None
 
-    user_current_game_id = get_user_current_game_id(message.author)
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
+    result = events.apply(work, game, ["move", user_id, troop_count])
+    await work.commit()
 
-    cards = db["games"][user_current_game_id]["players"][str(message.author.id)]["cards"]
-    display = "Your cards:"
-    for card in cards:
-      territory = card[1]
-      if card[0] == "Infantry":
-        display += f"\n> [:military_helmet: - {territory}]"
-      elif card[0] == "Cavalry":
-        display += f"\n> [:horse: - {territory}]"
-      elif card[0] == "Artillery":
-        display += f"\n> [:boom: - {territory}]"
-      else:
-        display += "\n> [:military_helmet: - :horse: - :artillery: - Wild]"
-
-    await message.channel.send(display)
+    plural = "s" if result.troops > 1 else ""
+    await send(message.channel, f"Moved {result.troops} extra troop{plural} to {result.territory}, increasing its troop count to {result.territory_troops}.")
     return
 
+  #Now for parsing the end-of-turn-movement syntax
+  clauses = parse_clauses(args, ("from", "to"), MOVE_USAGE)
+  if len(clauses) != 3: raise ParseError(MOVE_USAGE)
+  troop_count = parse_int(clauses[None], MOVE_USAGE)
+  start = territory(clauses["from"])
+  destination = territory(clauses["to"])
 
-  #The !trade command lets players trade in their cards. Automatically selects the remaining cards if some or all of the cards are unspecified.
-  if command == "!trade":
+  result = events.apply(work, game, ["fortify", user_id, troop_count, start, destination])
+  await work.commit()
 
-    user_current_game_id = get_user_current_game_id(message.author)
-    user_id = str(message.author.id)
+  await send(message.channel, f"Moved {troop_count} extra troops to {destination}, increasing its troop count to {result.territory_troops}.")
 
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
+  #Starting the next player's turn.
+  await send(message.channel, generate_turn_start_message(game, result.next_player_id))
+  await send_map(message.channel, game)
+  check_ai_turn(game, message.channel)
 
-    game = db["games"][user_current_game_id]
 
-    if game["active_player"] != game["players"][user_id]["turn_number"]:
-      await message.channel.send(f"It's not your turn, {message.author.mention}.")
-      return
-    if game["turn_stage"] == 2:
-      await message.channel.send(f"You've deployed all your troops and therefore can no longer trade, {message.author.mention}.")
-      return
+#Lists where a territory's troops could be moved to at the end of the turn.
+@command("!reach", in_game=True)
+async def reach_command(message, work, args, game, user_id):
 
-    player = game["players"][user_id]
-    cards = player["cards"]
+  if not args:
+    raise ParseError("Usage: !reach (territory)\n(e.g. !reach Siam)\nLists the territories you could move troops to from there at the end of your turn.")
+  start = territory(" ".join(args))
 
-    if len(cards) < 3:
-      await message.channel.send(f"You don't have enough cards to trade, {message.author.mention}.")
-      return
+  destinations = engine.fortify_destinations(game, user_id, start)
+  if not destinations:
+    await send(message.channel, f"You can't move troops anywhere from {start}.")
+    return
+  await send(message.channel, f"From {start}, you can move troops to: " + ", ".join(destinations) + ".")
 
-    selected_cards = []
-    try:
-      for i in range(1, 5):
-
-        try: card_index = int(args[i])-1 #Card numbers start at 1, not 0
-        except IndexError: break #All arguments recorded, moving on
-        
-        #Exceptions
-        except ValueError: #TheNumberGreenError
-          await message.channel.send("Invalid syntax; use numbers (no commas) to indicate which cards you're trading. (e.g. !trade 1 2 4)")
-          return
-        if card_index < 0: raise IndexError #NegativeIndexError
-        if i == 4: #TooManyArgumentsError
-          await message.channel.send("There are only three cards to a set. Why are you trying to trade in four?")
-          return
-
-        selected_cards.append(cards[card_index]) #Legit card? Alright then.
-
-    except IndexError as i:
-      if i < 21 and i > -1:
-        await message.channel.send(f"You don't have a {i}th card, mate.")
-      else:
-        await message.channel.send(f"Don't be absurd. No one has {i} cards.")
-      return
 
-    #Just a helpful inner function
-    def check_set_legality(cards_to_be_checked):
-      legal = False
-      if len(cards_to_be_checked) == 3:
-        L = [card[0] for card in cards_to_be_checked]
-        L, wild = (L.count("Infantry"), L.count("Cavalry"), L.count("Artillery")), L.count("Wild")
-        if wild or L.count(2) == 0: legal = True
-      return legal
-
-    #Legality checking and autoselecting
-    if len(selected_cards) == 3:
-      if not check_set_legality(selected_cards):
-        await message.channel.send("That's not a legal set of cards.")
-        return
-    else: #Autoselecting
-      #Filling a list named legal_sets with all possible legal sets of cards
-      legal_sets = []
-      unselected_cards = [card for card in cards if card not in selected_cards]
-      for combination in itertools.combinations(unselected_cards, 3 - len(selected_cards)):
-        possible_set = selected_cards + list(combination)
-        if check_set_legality(possible_set):
-          legal_sets.append(possible_set)
-      if not legal_sets:
-        await message.channel.send(f"You don't have a complete set to trade in, {message.author.mention}.")
-        return
+#The !cards command lets players see their cards.
+@command("!cards", in_game=True)
+async def cards_command(message, work, args, game, user_id):
 
-    #If we haven't selected yet, that means we have multiple legal sets to choose from
-    if len(selected_cards) != 3:
-      scores = [] #for storing how good each set is
-      
-      #Calculating set scores
-      for legal_set in legal_sets:
-        score = 0
-        card_types = []
-
-        for card in legal_set:
-          if card[0] == "Wild": card_types.append("Wild")
-          elif card[1] in player["territories"]: card_types.append("Bonus")
-          else: card_types.append("Normal")
-        
-        #The criteria for the best set? 1. Set has a bonus card. 2. Set has a low number of wild cards. 3. Set has a low number of bonus cards.
-        if "Bonus" in card_types: score += 3
-        wilds = card_types.count("Wild")
-        if wilds:
-          if wilds == 1: score += 1
-        else: score += 2
-        if score == 5: score += card_types.count("Normal")
-
-        scores.append(score)
-      
-      selected_cards = legal_sets[scores.index(max(scores))]
-
-    bonus_territory = None
-    for card in selected_cards:
-      if not bonus_territory and card[1] in player["territories"]:
-        bonus_territory = card[1]
-      cards.remove(card)
-      game["discard_pile"].append(card)
-
-    #Success! Have some troops
-    try: new_troops = (4, 6, 8, 10, 12, 15)[game["trade_count"]]
-    except IndexError: new_troops = ((game["trade_count"]-2)*5) #20, 25, 30...
-    game["trade_count"] += 1
-    player["deployable_troops"] += new_troops
-    deployable_troops = player["deployable_troops"]
-    
-    #If a bonus card was traded in, drop two bonus troops on that territory
-    if bonus_territory: game["territories"][bonus_territory]["troops"] += 2
-
-    await message.channel.send(f"You've received {new_troops} extra troops and now have {deployable_troops} troops left to deploy." + (f" (Additionally, for trading in a card marked with {bonus_territory}, a territory you own, two extra troops were deployed to {bonus_territory}.)" if bonus_territory else ""))
-    if game["turn_stage"] == 0: game["turn_stage"] = 1
-    return
+  display = "Your cards:"
+  for card in game["players"][user_id]["cards"]:
+    territory_name = card[1]
+    if card[0] == "Infantry":
+      display += f"\n> [:military_helmet: - {territory_name}]"
+    elif card[0] == "Cavalry":
+      display += f"\n> [:horse: - {territory_name}]"
+    elif card[0] == "Artillery":
+      display += f"\n> [:boom: - {territory_name}]"
+    else:
+      display += "\n> [:military_helmet: - :horse: - :artillery: - Wild]"
 
+  await send(message.channel, display)
 
-  #Displays the game's map.
-  if command == "!map":
-    user_current_game_id = get_user_current_game_id(message.author)
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
-    await message.channel.send(file=discord.File(draw_map(db["games"][user_current_game_id]), "map.jpg"))
-    return
 
+#The !trade command lets players trade in their cards. Automatically selects the remaining cards if some or all of the cards are unspecified.
+@command("!trade", in_game=True)
+async def trade_command(message, work, args, game, user_id):
 
-  #Ends the player's turn.
-  if command == "!endturn":
+  #Card numbers start at 1, not 0
+  card_numbers = [parse_int(arg, "Invalid syntax; use numbers (no commas) to indicate which cards you're trading. (e.g. !trade 1 2 4)") for arg in args]
 
-    user_current_game_id = get_user_current_game_id(message.author)
+  result = events.apply(work, game, ["trade", user_id, card_numbers])
+  await work.commit()
 
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
+  bonus_territory = result.bonus_territory
+  await send(message.channel, f"You've received {result.new_troops} extra troops and now have {result.deployable_troops} troops left to deploy." + (f" (Additionally, for trading in a card marked with {bonus_territory}, a territory you own, two extra troops were deployed to {bonus_territory}.)" if bonus_territory else ""))
 
-    user_id = str(message.author.id)
-    game = db["games"][user_current_game_id]
-    player = game["players"][user_id]
 
-    if game["active_player"] != player["turn_number"]:
-      await message.channel.send(f"It's not your turn, {message.author.mention}.")
-      return
-    if game["turn_stage"] != 2:
-      troops = player["deployable_troops"]
-      await message.channel.send(f"You must first deploy all of your troops, {message.author.mention}. You still have {troops} left.")
-      return
+#Displays the game's map.
+@command("!map", in_game=True)
+async def map_command(message, work, args, game, user_id):
+  await send_map(message.channel, game)
 
-    start_message = generate_turn_start_message(game, begin_next_player_turn(game))
-    await message.channel.send(start_message)
-    await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-    return
 
+#Lists the last few things that happened in the player's game, 10 unless they ask for more.
+@command("!history", in_game=True)
+async def history_command(message, work, args, game, user_id):
 
-  if command == "!resign":
+  count = min(parse_int(args[0], "Use !history or !history <number of events>.") if args else 10, 50)
+  start = max(game["event_count"] - max(count, 1), 0)
+  log = await store.get_events(game["log"], start)
 
-    user_current_game_id = get_user_current_game_id(message.author)
+  lines = [f"Game {game['index']}:"]
+  lines += [f"`#{number}` " + describe_event(game, event) for number, event in enumerate(log, start)]
+  await send_lines(message.channel, lines, separator="\n")
 
-    if user_current_game_id == None:
-      await message.channel.send(f"You're not in a game, {message.author.mention}.")
-      return
 
-    user_id = str(message.author.id)
-    game = db["games"][user_current_game_id]
-    player = game["players"][user_id]
-
-    game["discard_pile"] += player["cards"]
-    player["cards"] = None
-    game["eliminated_players"].append(player["turn_number"])
-    
-    await message.channel.send(f"<@{user_id}> has resigned.")
-    if len(game["players"]) == len(game["eliminated_players"]) + 1:
-      winner_id = begin_next_player_turn(game)
-      await message.channel.send(f"\n\nVICTORY! <@{winner_id}> has conquered the world! (Or most of it, anyway.)")
-      await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
-      db["users"][user_id]["current_game_id"] = None
-      db["games"][game["index"]] = None
+#Ends the player's turn.
+@command("!endturn", in_game=True)
+async def endturn_command(message, work, args, game, user_id):
+
+  next_player_id = events.apply(work, game, ["endturn", user_id])
+  await work.commit()
+
+  await send(message.channel, generate_turn_start_message(game, next_player_id))
+  await send_map(message.channel, game)
+  check_ai_turn(game, message.channel)
+
+
+@command("!resign", in_game=True)
+async def resign_command(message, work, args, game, user_id):
+
+  #'!resign ai' hands your seat over to an AI instead of leaving it empty.
+  if args and args[0].lower() == "ai":
+    if len(humans_left(game)) == 1:
+      await send(message.channel, "You're the last person in this game; an AI would only be playing against itself. Use plain !resign to end it.")
       return
-      
-    elif game["active_player"] == player["turn_number"]:
-      start_message = generate_turn_start_message(game, begin_next_player_turn(game))
-      await message.channel.send(start_message)
-      await message.channel.send(file=discord.File(draw_map(game), "map.jpg"))
+    ai_id = ai.new_ai_id(game["players"].keys())
+    events.apply(work, game, ["handover", user_id, ai_id])
+    await set_user_current_game_id(work, user_id, None)
+    await work.commit()
+    await send(message.channel, f"<@{user_id}> has resigned, and {mention(game, ai_id)} has taken over their seat.")
+    check_ai_turn(game, message.channel)
     return
 
+  result = events.apply(work, game, ["resign", user_id])
+  await set_user_current_game_id(work, user_id, None)
+
+  if result.winner_id:
+    await close_game(work, game)
+    await send(message.channel, f"<@{user_id}> has resigned.")
+    await send(message.channel, f"\n\nVICTORY! {mention(game, result.winner_id)} has conquered the world! (Or most of it, anyway.)")
+    await send_map(message.channel, game)
+    return
 
+  #Nobody left but AIs? Then there's no one to play for.
+  if not humans_left(game):
+    await close_game(work, game)
+    await send(message.channel, f"<@{user_id}> has resigned. There's nobody left but the AIs in game {game['index']}, so they've called it a day.")
+    return
 
-keep_alive()
-client.run(os.environ['TOKEN'])
\ No newline at end of file
+  await work.commit()
+  await send(message.channel, f"<@{user_id}> has resigned.")
+  if result.next_player_id:
+    await send(message.channel, generate_turn_start_message(game, result.next_player_id))
+    await send_map(message.channel, game)
+    check_ai_turn(game, message.channel)
+
+
+#Only when run as the bot, so that other scripts (like loadtest.py) can import this without connecting to Discord.
+if __name__ == "__main__":
+  odds.load_table()
+  start_render_pool()
+  ai.start_ai_pool()
+  keep_alive()
+  client.run(os.environ['TOKEN'])
\ No newline at end of file
@@ -0,0 +1,119 @@
+from collections import defaultdict, deque
+import threading
+
+#Recent timings (in seconds) for everything we're keeping an eye on, e.g. each command and map rendering.
+#Only the last SAMPLE_SIZE of each are kept, which is plenty for percentiles and keeps memory flat.
+SAMPLE_SIZE = 1000
+samples = defaultdict(lambda: deque(maxlen=SAMPLE_SIZE))
+
+#Same idea, but for counts rather than timings, like the number of database writes each command makes.
+tallies = defaultdict(lambda: deque(maxlen=SAMPLE_SIZE))
+
+def record(name, value):
+  samples[name].append(value)
+
+def tally(name, value):
+  tallies[name].append(value)
+
+#Nearest-rank percentile, p being between 0 and 100.
+def percentile(values, p):
+  values = sorted(values)
+  if not values: return None
+  return values[min(len(values)-1, max(0, round(p/100 * len(values)) - 1))]
+
+#A little table of everything recorded so far, for the !admin stats command.
+def report():
+  lines = []
+  for name in sorted(samples.keys()):
+    values = samples[name]
+    lines.append(f"{name}: n={len(values)} p50={percentile(values, 50)*1000:.1f}ms p99={percentile(values, 99)*1000:.1f}ms")
+  for name in sorted(tallies.keys()):
+    values = tallies[name]
+    lines.append(f"{name}: n={len(values)} mean={sum(values)/len(values):.2f} max={max(values):g}")
+  return "\n".join(lines) if lines else "Nothing recorded yet."
+
+
+#The same sort of thing for Prometheus, which scrapes /metrics on the keep-alive server (see keep_alive.py).
+#Histograms, counters and gauges are kept per metric name and per set of labels, e.g. the command for command latency.
+#The web server reads them from its own thread, so everything that touches them holds metrics_lock.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTE_BUCKETS = (10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000)
+
+metrics_lock = threading.Lock()
+histograms = {} #name -> {labels: [bucket counts..., sum, count]}
+counters = defaultdict(lambda: defaultdict(float)) #name -> {labels: total}
+gauges = defaultdict(dict) #name -> {labels: value}
+buckets = {} #histogram name -> its buckets
+descriptions = {
+  "risk_command_seconds": "How long each command took, from the message arriving to the last reply.",
+  "risk_render_seconds": "How long getting a map took, whether it was drawn or came from the cache.",
+  "risk_render_bytes": "The size of each map image that was drawn.",
+  "risk_store_seconds": "How long each storage operation took, cache hits included.",
+  "risk_store_cache_total": "Storage cache lookups, by whether they hit.",
+  "risk_discord_send_seconds": "How long Discord took to take each message.",
+  "risk_outbox_wait_seconds": "How long messages waited in their channel's outbox before being sent.",
+  "risk_outbox_items_total": "Things sent to a channel, by whether they went out as a message, merged into another one, were superseded or failed to send.",
+  "risk_replay_failures_total": "Events that wouldn't replay when their game was loaded, so the game carried on from before them.",
+  "risk_event_loop_lag_seconds": "How late the event loop was to wake up a sleeping task.",
+  "risk_event_loop_lag_seconds_last": "The event loop's lag the last time it was measured.",
+  "risk_ai_move_seconds": "How long an AI took to decide on a move.",
+  "risk_lock_wait_seconds": "How long commands waited for a game's lock.",
+  "risk_games": "Games being played, by whether they're still being set up.",
+}
+
+def label_key(labels):
+  return tuple(sorted(labels.items()))
+
+def observe(name, value, bucket_bounds=LATENCY_BUCKETS, **labels):
+  with metrics_lock:
+    if name not in histograms:
+      histograms[name] = {}
+      buckets[name] = bucket_bounds
+    key = label_key(labels)
+    bounds = buckets[name]
+    if key not in histograms[name]:
+      histograms[name][key] = [0] * len(bounds) + [0.0, 0]
+    values = histograms[name][key]
+    for i, bound in enumerate(bounds):
+      if value <= bound: values[i] += 1
+    values[-2] += value
+    values[-1] += 1
+
+def count(name, amount=1, **labels):
+  with metrics_lock:
+    counters[name][label_key(labels)] += amount
+
+def set_gauge(name, value, **labels):
+  with metrics_lock:
+    gauges[name][label_key(labels)] = value
+
+def format_labels(labels, extra=()):
+  labels = list(labels) + list(extra)
+  if not labels: return ""
+  escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for name, value in labels)
+  return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+#Everything in Prometheus's text format.
+def exposition():
+  lines = []
+  def header(name, kind):
+    if name in descriptions: lines.append(f"# HELP {name} {descriptions[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+  with metrics_lock:
+    for name in sorted(histograms):
+      header(name, "histogram")
+      for labels, values in sorted(histograms[name].items()):
+        for bound, total in zip(buckets[name], values):
+          lines.append(f"{name}_bucket{format_labels(labels, [('le', f'{bound:g}')])} {total}")
+        lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {values[-2]:.9g}")
+        lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+    for name in sorted(counters):
+      header(name, "counter")
+      for labels, total in sorted(counters[name].items()):
+        lines.append(f"{name}{format_labels(labels)} {total:g}")
+    for name in sorted(gauges):
+      header(name, "gauge")
+      for labels, value in sorted(gauges[name].items()):
+        lines.append(f"{name}{format_labels(labels)} {value:.9g}")
+  return "\n".join(lines) + "\n"
@@ -0,0 +1,100 @@
+#The odds of winning a battle, worked out exactly rather than simulated.
+#A battle is a Markov chain over (attacking troops, defending troops): every round of dice moves it to a state with fewer
+#troops, with probabilities that only depend on how many dice each side throws. So the chance of winning from every state,
+#and how many troops each side can expect to have left at the end, can be filled in from the smallest states up.
+#The table is built once (python odds.py, or the first time the bot starts without one) and written to ODDS_PATH. After that
+#it's memory-mapped, so a query is a single indexed read, and every process using it shares the same pages.
+#Troop counts are what's on the map: the attacking territory always keeps one troop behind, so an attack from a territory
+#with 1 troop has already lost. The battle is fought to the end, like a !blitz without an until.
+from engine import resolve_dice
+import itertools
+import struct
+import array
+import mmap
+import os
+import sys
+
+ODDS_PATH = os.environ.get("ODDS_PATH", "odds.bin")
+ODDS_MAX = int(os.environ.get("ODDS_MAX", 300))
+
+#The file starts with a header, then three doubles per (attackers, defenders) state, attackers major:
+#the chance the attacker wins, then the troops the attacker and the defender can expect to have left.
+MAGIC = b"ODDS"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+FIELDS = 3
+
+table = None
+table_max = None
+
+#The chance of each (attackers lost, defenders lost) outcome when army_size dice go up against def_size dice.
+def transitions(army_size, def_size):
+  outcomes = {}
+  rolls = list(itertools.product(range(1, 7), repeat=army_size + def_size))
+  for roll in rolls:
+    off_dice = sorted(roll[:army_size], reverse=True)
+    def_dice = sorted(roll[army_size:], reverse=True)
+    losses = resolve_dice(off_dice, def_dice)
+    outcomes[losses] = outcomes.get(losses, 0) + 1
+  return [(off_dead, def_dead, count / len(rolls)) for (off_dead, def_dead), count in outcomes.items()]
+
+def build_table(max_troops=ODDS_MAX):
+  size = max_troops + 1
+  values = array.array("d", bytes(8 * FIELDS * size * size))
+  chances = {(army_size, def_size):transitions(army_size, def_size) for army_size in (1, 2, 3) for def_size in (1, 2)}
+
+  for attackers in range(0, size):
+    for defenders in range(0, size):
+      i = (attackers * size + defenders) * FIELDS
+      if defenders == 0: #Nobody left to defend; the attacker has won.
+        values[i:i+FIELDS] = array.array("d", (1.0, attackers, 0))
+      elif attackers <= 1: #Nobody left to attack with.
+        values[i:i+FIELDS] = array.array("d", (0.0, attackers, defenders))
+      else:
+        win = off_left = def_left = 0.0
+        for off_dead, def_dead, chance in chances[(min(3, attackers - 1), min(2, defenders))]:
+          j = ((attackers - off_dead) * size + defenders - def_dead) * FIELDS
+          win += chance * values[j]
+          off_left += chance * values[j+1]
+          def_left += chance * values[j+2]
+        values[i:i+FIELDS] = array.array("d", (win, off_left, def_left))
+
+  return values
+
+def write_table(path=ODDS_PATH, max_troops=ODDS_MAX):
+  values = build_table(max_troops)
+  with open(path + ".tmp", "wb") as file:
+    file.write(HEADER.pack(MAGIC, VERSION, max_troops))
+    values.tofile(file)
+  os.replace(path + ".tmp", path) #So nothing ever maps a half-written table.
+
+#Maps the table into memory, building it first if it's missing or out of date.
+def load_table(path=ODDS_PATH, max_troops=ODDS_MAX):
+  global table, table_max
+  try:
+    with open(path, "rb") as file:
+      magic, version, stored_max = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or stored_max != max_troops: raise ValueError
+  except (OSError, ValueError, struct.error):
+    write_table(path, max_troops)
+    stored_max = max_troops
+
+  with open(path, "rb") as file:
+    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  table = memoryview(mapped)[HEADER.size:].cast("d")
+  table_max = stored_max
+  return table
+
+#Returns (chance of winning, expected attackers left, expected defenders left), or None if it's off the table.
+def lookup(attackers, defenders):
+  if table is None: load_table()
+  if not (0 <= attackers <= table_max and 0 <= defenders <= table_max):
+    return None
+  i = (attackers * (table_max + 1) + defenders) * FIELDS
+  return table[i], table[i+1], table[i+2]
+
+
+if __name__ == "__main__":
+  max_troops = int(sys.argv[1]) if len(sys.argv) > 1 else ODDS_MAX
+  write_table(ODDS_PATH, max_troops)
+  print(f"Wrote the odds for up to {max_troops} troops a side to {ODDS_PATH}.")
@@ -0,0 +1,190 @@
+#Everything the bot says goes out through an outbox per channel, which sends it in as few messages as it can.
+#A command usually says two or three things (what happened, whose turn it is now, the map), and every message is a
+#request that counts against Discord's rate limits: 5 messages per channel every 5 seconds, and 50 requests a second
+#for the whole bot. So:
+#  - Whatever a command sends is held until it's finished (see batch), then queued on its channel all at once.
+#  - Each channel's queue is sent by its own worker, which waits until there's room in the channel's bucket and the
+#    global one, then sends as much of the queue as fits in one message: texts joined up to 2000 characters, and the
+#    attachment that follows them. The longer it has to wait, the more piles up to go out together.
+#  - A map that's still waiting when a newer map of the same game is queued is dropped, since nobody needs the old one.
+#discord.py still does its own rate limiting underneath, and retries if it gets told off anyway; the buckets here keep it
+#from coming to that, and make the waiting happen where messages can be merged.
+#The limits are CHANNEL_RATE_LIMIT messages per CHANNEL_RATE_PERIOD seconds and GLOBAL_RATE_LIMIT per GLOBAL_RATE_PERIOD;
+#a limit of 0 turns that bucket off.
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncio
+import metrics
+import os
+import time
+import traceback
+import tracing
+
+MESSAGE_LIMIT = 2000
+SEPARATOR = "\n\n"
+CHANNEL_RATE_LIMIT = int(os.environ.get("CHANNEL_RATE_LIMIT", 5))
+CHANNEL_RATE_PERIOD = float(os.environ.get("CHANNEL_RATE_PERIOD", 5))
+GLOBAL_RATE_LIMIT = int(os.environ.get("GLOBAL_RATE_LIMIT", 50))
+GLOBAL_RATE_PERIOD = float(os.environ.get("GLOBAL_RATE_PERIOD", 1))
+
+#At most limit sends in any period seconds.
+class Bucket:
+
+  def __init__(self, limit, period):
+    self.limit = limit
+    self.period = period
+    self.sent = deque() #when each send in the last period happened
+
+  #How long until there's room for another send (0 if there's room now).
+  def wait_time(self, now):
+    if not self.limit: return 0
+    while self.sent and self.sent[0] <= now - self.period:
+      self.sent.popleft()
+    return 0 if len(self.sent) < self.limit else self.sent[0] + self.period - now
+
+  def take(self, now):
+    if self.limit: self.sent.append(now)
+
+global_bucket = Bucket(GLOBAL_RATE_LIMIT, GLOBAL_RATE_PERIOD)
+
+#Something to send: some text, keyword arguments for channel.send (a file, say), or both. A newer item with the same key
+#supersedes it, and an item that's alone is sent as a message of its own. done gets the message it went out in, or None
+#if it was dropped.
+class Item:
+
+  def __init__(self, content, kwargs, key, alone=False):
+    self.content = content
+    self.kwargs = kwargs
+    self.key = key
+    self.alone = alone
+    self.queued = time.perf_counter()
+    self.done = asyncio.get_running_loop().create_future()
+
+def drop_superseded(items, key):
+  for item in [item for item in items if item.key == key]:
+    items.remove(item)
+    item.done.set_result(None)
+    metrics.count("risk_outbox_items_total", result="superseded")
+
+#Takes as much off the front of the queue as goes in one message. Returns the items, the text and the other arguments.
+def take_message(queue):
+  items = []
+  texts = []
+  kwargs = {}
+  while queue and not kwargs and not (items and items[0].alone):
+    item = queue[0]
+    if items and item.alone:
+      break
+    if texts and item.content is not None and len(SEPARATOR.join(texts + [item.content])) > MESSAGE_LIMIT:
+      break
+    items.append(queue.popleft())
+    if item.content is not None: texts.append(item.content)
+    kwargs = item.kwargs
+  return items, SEPARATOR.join(texts) if texts else None, kwargs
+
+
+class Outbox:
+
+  def __init__(self, channel):
+    self.channel = channel
+    self.queue = deque()
+    self.bucket = Bucket(CHANNEL_RATE_LIMIT, CHANNEL_RATE_PERIOD)
+    self.worker = None
+
+  def put(self, items):
+    for item in items:
+      if item.key is not None: drop_superseded(self.queue, item.key)
+      self.queue.append(item)
+    if self.worker is None and self.queue:
+      #The worker sends for everyone, so it shouldn't be part of the trace of whichever command happened to start it.
+      with tracing.trace(None):
+        self.worker = asyncio.get_running_loop().create_task(self.run())
+
+  async def run(self):
+    try:
+      while self.queue:
+        now = time.monotonic()
+        wait = max(self.bucket.wait_time(now), global_bucket.wait_time(now))
+        if wait:
+          await asyncio.sleep(wait)
+          continue
+        self.bucket.take(now)
+        global_bucket.take(now)
+        await self.send(*take_message(self.queue))
+    finally:
+      self.worker = None
+
+  async def send(self, items, content, kwargs):
+    start = time.perf_counter()
+    metrics.observe("risk_outbox_wait_seconds", start - items[0].queued)
+    try:
+      message = await self.channel.send(content, **kwargs)
+    except Exception as error:
+      metrics.count("risk_outbox_items_total", len(items), result="failed")
+      for item in items:
+        item.done.set_exception(error)
+      return
+    finally:
+      metrics.observe("risk_discord_send_seconds", time.perf_counter() - start, kind="file" if "file" in kwargs else "text")
+    metrics.count("risk_outbox_items_total", result="sent")
+    metrics.count("risk_outbox_items_total", len(items) - 1, result="merged")
+    for item in items:
+      item.done.set_result(message)
+
+#Every channel that's been sent to. They're tiny once their queue is empty.
+outboxes = {}
+
+def outbox_for(channel):
+  if channel not in outboxes:
+    outboxes[channel] = Outbox(channel)
+  return outboxes[channel]
+
+
+#What a command has sent so far, by channel. It's closed once the command's finished, so tasks the command started (which
+#inherit it) go back to sending straight away.
+class Batch:
+
+  def __init__(self):
+    self.items = {}
+    self.open = True
+
+  def add(self, channel, item):
+    items = self.items.setdefault(channel, [])
+    if item.key is not None: drop_superseded(items, item.key)
+    items.append(item)
+
+current = ContextVar("batch", default=None)
+
+#Holds back everything sent inside it until the end, then queues it and waits for it all to be delivered. The waiting is
+#the send span of the trace. By then the command has done (and saved) what it did, so a message that doesn't get through
+#is only reported, not raised; everything merged into one message fails together, so each failure is reported once.
+@asynccontextmanager
+async def batch():
+  collecting = Batch()
+  token = current.set(collecting)
+  try:
+    yield
+  finally:
+    current.reset(token)
+    collecting.open = False
+    for channel, items in collecting.items.items():
+      outbox_for(channel).put(items)
+  with tracing.span("send"):
+    results = await asyncio.gather(*(item.done for items in collecting.items.values() for item in items),
+                                   return_exceptions=True)
+  for error in {id(result):result for result in results if isinstance(result, Exception)}.values():
+    print("Couldn't send a message:")
+    traceback.print_exception(error)
+
+#Sends to a channel through its outbox. Inside a batch this just adds to the batch and returns None; otherwise it waits
+#until it's been sent and returns the message it went out in (None if it was superseded). With alone, it's sent exactly
+#as it is, never merged with anything else.
+async def send(channel, content=None, key=None, alone=False, **kwargs):
+  item = Item(content, kwargs, key, alone)
+  collecting = current.get()
+  if collecting is not None and collecting.open:
+    collecting.add(channel, item)
+    return None
+  outbox_for(channel).put([item])
+  return await item.done
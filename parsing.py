@@ -0,0 +1,131 @@
+#Turning what players type into commands, arguments and territory names.
+#Territory names go through an index built from territories.txt when the bot starts. The index holds each name in a
+#normalized form (lowercase, punctuation gone) plus aliases and abbreviations, so "western us", "E. Africa" and "nwt" are
+#all a single dict lookup. Anything that's still not found gets matched against the full names and aliases (never the
+#abbreviations, which are so short that a typo of one is usually another one: "e aus" isn't Eastern US) allowing for a
+#typo or two.
+from functools import lru_cache
+from itertools import product
+from rules import territory_names
+from tracing import traced
+import re
+
+class ParseError(Exception):
+  pass
+
+#Splits a message into its command and the words after it.
+def tokenize(content):
+  tokens = content.split()
+  if not tokens: return None, []
+  return tokens[0].lower(), tokens[1:]
+
+#Splits the words after a command into clauses started by keywords, e.g. ["Siam", "from", "Indonesia", "with", "2"] with
+#the keywords ("from", "with") gives {None: "Siam", "from": "Indonesia", "with": "2"}. Keywords that don't appear are left
+#out; a keyword that appears twice or starts an empty clause raises a ParseError with the given usage message.
+@traced("parse")
+def parse_clauses(args, keywords, usage):
+  clauses = {}
+  keyword = None
+  words = []
+  for arg in args + [None]:
+    if arg is None or arg.lower() in keywords:
+      if keyword in clauses or (keyword is not None and not words): raise ParseError(usage)
+      if words: clauses[keyword] = " ".join(words)
+      keyword = arg.lower() if arg else None
+      words = []
+    else:
+      words.append(arg)
+  return clauses
+
+@traced("parse")
+def parse_int(text, usage):
+  try: return int(text)
+  except (TypeError, ValueError): raise ParseError(usage)
+
+
+def normalize(text):
+  return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+#Words that often get shortened, and what to.
+SHORT_WORDS = {"north":["n"], "northern":["n", "north"], "south":["s"], "southern":["s", "south"], "east":["e"],
+               "eastern":["e", "east"], "west":["w"], "western":["w", "west"], "great":["gt"]}
+SHORT_PHRASES = {"united states":["us", "usa"]}
+
+#Anything else people call a territory.
+ALIASES = {"nw territory":"North West Territory", "northwest territory":"North West Territory", "britain":"Great Britain",
+           "uk":"Great Britain", "papua new guinea":"New Guinea", "png":"New Guinea"}
+
+#Every way of writing a name that the index should know.
+def name_variants(name):
+  text = normalize(name)
+  for phrase, shortenings in SHORT_PHRASES.items():
+    if phrase in text:
+      yield from (variant for shortening in shortenings for variant in name_variants(text.replace(phrase, shortening)))
+  words = text.split()
+  for choice in product(*([word] + SHORT_WORDS.get(word, []) for word in words)):
+    yield " ".join(choice)
+  if len(words) > 1:
+    yield "".join(word[0] for word in words) #Initials, like nwt
+
+#normalized text -> the names it could mean. Most keys mean just one territory; the rest (like "ea") are ambiguous.
+territory_index = {}
+for name in territory_names:
+  for variant in set(name_variants(name)):
+    territory_index.setdefault(variant, [])
+    if name not in territory_index[variant]: territory_index[variant].append(name)
+for alias, name in ALIASES.items():
+  territory_index[normalize(alias)] = [name]
+#A full name always wins over someone else's abbreviation.
+for name in territory_names:
+  territory_index[normalize(name)] = [name]
+
+#What's too short to guess at isn't worth forgiving typos in.
+TYPO_MIN_LENGTH = 4
+
+#normalized full name or alias -> the name, for matching typos against.
+typo_index = {normalize(name):name for name in territory_names}
+typo_index.update((normalize(alias), name) for alias, name in ALIASES.items() if len(normalize(alias)) >= TYPO_MIN_LENGTH)
+
+#Levenshtein distance, giving up (and returning limit + 1) as soon as it's clear it'll be over the limit.
+def edit_distance(a, b, limit):
+  if abs(len(a) - len(b)) > limit: return limit + 1
+  previous = list(range(len(b) + 1))
+  for i, char_a in enumerate(a, 1):
+    current = [i]
+    for j, char_b in enumerate(b, 1):
+      current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (char_a != char_b)))
+    if min(current) > limit: return limit + 1
+    previous = current
+  return previous[-1]
+
+#How many typos to forgive in a name of the given length.
+def typo_limit(length):
+  return 0 if length < TYPO_MIN_LENGTH else 1 if length < 6 else 2
+
+#Returns the names text could mean: one for a hit, several if it's ambiguous, none if nothing's close.
+@lru_cache(maxsize=1024)
+def find_territories(text):
+  key = normalize(text)
+  if key in territory_index:
+    return tuple(territory_index[key])
+  limit = typo_limit(len(key.replace(" ", ""))) #Letters only, so "s am" is too short for a typo to be forgiven.
+  if not limit: return ()
+  best_distance, matches = limit + 1, []
+  for variant, name in typo_index.items():
+    distance = edit_distance(key, variant, min(limit, best_distance))
+    if distance > limit: continue
+    if distance < best_distance:
+      best_distance, matches = distance, []
+    if distance == best_distance and name not in matches:
+      matches.append(name)
+  return tuple(matches)
+
+#Resolves what a player typed to a territory name, or raises a ParseError saying why it couldn't.
+@traced("parse")
+def territory(text):
+  matches = find_territories(text)
+  if len(matches) == 1:
+    return matches[0]
+  if not matches:
+    raise ParseError(f"Couldn't find the territory '{text}'.")
+  raise ParseError(f"'{text}' could be " + ", ".join(matches[:-1]) + f" or {matches[-1]}. Which one did you mean?")
@@ -0,0 +1,81 @@
+#A sampling profiler, for finding out what the bot is up to when it's slow (see !admin profile).
+#While it's running, a background thread looks at every other thread's stack PROFILE_INTERVAL seconds apart and counts
+#how often it saw each one. When it stops, the counts are written out as folded stacks ("thread;outer;inner count", one
+#stack per line), which flamegraph.pl, speedscope and friends all read. When it isn't running it costs nothing at all.
+from collections import Counter
+import datetime
+import os
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+class SamplingProfiler:
+
+  def __init__(self, seconds, interval=PROFILE_INTERVAL):
+    self.seconds = seconds
+    self.interval = interval
+    self.counts = Counter()
+    self.samples = 0
+    self.stopping = threading.Event()
+    self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+    self.path = None
+
+  def start(self):
+    self.thread.start()
+
+  #Stops early if it's still going, and waits for the file to be written. Returns its path.
+  def stop(self):
+    self.stopping.set()
+    self.thread.join()
+    return self.path
+
+  def running(self):
+    return self.thread.is_alive()
+
+  def run(self):
+    deadline = time.perf_counter() + self.seconds
+    while not self.stopping.wait(self.interval) and time.perf_counter() < deadline:
+      self.sample()
+    self.path = self.write()
+
+  def sample(self):
+    names = {thread.ident:thread.name for thread in threading.enumerate()}
+    for thread_id, frame in sys._current_frames().items():
+      if thread_id == threading.get_ident(): continue
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+      stack.append(names.get(thread_id, str(thread_id)))
+      self.counts[";".join(reversed(stack))] += 1
+    self.samples += 1
+
+  def write(self):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, datetime.datetime.now().strftime("profile-%Y%m%d-%H%M%S.folded"))
+    with open(path, "w") as file:
+      for stack, count in self.counts.most_common():
+        file.write(f"{stack} {count}\n")
+    return path
+
+
+#The profiler that's running (or last ran), if any.
+profiler = None
+
+#Starts profiling for up to seconds. Returns False if a profile is already being taken.
+def start(seconds):
+  global profiler
+  if profiler and profiler.running():
+    return False
+  profiler = SamplingProfiler(seconds)
+  profiler.start()
+  return True
+
+#Stops profiling. Returns the finished profiler (with its path and sample count), or None if there's never been one.
+def stop():
+  if profiler: profiler.stop()
+  return profiler
@@ -0,0 +1,80 @@
+#The board and the rules that only depend on the board.
+#Every territory gets an integer index (its position in territories.txt), and any set of territories can then be stored
+#as a bitmask with bit i set if territory i is in the set. A territory's neighbours and each continent are masks, and a
+#player's holdings (still a list in the game) are turned into one with mask_of when they're needed, so checking adjacency
+#or continent ownership is a single AND instead of a walk through lists.
+
+from boards import get_board
+from functools import lru_cache
+import os
+
+#The board every game is played on (see boards.py). Games saved on one board can't be loaded on another, since they
+#only store territories by index.
+BOARD = os.environ.get("BOARD", "classic")
+board = get_board(BOARD)
+
+#Shorthands for the parts of the board that get used everywhere. They're the board's own read-only tuples and mappings.
+continents = board.continents
+neighbours = board.neighbours
+territory_names = board.territory_names
+territory_index = board.territory_index
+ALL_TERRITORIES = (1 << len(territory_names)) - 1
+
+def mask_of(names):
+  mask = 0
+  for name in names:
+    mask |= 1 << territory_index[name]
+  return mask
+
+def names_of(mask):
+  return [name for i, name in enumerate(territory_names) if mask >> i & 1]
+
+def count(mask):
+  return bin(mask).count("1")
+
+neighbour_masks = [mask_of(neighbours[name]) for name in territory_names]
+continent_masks = [(mask_of(continent.territories), continent.bonus) for continent in continents]
+
+def is_adjacent(a, b):
+  return neighbour_masks[territory_index[a]] >> territory_index[b] & 1 == 1
+
+#The troops a player with these territories receives at the start of their turn.
+def new_troops_for(mask):
+
+  #The number of territories you occupy.
+  new_troops = count(mask) // 3
+  if new_troops < 3: new_troops = 3
+
+  #The value of the continents you control.
+  for continent_mask, bonus in continent_masks:
+    if mask & continent_mask == continent_mask:
+      new_troops += bonus
+
+  return new_troops
+
+#Splits a set of territories into the groups that are connected through each other, as masks. It's cached on the mask,
+#so a player's groups are only worked out again once they've actually gained or lost a territory.
+@lru_cache(maxsize=1024)
+def components(mask):
+  groups = []
+  left = mask
+  while left:
+    group = frontier = left & -left
+    while frontier:
+      reached = 0
+      while frontier:
+        bit = frontier & -frontier
+        reached |= neighbour_masks[bit.bit_length() - 1]
+        frontier ^= bit
+      frontier = reached & left & ~group
+      group |= frontier
+    groups.append(group)
+    left &= ~group
+  return tuple(groups)
+
+#The group within mask that the named territory belongs to (0 if it isn't in mask at all).
+def component_of(mask, name):
+  bit = 1 << territory_index[name]
+  for group in components(mask):
+    if group & bit: return group
+  return 0
@@ -0,0 +1,582 @@
+from boards import as_territories
+from collections import OrderedDict
+from rules import board
+from urllib.parse import quote, unquote
+from tracing import traced
+import asyncio
+import aiohttp
+import base64
+import codec
+import events
+import json
+import metrics
+import os
+import sqlite3
+import time
+import traceback
+
+#Where games and users are kept. Every backend hands out plain dicts and lists (decoded from JSON, so tuples come back as
+#lists), and nothing is saved until put_game/put_user is called with the changed object.
+#Games are keyed by their integer id, users by their Discord id as a string. Everything is a coroutine so that a slow
+#backend never holds up the event loop.
+#Each game also has an event log (see events.py), keyed by the game's log id. The stored game is only a snapshot, and
+#whatever's happened since is in the log's trailing events.
+#Games are saved packed with codec.py; games saved before that are JSON, and still load.
+class Storage:
+
+  async def get_game(self, game_id):
+    raise NotImplementedError
+
+  async def put_game(self, game_id, game):
+    raise NotImplementedError
+
+  async def delete_game(self, game_id):
+    raise NotImplementedError
+
+  #The ids of every game currently being played.
+  async def game_ids(self):
+    raise NotImplementedError
+
+  async def get_user(self, user_id):
+    raise NotImplementedError
+
+  async def put_user(self, user_id, user):
+    raise NotImplementedError
+
+  #Every user the store knows about, as a dict keyed by user id. Only used at startup.
+  async def all_users(self):
+    raise NotImplementedError
+
+  #The events of a log from event number start on, in order.
+  async def get_events(self, log_id, start=0):
+    raise NotImplementedError
+
+  #Stores events as event numbers start, start + 1 and so on of a log.
+  async def append_events(self, log_id, start, new_events):
+    raise NotImplementedError
+
+  async def clear(self):
+    raise NotImplementedError
+
+  #Several users at once. Backends with a network round trip per request fetch them side by side.
+  async def get_users(self, user_ids):
+    return [await self.get_user(user_id) for user_id in user_ids]
+
+  #Everything a command changed, in one go. Backends that can batch writes do it here.
+  #logs maps log ids to (number of the first new event, new events).
+  async def write(self, games, users, deleted_games, logs={}):
+    for log_id, (start, new_events) in logs.items():
+      await self.append_events(log_id, start, new_events)
+    for game_id, game in games.items():
+      await self.put_game(game_id, game)
+    for game_id in deleted_games:
+      await self.delete_game(game_id)
+    for user_id, user in users.items():
+      await self.put_user(user_id, user)
+
+
+#How a backend keeps an object: games as codec.py's bytes, everything else (and games from before there was a codec) as
+#JSON text.
+def dumps(value, is_game=False):
+  return codec.encode(value) if is_game and value is not None else json.dumps(value)
+
+def loads(data):
+  return codec.decode(data) if isinstance(data, bytes) else json.loads(data)
+
+
+#Keeps everything in a dict. Objects are stored as JSON so that, like with the real backends, changing a game you got
+#from get_game doesn't change what's stored until you put it back.
+class MemoryStorage(Storage):
+
+  def __init__(self):
+    self.games = {}
+    self.users = {}
+    self.events = {}
+
+  async def get_game(self, game_id):
+    data = self.games.get(game_id)
+    return loads(data) if data else None
+
+  async def put_game(self, game_id, game):
+    self.games[game_id] = dumps(game, is_game=True)
+
+  async def delete_game(self, game_id):
+    self.games.pop(game_id, None)
+
+  async def game_ids(self):
+    return sorted(self.games.keys())
+
+  async def get_user(self, user_id):
+    data = self.users.get(user_id)
+    return json.loads(data) if data else None
+
+  async def put_user(self, user_id, user):
+    self.users[user_id] = json.dumps(user)
+
+  async def all_users(self):
+    return {user_id:json.loads(data) for user_id, data in self.users.items()}
+
+  async def get_events(self, log_id, start=0):
+    return [json.loads(data) for data in self.events.get(log_id, [])[start:]]
+
+  async def append_events(self, log_id, start, new_events):
+    self.events.setdefault(log_id, [])[start:] = [json.dumps(event) for event in new_events]
+
+  async def clear(self):
+    self.games.clear()
+    self.users.clear()
+    self.events.clear()
+
+
+#A local SQLite file with one row per game (a blob, or text for older games), one row per user and one row per event.
+#WAL mode lets reads carry on while a write is happening.
+#Queries run right on the event loop: they're local disk lookups by primary key, which take microseconds.
+class SQLiteStorage(Storage):
+
+  def __init__(self, path="risk.db"):
+    self.connection = sqlite3.connect(path, isolation_level=None)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS games (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS events (log INTEGER, seq INTEGER, data TEXT NOT NULL, PRIMARY KEY (log, seq)) WITHOUT ROWID")
+
+  async def get_game(self, game_id):
+    row = self.connection.execute("SELECT data FROM games WHERE id = ?", (game_id,)).fetchone()
+    return loads(row[0]) if row else None
+
+  async def put_game(self, game_id, game):
+    self.connection.execute("INSERT OR REPLACE INTO games (id, data) VALUES (?, ?)", (game_id, dumps(game, is_game=True)))
+
+  async def delete_game(self, game_id):
+    self.connection.execute("DELETE FROM games WHERE id = ?", (game_id,))
+
+  async def game_ids(self):
+    return [row[0] for row in self.connection.execute("SELECT id FROM games ORDER BY id")]
+
+  async def get_user(self, user_id):
+    row = self.connection.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  async def put_user(self, user_id, user):
+    self.connection.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (user_id, json.dumps(user)))
+
+  async def all_users(self):
+    return {row[0]:json.loads(row[1]) for row in self.connection.execute("SELECT id, data FROM users")}
+
+  async def get_events(self, log_id, start=0):
+    return [json.loads(row[0]) for row in
+            self.connection.execute("SELECT data FROM events WHERE log = ? AND seq >= ? ORDER BY seq", (log_id, start))]
+
+  async def append_events(self, log_id, start, new_events):
+    self.connection.executemany("INSERT OR REPLACE INTO events (log, seq, data) VALUES (?, ?, ?)",
+                                [(log_id, seq, json.dumps(event)) for seq, event in enumerate(new_events, start)])
+
+  #All of a command's writes go in a single transaction.
+  async def write(self, games, users, deleted_games, logs={}):
+    with self.connection:
+      self.connection.execute("BEGIN")
+      for log_id, (start, new_events) in logs.items():
+        await self.append_events(log_id, start, new_events)
+      self.connection.executemany("INSERT OR REPLACE INTO games (id, data) VALUES (?, ?)", [(game_id, dumps(game, is_game=True)) for game_id, game in games.items()])
+      self.connection.executemany("DELETE FROM games WHERE id = ?", [(game_id,) for game_id in deleted_games])
+      self.connection.executemany("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", [(user_id, json.dumps(user)) for user_id, user in users.items()])
+
+  async def clear(self):
+    self.connection.execute("DELETE FROM games")
+    self.connection.execute("DELETE FROM users")
+    self.connection.execute("DELETE FROM events")
+
+
+#Replit's key-value database, spoken to directly over its HTTP API (GET/DELETE /key, POST key=value, GET ?prefix=) from a
+#single pooled, keep-alive aiohttp session. Each game, user and event gets its own key ("game:12", "user:1234", "event:5678:3").
+#All the writes of one command go out as a single POST, and multi-key reads are sent side by side.
+#REPLIT_DB_URL points at the database; kv_server.py is a local stand-in for it.
+class ReplitStorage(Storage):
+
+  def __init__(self, url=None, connections=None):
+    self.url = (url or os.environ["REPLIT_DB_URL"]).rstrip("/")
+    self.connections = connections or int(os.environ.get("STORAGE_CONNECTIONS", 8))
+    self.session = None
+
+  async def request(self, method, key=None, **kwargs):
+    if self.session is None:
+      self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60),
+                                           timeout=aiohttp.ClientTimeout(total=10))
+      await self.migrate()
+    url = self.url + ("/" + quote(key, safe="") if key else "")
+    async with self.session.request(method, url, **kwargs) as response:
+      if response.status == 404:
+        return None
+      response.raise_for_status()
+      return await response.text()
+
+  async def get_json(self, key):
+    text = await self.request("GET", key)
+    return json.loads(text) if text else None
+
+  async def keys(self, prefix):
+    text = await self.request("GET", params={"prefix":prefix, "encode":"true"})
+    return [unquote(key) for key in text.split("\n") if key] if text else []
+
+  async def set_many(self, values):
+    if values:
+      await self.request("POST", data={key:json.dumps(value) for key, value in values.items()})
+
+  #Older versions of the bot kept every game in one "games" list and every user in one "users" dict. Those get split
+  #up into a key each the first time we connect.
+  async def migrate(self):
+    games = await self.get_json("games")
+    users = await self.get_json("users")
+    values = {f"game:{game_id}":game for game_id, game in enumerate(games or []) if game is not None}
+    values.update({f"user:{user_id}":user for user_id, user in (users or {}).items()})
+    await self.set_many(values)
+    if games is not None: await self.request("DELETE", "games")
+    if users is not None: await self.request("DELETE", "users")
+
+  #Values are text, so games are kept as base64 of their encoding. Games from before that are JSON objects.
+  async def get_game(self, game_id):
+    game = await self.get_json(f"game:{game_id}")
+    return codec.decode(base64.b64decode(game)) if isinstance(game, str) else game
+
+  async def put_game(self, game_id, game):
+    await self.set_many({f"game:{game_id}":base64.b64encode(codec.encode(game)).decode()})
+
+  async def delete_game(self, game_id):
+    await self.request("DELETE", f"game:{game_id}")
+
+  async def game_ids(self):
+    return sorted(int(key[5:]) for key in await self.keys("game:"))
+
+  async def get_user(self, user_id):
+    return await self.get_json(f"user:{user_id}")
+
+  async def get_users(self, user_ids):
+    return await asyncio.gather(*[self.get_user(user_id) for user_id in user_ids])
+
+  async def put_user(self, user_id, user):
+    await self.set_many({f"user:{user_id}":user})
+
+  async def all_users(self):
+    user_ids = [key[5:] for key in await self.keys("user:")]
+    return dict(zip(user_ids, await self.get_users(user_ids)))
+
+  async def get_events(self, log_id, start=0):
+    prefix = f"event:{log_id}:"
+    seqs = sorted(seq for seq in (int(key[len(prefix):]) for key in await self.keys(prefix)) if seq >= start)
+    return await asyncio.gather(*[self.get_json(f"{prefix}{seq}") for seq in seqs])
+
+  async def append_events(self, log_id, start, new_events):
+    await self.set_many({f"event:{log_id}:{seq}":event for seq, event in enumerate(new_events, start)})
+
+  async def write(self, games, users, deleted_games, logs={}):
+    values = {f"event:{log_id}:{seq}":event for log_id, (start, new_events) in logs.items()
+              for seq, event in enumerate(new_events, start)}
+    values.update({f"game:{game_id}":base64.b64encode(codec.encode(game)).decode() for game_id, game in games.items()})
+    values.update({f"user:{user_id}":user for user_id, user in users.items()})
+    await asyncio.gather(self.set_many(values), *[self.delete_game(game_id) for game_id in deleted_games])
+
+  async def clear(self):
+    keys = await self.keys("game:") + await self.keys("user:") + await self.keys("event:")
+    await asyncio.gather(*[self.request("DELETE", key) for key in keys])
+
+
+#Sits in front of another backend and keeps the most recently used games, users and event logs in memory, so a game
+#that's being played doesn't need a round trip on every command. Writes go through to the backend before the cache is
+#updated, and deletes drop the entry, so the cache never holds anything the backend doesn't. This assumes the bot is the
+#only thing writing to the backend.
+class CachedStorage(Storage):
+
+  def __init__(self, backend, max_entries=None):
+    self.backend = backend
+    self.max_entries = max_entries or int(os.environ.get("STORAGE_CACHE_SIZE", 1000))
+    self.cache = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  #Entries are kept encoded (see dumps) so that every read hands out a fresh copy.
+  def remember(self, key, value):
+    self.cache[key] = dumps(value, is_game=key[0] == "game")
+    self.cache.move_to_end(key)
+    while len(self.cache) > self.max_entries:
+      self.cache.popitem(last=False)
+
+  async def read_through(self, key, load):
+    if key in self.cache:
+      self.hits += 1
+      metrics.count("risk_store_cache_total", result="hit")
+      self.cache.move_to_end(key)
+      return loads(self.cache[key])
+    self.misses += 1
+    metrics.count("risk_store_cache_total", result="miss")
+    value = await load()
+    self.remember(key, value)
+    return value
+
+  async def get_game(self, game_id):
+    return await self.read_through(("game", game_id), lambda: self.backend.get_game(game_id))
+
+  async def put_game(self, game_id, game):
+    await self.backend.put_game(game_id, game)
+    self.remember(("game", game_id), game)
+
+  async def delete_game(self, game_id):
+    self.cache.pop(("game", game_id), None)
+    await self.backend.delete_game(game_id)
+
+  async def game_ids(self):
+    return await self.backend.game_ids()
+
+  async def get_user(self, user_id):
+    return await self.read_through(("user", user_id), lambda: self.backend.get_user(user_id))
+
+  async def get_users(self, user_ids):
+    missing = [user_id for user_id in user_ids if ("user", user_id) not in self.cache]
+    if missing:
+      for user_id, user in zip(missing, await self.backend.get_users(missing)):
+        self.remember(("user", user_id), user)
+    return [await self.get_user(user_id) for user_id in user_ids]
+
+  async def put_user(self, user_id, user):
+    await self.backend.put_user(user_id, user)
+    self.remember(("user", user_id), user)
+
+  async def all_users(self):
+    return await self.backend.all_users()
+
+  #A log is cached as (number of its first cached event, the events from there on), which is enough for any later read.
+  async def get_events(self, log_id, start=0):
+    key = ("events", log_id)
+    if key in self.cache:
+      cached_start, cached_events = json.loads(self.cache[key])
+      if cached_start <= start:
+        self.hits += 1
+        metrics.count("risk_store_cache_total", result="hit")
+        self.cache.move_to_end(key)
+        return cached_events[start - cached_start:]
+    self.misses += 1
+    metrics.count("risk_store_cache_total", result="miss")
+    log = await self.backend.get_events(log_id, start)
+    self.remember(key, (start, log))
+    return log
+
+  #Adds new events to a cached log, dropping any from before keep_from (where the game's latest snapshot picks up).
+  def remember_events(self, log_id, start, new_events, keep_from=0):
+    key = ("events", log_id)
+    if key not in self.cache: return
+    cached_start, cached_events = json.loads(self.cache[key])
+    if cached_start + len(cached_events) == start:
+      cached_events += new_events
+      if keep_from > cached_start:
+        cached_events, cached_start = cached_events[keep_from - cached_start:], keep_from
+      self.remember(key, (cached_start, cached_events))
+    else:
+      self.cache.pop(key)
+
+  async def append_events(self, log_id, start, new_events):
+    await self.backend.append_events(log_id, start, new_events)
+    self.remember_events(log_id, start, new_events)
+
+  async def write(self, games, users, deleted_games, logs={}):
+    for game_id in deleted_games:
+      self.cache.pop(("game", game_id), None)
+    await self.backend.write(games, users, deleted_games, logs)
+    snapshots = {game["log"]:game["event_count"] for game in games.values() if "log" in game}
+    for log_id, (start, new_events) in logs.items():
+      self.remember_events(log_id, start, new_events, snapshots.get(log_id, 0))
+    for game_id, game in games.items():
+      self.remember(("game", game_id), game)
+    for user_id, user in users.items():
+      self.remember(("user", user_id), user)
+
+  async def clear(self):
+    self.cache.clear()
+    await self.backend.clear()
+
+
+#Sits in front of the store the bot uses and times everything asked of it, for the risk_store_seconds metric. The
+#count of each operation comes with the histogram.
+class MeteredStorage(Storage):
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  async def timed(self, operation, coroutine):
+    start = time.perf_counter()
+    try:
+      return await coroutine
+    finally:
+      metrics.observe("risk_store_seconds", time.perf_counter() - start, op=operation)
+
+  async def get_game(self, game_id):
+    return await self.timed("get_game", self.backend.get_game(game_id))
+
+  async def put_game(self, game_id, game):
+    return await self.timed("put_game", self.backend.put_game(game_id, game))
+
+  async def delete_game(self, game_id):
+    return await self.timed("delete_game", self.backend.delete_game(game_id))
+
+  async def game_ids(self):
+    return await self.timed("game_ids", self.backend.game_ids())
+
+  async def get_user(self, user_id):
+    return await self.timed("get_user", self.backend.get_user(user_id))
+
+  async def get_users(self, user_ids):
+    return await self.timed("get_users", self.backend.get_users(user_ids))
+
+  async def put_user(self, user_id, user):
+    return await self.timed("put_user", self.backend.put_user(user_id, user))
+
+  async def all_users(self):
+    return await self.timed("all_users", self.backend.all_users())
+
+  async def get_events(self, log_id, start=0):
+    return await self.timed("get_events", self.backend.get_events(log_id, start))
+
+  async def append_events(self, log_id, start, new_events):
+    return await self.timed("append_events", self.backend.append_events(log_id, start, new_events))
+
+  async def write(self, games, users, deleted_games, logs={}):
+    return await self.timed("write", self.backend.write(games, users, deleted_games, logs))
+
+  async def clear(self):
+    return await self.timed("clear", self.backend.clear())
+
+
+#STORAGE picks the backend: "sqlite" (the file named by STORAGE_PATH), "replit" or "memory". Without it we use Replit's
+#database when running on Replit and SQLite everywhere else. Anything slower than memory gets a read-through cache, and
+#everything gets timed.
+def open_storage(kind=None):
+  kind = kind or os.environ.get("STORAGE", "replit" if "REPLIT_DB_URL" in os.environ else "sqlite")
+  if kind == "sqlite":
+    return MeteredStorage(CachedStorage(SQLiteStorage(os.environ.get("STORAGE_PATH", "risk.db"))))
+  if kind == "replit":
+    return MeteredStorage(CachedStorage(ReplitStorage()))
+  if kind == "memory":
+    return MeteredStorage(MemoryStorage())
+  raise ValueError(f"Unknown storage backend '{kind}'.")
+
+
+#How many events a game's log can get ahead of its stored snapshot before the game is written out in full again.
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", 20))
+
+#Collects everything one command loads from the store, so the command can change it freely and then save it all at once
+#with commit(). Each game or user is written at most once per commit, and only if it actually changed. If the command
+#gives up halfway (say, with an error message) and never commits, its changes are simply thrown away, and so are changes
+#it made outside the store that it registered with on_rollback.
+#A game that changed through events (events.apply) only has its new events appended to its log, until the log gets
+#SNAPSHOT_EVERY events ahead of the stored game; loading a game replays whatever's in the log after its snapshot.
+class UnitOfWork:
+
+  def __init__(self, store):
+    self.store = store
+    self.writes = 0
+    self.undos = []
+    self.rollback()
+
+  #Gets a game, loading it from the store the first time it's asked for.
+  @traced("load")
+  async def game(self, game_id):
+    if game_id not in self.games:
+      game = await self.store.get_game(game_id)
+      if game is not None:
+        game["territories"] = as_territories(game["territories"], board)
+        self.snapshot_counts[game_id] = game.get("event_count")
+        if "log" in game:
+          game = await self.replay_trailing(game_id, game)
+        else:
+          events.start_log(game)
+      self.games[game_id] = game
+      self.loaded_games[game_id] = dumps(game, is_game=True)
+    return self.games[game_id]
+
+  #Replays the events in a game's log after its snapshot. One that won't replay (because the engine has changed since it
+  #happened, say) mustn't leave the game stuck for good, failing every command: the game carries on from just before it
+  #on a new log, and is snapshotted straight away so that it's never replayed again. The old log stays for !admin replay.
+  async def replay_trailing(self, game_id, game):
+    snapshot = dumps(game, is_game=True)
+    trailing = await self.store.get_events(game["log"], game["event_count"])
+    for number, event in enumerate(trailing):
+      try:
+        events.apply(None, game, event)
+      except Exception:
+        print(f"Event {game['event_count']} of log {game['log']} won't replay, so game {game_id} is carrying on from just before it.")
+        traceback.print_exc()
+        metrics.count("risk_replay_failures_total")
+        game = loads(snapshot)
+        for event in trailing[:number]:
+          events.apply(None, game, event)
+        del game["log"]
+        events.start_log(game)
+        await self.store.write({game_id:game}, {}, set())
+        self.snapshot_counts[game_id] = game["event_count"]
+        break
+    return game
+
+  def new_game(self, game_id, game):
+    self.games[game_id] = game
+    self.loaded_games[game_id] = None
+    self.snapshot_counts[game_id] = None
+    self.deleted_games.discard(game_id)
+
+  #Registers a function that undoes a change made outside the store (to the directory, say), to be called if this work
+  #is thrown away rather than committed.
+  def on_rollback(self, undo):
+    self.undos.append(undo)
+
+  #Called by events.apply with each event that changes a game.
+  def record(self, game_id, event):
+    self.new_events.setdefault(game_id, []).append(event)
+
+  def delete_game(self, game_id):
+    self.deleted_games.add(game_id)
+
+  #Gets a user, making a fresh one if the store has never heard of them.
+  async def user(self, user_id):
+    if user_id not in self.users:
+      await self.load_users([user_id])
+    return self.users[user_id]
+
+  #Loads several users with one trip to the store.
+  @traced("load")
+  async def load_users(self, user_ids):
+    user_ids = [user_id for user_id in user_ids if user_id not in self.users]
+    for user_id, user in zip(user_ids, await self.store.get_users(user_ids)):
+      self.loaded_users[user_id] = json.dumps(user)
+      self.users[user_id] = user if user is not None else {"current_game_id":None}
+
+  @traced("persist")
+  async def commit(self):
+    logs = {}
+    games = {}
+    for game_id, game in self.games.items():
+      new_events = self.new_events.get(game_id)
+      if new_events:
+        logs[game["log"]] = (game["event_count"] - len(new_events), new_events)
+      if game_id in self.deleted_games or dumps(game, is_game=True) == self.loaded_games[game_id]:
+        continue
+      #Snapshot new games, games that changed some other way than through events, and games whose logs have run long.
+      snapshot_count = self.snapshot_counts[game_id]
+      if not new_events or snapshot_count is None or game["event_count"] - snapshot_count >= SNAPSHOT_EVERY:
+        games[game_id] = game
+    users = {user_id:user for user_id, user in self.users.items() if json.dumps(user) != self.loaded_users[user_id]}
+    if games or users or self.deleted_games or logs:
+      await self.store.write(games, users, self.deleted_games, logs)
+      self.writes += len(games) + len(users) + len(self.deleted_games) + len(logs)
+    self.undos = []
+    self.rollback()
+
+  #Forgets everything loaded so far, along with any changes that weren't committed.
+  def rollback(self):
+    for undo in reversed(self.undos):
+      undo()
+    self.undos = []
+    self.games = {}
+    self.loaded_games = {}
+    self.snapshot_counts = {}
+    self.new_events = {}
+    self.deleted_games = set()
+    self.users = {}
+    self.loaded_users = {}
@@ -0,0 +1,95 @@
+#Where the time goes within a command.
+#Each command is a trace, split into spans by what it's doing: parse (working out what the player typed), load (getting
+#the game and users from the store), state (the engine checking and making the move; it does both in one go), persist
+#(saving), render (getting the map) and send (handing messages to Discord). Whatever's left over is the handler's own
+#logic and waiting for the game's lock.
+#A trace that takes longer than TRACE_SLOW_MS is written to TRACE_LOG as a line of JSON, with how long each kind of span
+#took in total and the order they happened in. Spans don't nest: anything timed inside a span counts as part of it (so
+#replaying a game's events while loading it is loading). Outside of a trace (or with TRACE_LOG set to nothing) a span
+#costs one context variable lookup.
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import datetime
+import inspect
+import json
+import os
+import time
+
+TRACE_LOG = os.environ.get("TRACE_LOG", "slow_traces.log")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 250))
+
+current = ContextVar("trace", default=None)
+
+class Trace:
+
+  def __init__(self, name):
+    self.name = name
+    self.start = time.perf_counter()
+    self.spans = [] #(kind, when it started, how long it took), in seconds from the start of the trace
+    self.in_span = False
+
+  def totals(self):
+    totals = {}
+    for kind, start, seconds in self.spans:
+      totals[kind] = totals.get(kind, 0) + seconds
+    return totals
+
+#Traces everything done inside it under the given name (a command, say). A name of None traces nothing.
+@contextmanager
+def trace(name):
+  if name is None or not TRACE_LOG:
+    token = current.set(None)
+  else:
+    token = current.set(Trace(name))
+  try:
+    yield
+  finally:
+    finished = current.get()
+    current.reset(token)
+    if finished: finish(finished)
+
+def finish(trace):
+  seconds = time.perf_counter() - trace.start
+  if seconds * 1000 < TRACE_SLOW_MS: return
+  record = {"time":datetime.datetime.now().isoformat(timespec="seconds"),
+            "trace":trace.name,
+            "ms":round(seconds * 1000, 3),
+            "spans":{kind:round(total * 1000, 3) for kind, total in trace.totals().items()},
+            "timeline":[[kind, round(start * 1000, 3), round(took * 1000, 3)] for kind, start, took in trace.spans]}
+  with open(TRACE_LOG, "a") as file:
+    file.write(json.dumps(record) + "\n")
+
+#Times whatever's done inside it as a span of the current trace, if there is one.
+@contextmanager
+def span(kind):
+  trace = current.get()
+  if trace is None or trace.in_span:
+    yield
+    return
+  start = time.perf_counter()
+  trace.in_span = True
+  try:
+    yield
+  finally:
+    trace.in_span = False
+    trace.spans.append((kind, start - trace.start, time.perf_counter() - start))
+
+#Decorates a function (or a coroutine function) so that every call to it is a span.
+def traced(kind):
+  def decorate(function):
+    if inspect.iscoroutinefunction(function):
+      @wraps(function)
+      async def traced_coroutine(*args, **kwargs):
+        if current.get() is None: return await function(*args, **kwargs)
+        with span(kind):
+          return await function(*args, **kwargs)
+      return traced_coroutine
+
+    @wraps(function)
+    def traced_function(*args, **kwargs):
+      if current.get() is None: return function(*args, **kwargs)
+      with span(kind):
+        return function(*args, **kwargs)
+    return traced_function
+  return decorate